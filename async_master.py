@@ -0,0 +1,153 @@
+"""Асинхронный запуск бота на AsyncTeleBot: python async_master.py
+
+Обработчики и фильтры те же, что в master.py. Они выполняются в небольшом пуле потоков
+DB_WORKERS, где идут все обращения к базе. Вызовы Bot API, сделанные обработчиком, не ждут
+Telegram в потоке пула: они записываются и отправляются из цикла событий после обработчика,
+по порядку, поэтому ответы разным пользователям идут одновременно, а поток пула сразу берёт
+следующее обновление. Обновления одного пользователя обрабатываются по очереди: следующее
+не проверяется фильтрами, пока не отправлены ответы на предыдущее.
+"""
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+import master
+
+DB_WORKERS = int(os.environ.get('TASK_LAB_DB_WORKERS', 4))
+# Очерёдность обновлений пользователя держится блокировками из фиксированного набора
+USER_LOCK_STRIPES = 1024
+# Адрес Bot API вместо api.telegram.org, как в ingress.py
+API_URL = os.environ.get('TASK_LAB_BOT_API_URL')
+
+_local = threading.local()  # вызовы Bot API обработчика, который выполняется в этом потоке
+
+
+class BotCalls:
+    """Подменяет master.bot.
+
+    В потоке обработчика вызовы записываются и возвращают None (результаты вызовов обработчики
+    не используют). В остальных потоках (напоминания, setup) вызов выполняется в цикле событий,
+    поток ждёт результата и получает исключение, если запрос не удался.
+    """
+
+    def __init__(self, bot: AsyncTeleBot, loop):
+        self._bot = bot
+        self._loop = loop
+
+    def __getattr__(self, name):
+        method = getattr(self._bot, name)
+
+        def call(*args, **kwargs):
+            # Параметры очереди отправки master.QueuedTeleBot: здесь отправляет цикл событий
+            kwargs.pop('priority', None)
+            kwargs.pop('wait', None)
+            calls = getattr(_local, 'calls', None)
+            if calls is not None:
+                calls.append((method, args, kwargs))
+                return None
+            return asyncio.run_coroutine_threadsafe(method(*args, **kwargs), self._loop).result()
+        return call
+
+
+def _update_user_id(update):
+    """id автора обновления (from_user или user вложенного объекта) или None."""
+    for value in vars(update).values():
+        author = getattr(value, 'from_user', None) or getattr(value, 'user', None)
+        if author is not None:
+            return author.id
+    return None
+
+
+class UserOrderedTeleBot(AsyncTeleBot):
+    """AsyncTeleBot, который пропускает обновление пользователя через фильтры и обработчик
+    только после того, как обработано предыдущее обновление этого пользователя.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._user_locks = [asyncio.Lock() for _ in range(USER_LOCK_STRIPES)]
+
+    async def process_new_updates(self, updates):
+        by_user = {}
+        for update in updates:
+            by_user.setdefault(_update_user_id(update), []).append(update)
+        await asyncio.gather(*(self._process_user_updates(user_id, user_updates)
+                               for user_id, user_updates in by_user.items()))
+
+    async def _process_user_updates(self, user_id, updates):
+        if user_id is None:
+            await super().process_new_updates(updates)
+            return
+        async with self._user_locks[user_id % USER_LOCK_STRIPES]:
+            for update in updates:
+                await super().process_new_updates([update])
+
+
+def _run_handler(function, update) -> list:
+    """Выполняет синхронный обработчик и возвращает записанные им вызовы Bot API."""
+    _local.calls = []
+    try:
+        function(update)
+    except Exception as e:
+        print(f"Error in handler {function.__name__}: {e}")
+    finally:
+        calls = _local.calls
+        _local.calls = None
+    return calls
+
+
+class AsyncRuntime:
+    def __init__(self, token: str, db_workers: int = DB_WORKERS):
+        self.bot = UserOrderedTeleBot(token, parse_mode="HTML")
+        self.executor = ThreadPoolExecutor(max_workers=db_workers, thread_name_prefix='db')
+        for handler in master.bot.message_handlers:
+            self.bot.add_message_handler(self._wrap(handler))
+        for handler in master.bot.callback_query_handlers:
+            self.bot.add_callback_query_handler(self._wrap(handler))
+
+    def _wrap(self, handler: dict) -> dict:
+        """Асинхронная копия словаря обработчика TeleBot: фильтр func и сам обработчик — в пуле."""
+        filters = dict(handler['filters'])
+        if 'func' in filters:
+            filters['func'] = self._in_executor(filters['func'])
+        return AsyncTeleBot._build_handler_dict(self._dispatch(handler['function']), **filters)
+
+    def _in_executor(self, func):
+        async def check(update):
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, update)
+        return check
+
+    def _dispatch(self, function):
+        async def handle(update):
+            calls = await asyncio.get_running_loop().run_in_executor(self.executor, _run_handler, function, update)
+            for method, args, kwargs in calls:
+                try:
+                    await method(*args, **kwargs)
+                except Exception as e:
+                    print(f"Error calling Bot API {method.__name__}: {e}")
+        return handle
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        master.bot = BotCalls(self.bot, loop)
+        # Ответы отправляет цикл событий, очередь master.outbound не нужна
+        await loop.run_in_executor(self.executor, functools.partial(master.setup, queued=False))
+        print('Async bot initialized')
+        try:
+            await self.bot.infinity_polling()
+        finally:
+            # Потоки напоминаний могут ждать цикл событий, поэтому останавливаются не в нём
+            await loop.run_in_executor(None, master.reminders.stop)
+            await self.bot.close_session()
+            self.executor.shutdown()
+
+
+if __name__ == '__main__':
+    if API_URL:
+        asyncio_helper.API_URL = API_URL
+    asyncio.run(AsyncRuntime(master.token).run())
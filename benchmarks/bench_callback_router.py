@@ -0,0 +1,95 @@
+"""Сравнение CallbackRouter с цепочкой фильтров callback_query_handler.
+
+Запуск из корня репозитория: python benchmarks/bench_callback_router.py
+Цепочка повторяет прежние фильтры master.py: обработчики проверяются по порядку, пока
+фильтр не совпадёт, и каждый заново разбирает query.data. Проверки прав не обращаются к базе,
+чтобы измерялась только маршрутизация. К обоим вариантам добавляется по EXTRA действий.
+"""
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import callback_router
+
+ROUNDS = 20000
+EXTRA = (0, 20, 100)
+QUERIES = ["lab_menu?3", "create_task", "task_list", "task_2", "select_day_2_2025-01-02",
+           "reserve_2_202501020800_202501020842_1a2b3c4d", "my_tasks?3", "cancel_task_7", "remove_equipment?3"]
+
+
+def handle(query, args):
+    return args
+
+
+def build_chain(extra):
+    """[(фильтр, обработчик)] в порядке регистрации, как у telebot."""
+    chain = [(lambda q, a=f"extra_{i}": q.data.startswith(a), handle) for i in range(extra)]
+    chain += [
+        (lambda q: "lab_menu" in q.data and int(q.data.split('?')[1]) in (1, 2, 3), handle),
+        (lambda q: "link_to" in q.data and int(q.data.split('?')[1]) in (1, 2, 3), handle),
+        (lambda q: q.data == "create_task", handle),
+        (lambda q: q.data == "хз", handle),
+        (lambda q: q.data == "add_another_step", handle),
+        (lambda q: q.data == "finish_steps", handle),
+        (lambda q: q.data == "task_list", handle),
+        (lambda q: q.data.startswith("share_task_"), handle),
+        (lambda q: q.data.startswith("task_"), handle),
+        (lambda q: q.data.startswith("select_day_"), handle),
+        (lambda q: q.data.startswith("next_slots_"), handle),
+        (lambda q: q.data.startswith("reserve_"), handle),
+        (lambda q: q.data == "create_lab", handle),
+        (lambda q: "add_equipment" in q.data, handle),
+        (lambda q: q.data.startswith("equipment_list"), handle),
+        (lambda q: q.data.startswith("my_tasks"), handle),
+        (lambda q: q.data.startswith("cancel_task_"), handle),
+        (lambda q: q.data.startswith("remove_equipment"), handle),
+    ]
+    return chain
+
+
+def chain_dispatch(chain, query):
+    for check, handler in chain:
+        if check(query):
+            # Прежние обработчики разбирали query.data ещё раз
+            return handler(query, query.data.replace('?', '_').split('_'))
+    return None
+
+
+def build_router(extra):
+    router = callback_router.CallbackRouter()
+    for i in range(extra):
+        router.route(f"extra_{i}")(handle)
+    is_member = lambda query, args: int(args[0]) in (1, 2, 3)
+    router.route("lab_menu", check=is_member)(handle)
+    router.route("link_to", check=is_member)(handle)
+    for action in ("create_task", "хз", "add_another_step", "finish_steps", "task_list", "share_task", "task",
+                   "select_day", "next_slots", "reserve", "create_lab", "add_equipment", "equipment_list",
+                   "my_tasks", "cancel_task", "remove_equipment"):
+        router.route(action)(handle)
+    return router
+
+
+def measure(dispatch, queries):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for query in queries:
+            dispatch(query)
+    return (time.perf_counter() - start) / (ROUNDS * len(queries)) * 1e6
+
+
+def main():
+    queries = [SimpleNamespace(data=data) for data in QUERIES]
+    for extra in EXTRA:
+        chain = build_chain(extra)
+        router = build_router(extra)
+        assert all(router.dispatch(query) for query in queries)
+        chain_us = measure(lambda query: chain_dispatch(chain, query), queries)
+        router_us = measure(router.dispatch, queries)
+        print(f"+{extra:>3} действий: цепочка фильтров {chain_us:.2f} мкс, CallbackRouter {router_us:.2f} мкс")
+
+
+if __name__ == '__main__':
+    main()
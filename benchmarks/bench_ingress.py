@@ -0,0 +1,194 @@
+"""Пропускная способность ingress.py при разном числе воркеров.
+
+Запуск из корня репозитория: python benchmarks/bench_ingress.py [число воркеров ...]
+Поднимает локальный поддельный Bot API и проигрывает поток нажатий «Ближайшее свободное
+время» от USERS пользователей. Время считается от выдачи потока до ответа на последнее нажатие;
+запуск воркеров в замер не входит. База создаётся во временном каталоге.
+"""
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+USERS = 64
+CLICKS_PER_USER = 8
+BUSY_DAYS = 4
+INSTANCES = 6
+EMPTY_POLL_SECONDS = 0.05
+
+
+class FakeBotApi:
+    """Отдаёт обновления из очереди через getUpdates и считает ответы на нажатия."""
+
+    def __init__(self):
+        self.updates = []
+        self.released = 0      # сколько обновлений уже можно выдавать
+        self.answered = 0
+        self.expected = 0
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+    def release(self, updates):
+        with self.lock:
+            self.updates.extend(updates)
+            self.released = len(self.updates)
+            self.expected = self.released
+            self.done.clear()
+            if self.answered >= self.expected:
+                self.done.set()
+
+    def handle(self, method, params):
+        if method == 'getUpdates':
+            offset = int(params.get('offset', 0))
+            limit = int(params.get('limit', 100))
+            with self.lock:
+                batch = [u for u in self.updates[:self.released] if u['update_id'] >= offset][:limit]
+            if not batch:
+                time.sleep(EMPTY_POLL_SECONDS)
+            return batch
+        if method == 'answerCallbackQuery':
+            with self.lock:
+                self.answered += 1
+                if self.answered >= self.expected:
+                    self.done.set()
+            return True
+        if method == 'getMe':
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method == 'sendMessage':
+            return {"message_id": 1, "date": 0, "chat": {"id": int(params.get('chat_id', 0)), "type": "private"}}
+        return True
+
+
+def serve(api):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, params):
+            method = urlparse(self.path).path.rsplit('/', 1)[-1]
+            body = json.dumps({"ok": True, "result": api.handle(method, params)}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            # AsyncTeleBot передаёт параметры телом запроса и в GET
+            length = int(self.headers.get('Content-Length', 0))
+            raw = self.rfile.read(length).decode() if length else ''
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                params = json.loads(raw or '{}')
+            else:
+                params = {k: v[0] for k, v in parse_qs(raw).items()}
+            params.update({k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()})
+            self._reply(params)
+
+        do_GET = do_POST
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def setup(db):
+    db.init_db()
+    stages = [[{"name": "prep", "equipment": "Micro", "timing": ["10a", "30p", "10a"]},
+               {"name": "spin", "equipment": "Centri", "timing": ["5a", "20p", "5a"]}],
+              [{"name": "scan", "equipment": "Micro", "timing": ["15a", "40p", "5a"]}]]
+    db.add_user('1')
+    lab_id = db.create_lab('Bench', '1')
+    for _ in range(INSTANCES):
+        db.add_equipment('Micro', True, lab_id)
+    db.add_equipment('Centri', True, lab_id)
+    template_id = db.add_template('Bench', '', stages)
+    for user_id in range(1, USERS + 1):
+        db.add_user(str(user_id))
+        db.create_connection_user_to_lab(str(user_id), lab_id)
+        db.user_select_lab(str(user_id), lab_id)
+        db.assign_task_to_user(template_id, str(user_id))
+    task = db.get_tasks_by_user_id('1')[0]
+    today = datetime.now(tz=db.LOCAL_TZ).replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+    for day in range(BUSY_DAYS):
+        day_start = today + timedelta(days=day, hours=8)
+        for equip_id in db.get_equipment_list(lab_id):
+            db.add_reserve('1', equip_id, day_start, day_start + timedelta(hours=8), task.task_id)
+    db.close_connections()
+
+
+def clicks(user_ids, first_id):
+    return [{"update_id": first_id + n,
+             "callback_query": {"id": str(first_id + n), "chat_instance": "1", "data": "next_slots_0",
+                                "from": {"id": user_id, "is_bot": False, "first_name": "Bench"}}}
+            for n, user_id in enumerate(user_ids)]
+
+
+@contextlib.contextmanager
+def quiet():
+    """Глушит вывод этого процесса и воркеров: они наследуют дескриптор 1."""
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        os.dup2(saved, 1)
+        os.close(saved)
+        os.close(devnull)
+
+
+def measure(ingress, api, workers):
+    stop = threading.Event()
+    thread = threading.Thread(target=ingress.run, args=(workers, stop))
+    with quiet():
+        thread.start()
+        # По нажатию на каждый воркер: дожидаемся, пока все поднимутся
+        api.release(clicks(range(1, workers + 1), len(api.updates) + 1))
+        api.done.wait()
+        stream = [user_id for _ in range(CLICKS_PER_USER) for user_id in range(1, USERS + 1)]
+        start = time.perf_counter()
+        api.release(clicks(stream, len(api.updates) + 1))
+        api.done.wait()
+        elapsed = time.perf_counter() - start
+        stop.set()
+        thread.join()
+    return elapsed, len(stream)
+
+
+def main():
+    worker_counts = [int(arg) for arg in sys.argv[1:]] or [1, os.cpu_count() or 1]
+    work_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        api = FakeBotApi()
+        server = serve(api)
+        os.environ['TELEGRAM_BOT_TOKEN'] = '123456:bench'
+        os.environ['TASK_LAB_BOT_API_URL'] = f'http://127.0.0.1:{server.server_address[1]}/bot{{0}}/{{1}}'
+        with contextlib.redirect_stdout(io.StringIO()):
+            import db
+            import ingress
+            setup(db)
+        for workers in worker_counts:
+            elapsed, count = measure(ingress, api, workers)
+            print(f"{workers:>2} воркеров: {count} нажатий за {elapsed:.2f} с, {count / elapsed:.0f} в секунду")
+        server.shutdown()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Сравнение find_next_slots с поиском по одному дню в цикле.
+
+Запуск из корня репозитория: python benchmarks/bench_next_slots.py
+База создаётся во временном каталоге; первые дни лаборатории почти полностью заняты.
+"""
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BUSY_DAYS = 6
+INSTANCES = 12
+LIMIT = 8
+HORIZON_DAYS = 14
+ROUNDS = 20
+
+
+def setup(db):
+    db.init_db()
+    db.add_user('1')
+    lab_id = db.create_lab('Bench', '1')
+    for _ in range(INSTANCES):
+        db.add_equipment('Micro', True, lab_id)
+    db.add_equipment('Centri', True, lab_id)
+    stages = [[{"name": "prep", "equipment": "Micro", "timing": ["10a", "30p", "10a"]},
+               {"name": "spin", "equipment": "Centri", "timing": ["5a", "20p", "5a"]}],
+              [{"name": "scan", "equipment": "Micro", "timing": ["15a", "40p", "5a"]}]]
+    db.assign_task_to_user(db.add_template('Bench', '', stages), '1')
+    task = db.get_tasks_by_user_id('1')[0]
+
+    # Все экземпляры Micro заняты с 8:00 до 17:00, кроме последнего часа, первые BUSY_DAYS дней
+    today = datetime.now(tz=db.LOCAL_TZ).replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+    for day in range(BUSY_DAYS):
+        day_start = today + timedelta(days=day, hours=8)
+        for equip_id in db.get_equipment_list(lab_id):
+            if db.get_equipment_by_id(equip_id)['name'] == 'Micro':
+                db.add_reserve('1', equip_id, day_start, day_start + timedelta(hours=8), task.task_id)
+    return task, lab_id, today
+
+
+def single_day_loop(db, task, lab_id, today):
+    now = datetime.now(tz=db.LOCAL_TZ).replace(tzinfo=None)
+    slots = []
+    for day in range(HORIZON_DAYS):
+        slots.extend(slot for slot in db.find_available_slots(task, lab_id, today + timedelta(days=day))
+                     if slot[0] >= now)
+        if len(slots) >= LIMIT:
+            break
+    return slots[:LIMIT]
+
+
+def measure(func):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = func()
+    return (time.perf_counter() - start) / ROUNDS * 1000, result
+
+
+def main():
+    work_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            import db
+            task, lab_id, today = setup(db)
+        loop_ms, loop_slots = measure(lambda: single_day_loop(db, task, lab_id, today))
+        next_ms, next_slots = measure(lambda: db.find_next_slots(task, lab_id, HORIZON_DAYS, LIMIT))
+        assert [slot[:2] for slot in loop_slots] == [slot[:2] for slot in next_slots]
+        print(f"find_available_slots по дням: {loop_ms:.1f} мс")
+        print(f"find_next_slots:              {next_ms:.1f} мс")
+        print(f"первое окно: {next_slots[0][0] if next_slots else 'нет'}")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
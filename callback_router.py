@@ -0,0 +1,45 @@
+class CallbackRouter:
+    """Разбор callback_data один раз и выбор обработчика по словарю действий.
+
+    Поддерживаются оба формата кнопок бота: 'действие?арг' и 'действие_арг1_арг2'.
+    Действие ищется точным совпадением, затем по префиксам из не более чем max_words слов,
+    поэтому стоимость маршрутизации не зависит от числа зарегистрированных действий.
+    """
+
+    def __init__(self):
+        self._routes = {}    # {действие: (обработчик, проверка или None)}
+        self.max_words = 1   # наибольшее число слов через '_' в названии действия
+
+    def route(self, action: str, check=None):
+        """Декоратор: handler(query, args) для действия; check(query, args) -> bool вызывается перед ним."""
+        def register(handler):
+            self._routes[action] = (handler, check)
+            self.max_words = max(self.max_words, action.count('_') + 1)
+            return handler
+        return register
+
+    def parse(self, data: str) -> tuple:
+        """'lab_menu?5' -> ('lab_menu', ['5']), 'select_day_0_2025-01-02' -> ('select_day', ['0', '2025-01-02'])."""
+        if '?' in data:
+            action, _, rest = data.partition('?')
+            return action, rest.split('?')
+        if data in self._routes:
+            return data, []
+        parts = data.split('_')
+        for words in range(min(self.max_words, len(parts) - 1), 0, -1):
+            action = '_'.join(parts[:words])
+            if action in self._routes:
+                return action, parts[words:]
+        return None, []
+
+    def dispatch(self, query) -> bool:
+        """Вызывает обработчик query.data; False, если действие не найдено или проверка не пройдена."""
+        action, args = self.parse(query.data)
+        route = self._routes.get(action)
+        if route is None:
+            return False
+        handler, check = route
+        if check is not None and not check(query, args):
+            return False
+        handler(query, args)
+        return True
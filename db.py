@@ -1,114 +1,631 @@
 import os
 import sqlite3
 import json
+import threading
+import hashlib
+import secrets
+import time
+from bisect import bisect_left
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
 
+import occupancy
+import scheduler
+import task_template
+
+DB_DIR = 'database'
+
+# Режим хранения:
+#   'attached' — исходные файлы (labs.db + ATTACH users/tasks/connection) через одно соединение;
+#   'single'   — одна объединённая база, см. migrate_to_single_file().
+# В режиме 'attached' с WAL транзакция атомарна внутри каждого файла, но не между файлами
+# при падении машины посреди COMMIT; 'single' атомарен полностью.
+STORAGE_MODE = os.environ.get('TASK_LAB_STORAGE', 'attached')
+SINGLE_DB_NAME = 'task_lab'
+MAIN_DB_NAME = 'labs'
+ATTACHED_DB_NAMES = ('users', 'tasks', 'connection')
+
+# Файл, в котором исходно лежит каждая таблица
+TABLE_FILES = {
+    'users': 'users',
+    'wizard_state': 'users',
+    'tasks': 'tasks',
+    'templates': 'tasks',
+    'template_steps': 'tasks',
+    'labs': 'labs',
+    'equipments': 'labs',
+    'reserve': 'labs',
+    'notifications': 'labs',
+    'connection_user_to_task': 'connection',
+    'connection_user_to_lab': 'connection',
+}
+
+# Время броней хранится в минутах от эпохи (UTC); наивные datetime в приложении — местное время
+LOCAL_TZ = timezone(timedelta(hours=10))
+TIME_FORMAT = "%Y-%m-%d %H:%M"
+
+# Настройки соединений: WAL, ослабленный fsync, увеличенный кэш страниц и mmap
+CACHE_SIZE_KIB = 16384
+MMAP_SIZE = 256 * 1024 * 1024
+CACHED_STATEMENTS = 256
+
+# Кэш занятости оборудования в памяти процесса; '0' — читать брони из базы при каждом поиске
+OCCUPANCY_CACHE_ENABLED = os.environ.get('TASK_LAB_OCCUPANCY_CACHE', '1') != '0'
+
+# Поиск окон: 'numpy' — матрица занятости дня (нужен NumPy), 'sweep' — по промежуткам броней
+SLOT_ENGINE = os.environ.get('TASK_LAB_SLOT_ENGINE', 'numpy' if scheduler.np is not None else 'sweep')
+
+# За сколько минут до начала шага напоминать; зашито в триггер notifications_insert (миграция 8)
+REMINDER_LEAD_MINUTES = 3
+
+# Бронирование: сколько раз повторять транзакцию, если база занята другим писателем дольше
+# таймаута соединения, и сколько раз искать расписание заново, если время заняли во время поиска
+BOOKING_ATTEMPTS = 3
+BOOKING_RETRY_SECONDS = 0.05
+
+# Планы бронирования, найденные при поиске окон, живут до подтверждения слота; у каждой задачи
+# хранятся её последние планы (поиск дня даёт около 30 окон), истёкшие задачи вытесняются
+PLAN_TTL_SECONDS = 15 * 60
+PLANS_PER_TASK = 256
+# reserve_planned: по этому токену уже бронировали
+PLAN_BOOKED = 'booked'
+
+# Регистрация, права и лаборатории пользователя для фильтров обработчиков; записи сбрасываются
+# при изменениях в этом процессе, TTL ограничивает устаревание из-за других процессов
+USER_CACHE_TTL_SECONDS = 60
+USER_CACHE_SIZE = 4096
+
+_local = threading.local()  # соединение текущего потока
+_stats_lock = threading.Lock()
+_connection_stats = {"opened": 0, "reused": 0}
+# {task_id: {токен: (истекает, lab_id, [(equip_id, начало, конец, ветка, шаг), ...] или None, если забронирован)}},
+# задачи — в порядке последнего плана
+_plan_cache = OrderedDict()
+_plan_cache_lock = threading.Lock()
+_user_cache = OrderedDict()        # {telegram_id: (истекает, зарегистрирован, is_admin, (lab_id, ...))}
+_lab_admins_cache = OrderedDict()  # {lab_id: (истекает, frozenset(str(admin_id), ...))}
+_user_cache_lock = threading.Lock()
+_occupancy = occupancy.OccupancyCache()
+_reservation_listeners = []  # функции listener(added, removed), см. add_reservation_listener
+
 class Task:
     def __init__(self, name: str, description: str, stages: list):
         self.name = name
         self.description = description
         self.stages = stages
         self.task_id = None
+        self.template_id = None
+        self.shift_table = None  # таблица допустимых смещений веток, см. scheduler.build_shift_table
+        self.duration = None     # минимальная длительность в минутах из templates.duration, см. _template_schedule
+        self._compiled = None
+
+    @property
+    def compiled(self) -> task_template.CompiledTemplate:
+        """Разобранные stages из кэша task_template; после правки stages сбросьте _compiled."""
+        if self._compiled is None:
+            self._compiled = task_template.load(json.dumps(self.stages))
+        return self._compiled
+
+def to_epoch_minutes(value) -> int:
+    """Переводит datetime (наивный — в местном времени) или строку TIME_FORMAT в минуты от эпохи UTC."""
+    if isinstance(value, str):
+        value = datetime.strptime(value, TIME_FORMAT)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=LOCAL_TZ)
+    return int(value.timestamp()) // 60
+
+def from_epoch_minutes(minutes: int) -> datetime:
+    """Переводит минуты от эпохи UTC в наивный datetime местного времени."""
+    return datetime.fromtimestamp(minutes * 60, LOCAL_TZ).replace(tzinfo=None)
+
+def shift_table_json(stages: list):
+    """Строит и сериализует таблицу допустимых смещений веток шаблона; None, если stages некорректны."""
+    try:
+        return json.dumps(task_template.load(json.dumps(stages)).shift_table)
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
 
-def init_db():
-    if not os.path.exists('database'):
-        os.makedirs('database')
+def stages_hash(stages: list) -> str:
+    """Хэш содержимого stages, не зависящий от форматирования JSON, — для поиска шаблона по содержимому."""
+    canonical = json.dumps(stages, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(canonical.encode()).hexdigest()
+
+def _insert_template_steps(c: sqlite3.Cursor, template_id: int, stages_json: str):
+    """Записывает шаги шаблона в template_steps; некорректные stages пропускаются."""
+    try:
+        compiled = task_template.load(stages_json)
+    except (json.JSONDecodeError, KeyError, IndexError, TypeError, ValueError):
+        return
+    c.executemany('''INSERT INTO template_steps (template_id, branch_idx, step_idx, name, equipment,
+                                                 active_time, passive_time, processing_time)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                  [(template_id, step.branch_idx, step.step_idx, step.name, step.equipment,
+                    step.active, step.passive, step.processing)
+                   for branch in compiled.branches for step in branch.steps])
+
+def _count_connection(key: str):
+    with _stats_lock:
+        _connection_stats[key] += 1
+
+def _schemas() -> list:
+    if STORAGE_MODE == 'single':
+        return ['main']
+    return ['main'] + list(ATTACHED_DB_NAMES)
+
+def schema_of(table: str) -> str:
+    """Возвращает имя схемы, в которой лежит таблица при текущем режиме хранения."""
+    if STORAGE_MODE == 'single' or TABLE_FILES[table] == MAIN_DB_NAME:
+        return 'main'
+    return TABLE_FILES[table]
+
+def _tune_connection(conn: sqlite3.Connection):
+    for schema in _schemas():
+        conn.execute(f'PRAGMA {schema}.journal_mode=WAL')
+        conn.execute(f'PRAGMA {schema}.synchronous=NORMAL')
+        conn.execute(f'PRAGMA {schema}.cache_size=-{CACHE_SIZE_KIB}')
+        conn.execute(f'PRAGMA {schema}.mmap_size={MMAP_SIZE}')
+
+def _open_connection() -> sqlite3.Connection:
+    if STORAGE_MODE == 'single':
+        return sqlite3.connect(f'{DB_DIR}/{SINGLE_DB_NAME}.db', cached_statements=CACHED_STATEMENTS)
+    if STORAGE_MODE != 'attached':
+        raise ValueError(f"Unknown storage mode: {STORAGE_MODE}")
+    conn = sqlite3.connect(f'{DB_DIR}/{MAIN_DB_NAME}.db', cached_statements=CACHED_STATEMENTS)
+    for name in ATTACHED_DB_NAMES:
+        conn.execute('ATTACH DATABASE ? AS ' + name, (f'{DB_DIR}/{name}.db',))
+    return conn
+
+def get_connection() -> sqlite3.Connection:
+    """Возвращает соединение текущего потока, открывая его при первом обращении.
+
+    Все таблицы доступны через это соединение по неквалифицированным именам,
+    поэтому запросы могут объединять таблицы разных файлов в одном JOIN и одной транзакции.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        _count_connection("reused")
+        return conn
+    conn = _open_connection()
+    _tune_connection(conn)
+    _local.conn = conn
+    _count_connection("opened")
+    return conn
+
+def release_connection(conn: sqlite3.Connection):
+    """Возвращает соединение в пул потока, откатывая незавершённую транзакцию."""
+    if conn.in_transaction:
+        conn.rollback()
+
+def close_connections():
+    """Закрывает соединение текущего потока."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        return
+    conn.close()
+    _local.conn = None
 
-    users_conn = sqlite3.connect('database/users.db')
-    users_c = users_conn.cursor()
+def get_connection_stats() -> dict:
+    """Возвращает счётчики открытых и переиспользованных соединений."""
+    with _stats_lock:
+        return dict(_connection_stats)
 
-    users_c.execute('''CREATE TABLE IF NOT EXISTS users
+def reset_connection_stats():
+    with _stats_lock:
+        for key in _connection_stats:
+            _connection_stats[key] = 0
+
+def _create_tables(c: sqlite3.Cursor, schema_for=schema_of):
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {schema_for('users')}.users
                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
                      telegram_id TEXT NOT NULL,
                      selected_lab TEXT DEFAULT NULL,
                      is_admin INTEGER NOT NULL DEFAULT 0)''')
-    
-    users_conn.commit()
-    users_conn.close()
-    
-    tasks_conn = sqlite3.connect('database/tasks.db')
-    tasks_c = tasks_conn.cursor()
 
-    tasks_c.execute('''CREATE TABLE IF NOT EXISTS tasks
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {schema_for('tasks')}.tasks
                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
                      templates_id INTEGER NOT NULL)''')
-    
-    tasks_c.execute('''CREATE TABLE IF NOT EXISTS templates
+
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {schema_for('templates')}.templates
                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
                      name TEXT NOT NULL,
                      description TEXT NOT NULL,
                      stages TEXT NOT NULL)''')
-    
-    tasks_conn.commit()
-    tasks_conn.close()
-    
-    labs_conn = sqlite3.connect('database/labs.db')
-    labs_c = labs_conn.cursor()
 
-    labs_c.execute('''CREATE TABLE IF NOT EXISTS labs
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {schema_for('labs')}.labs
                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
                      name TEXT NOT NULL,
                      admins TEXT NOT NULL)''')
-    
-    labs_c.execute('''CREATE TABLE IF NOT EXISTS equipments
+
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {schema_for('equipments')}.equipments
                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
                      name TEXT NOT NULL,
                      is_active INTEGER NOT NULL,
                      lab_id INTEGER NOT NULL)''')
-    
-    labs_c.execute('''CREATE TABLE IF NOT EXISTS reserve
+
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {schema_for('reserve')}.reserve
                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
                      user_id INTEGER NOT NULL,
                      start_time TEXT NOT NULL,
                      end_time TEXT NOT NULL,
                      equipment_id INTEGER NOT NULL,
                      task_id INTEGER NOT NULL)''')
-    
-    labs_conn.commit()
-    labs_conn.close()
-    
-    connection_conn = sqlite3.connect('database/connection.db')
-    connection_c = connection_conn.cursor()
 
-    connection_c.execute('''CREATE TABLE IF NOT EXISTS connection_user_to_task
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {schema_for('connection_user_to_task')}.connection_user_to_task
                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
                      user_id TEXT NOT NULL,
                      task_id INTEGER NOT NULL)''')
-    
-    connection_c.execute('''CREATE TABLE IF NOT EXISTS connection_user_to_lab
+
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {schema_for('connection_user_to_lab')}.connection_user_to_lab
                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
                      user_id TEXT NOT NULL,
                      lab_id INTEGER NOT NULL)''')
-    
-    connection_conn.commit()
-    connection_conn.close()
 
-def is_user_registered(telegram_id: str):
-    conn = sqlite3.connect('database/users.db')
+def _migration_indexes(c: sqlite3.Cursor, schema_for):
+    """Индексы горячих выборок и уникальность пользователей и связей."""
+    # Перед созданием уникальных индексов убираем накопившиеся дубликаты
+    c.execute('''UPDATE users SET is_admin = (SELECT MAX(u.is_admin) FROM users u
+                                              WHERE u.telegram_id = users.telegram_id)''')
+    c.execute('''DELETE FROM users WHERE id NOT IN (SELECT MIN(id) FROM users GROUP BY telegram_id)''')
+    c.execute('''DELETE FROM connection_user_to_lab WHERE id NOT IN
+                 (SELECT MIN(id) FROM connection_user_to_lab GROUP BY user_id, lab_id)''')
+    c.execute('''DELETE FROM connection_user_to_task WHERE id NOT IN
+                 (SELECT MIN(id) FROM connection_user_to_task GROUP BY user_id, task_id)''')
+
+    c.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {schema_for("users")}.idx_users_telegram_id '
+              f'ON users (telegram_id)')
+    c.execute(f'CREATE INDEX IF NOT EXISTS {schema_for("reserve")}.idx_reserve_equipment_start '
+              f'ON reserve (equipment_id, start_time)')
+    c.execute(f'CREATE INDEX IF NOT EXISTS {schema_for("reserve")}.idx_reserve_user '
+              f'ON reserve (user_id)')
+    c.execute(f'CREATE INDEX IF NOT EXISTS {schema_for("equipments")}.idx_equipments_lab_active_name '
+              f'ON equipments (lab_id, is_active, name)')
+    c.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {schema_for("connection_user_to_task")}.idx_user_task '
+              f'ON connection_user_to_task (user_id, task_id)')
+    c.execute(f'CREATE INDEX IF NOT EXISTS {schema_for("connection_user_to_task")}.idx_user_task_task '
+              f'ON connection_user_to_task (task_id)')
+    c.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {schema_for("connection_user_to_lab")}.idx_user_lab '
+              f'ON connection_user_to_lab (user_id, lab_id)')
+    c.execute(f'CREATE INDEX IF NOT EXISTS {schema_for("connection_user_to_lab")}.idx_user_lab_lab '
+              f'ON connection_user_to_lab (lab_id)')
+
+def _migration_lab_creator(c: sqlite3.Cursor, schema_for):
+    """Колонка labs.creator_id, которую читает is_user_admin_of_any_lab."""
+    c.execute(f'PRAGMA {schema_for("labs")}.table_info(labs)')
+    if 'creator_id' not in [row[1] for row in c.fetchall()]:
+        c.execute(f'ALTER TABLE {schema_for("labs")}.labs ADD COLUMN creator_id TEXT')
+    # Создатель лаборатории — первый администратор в списке admins
+    c.execute('''UPDATE labs SET creator_id = json_extract(admins, '$[0]')
+                 WHERE creator_id IS NULL AND json_valid(admins)''')
+    c.execute(f'CREATE INDEX IF NOT EXISTS {schema_for("labs")}.idx_labs_creator ON labs (creator_id)')
+
+def _migration_reserve_minutes(c: sqlite3.Cursor, schema_for):
+    """Перевод броней на целые минуты UTC и R*Tree-индекс (оборудование × время)."""
+    schema = schema_for("reserve")
+    c.execute(f'''CREATE TABLE {schema}.reserve_new
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER NOT NULL,
+                  start_min INTEGER NOT NULL,
+                  end_min INTEGER NOT NULL,
+                  equipment_id INTEGER NOT NULL,
+                  task_id INTEGER NOT NULL)''')
+    # Строки "%Y-%m-%d %H:%M" записаны в местном времени: сдвигаем их в UTC
+    shift = f"{-int(LOCAL_TZ.utcoffset(None).total_seconds() // 60)} minutes"
+    c.execute(f'''INSERT INTO {schema}.reserve_new (id, user_id, start_min, end_min, equipment_id, task_id)
+                  SELECT id, user_id, start_min, end_min, equipment_id, task_id FROM
+                  (SELECT id, user_id, equipment_id, task_id,
+                          CAST(strftime('%s', start_time, ?) AS INTEGER) / 60 AS start_min,
+                          CAST(strftime('%s', end_time, ?) AS INTEGER) / 60 AS end_min
+                   FROM {schema}.reserve)
+                  WHERE start_min IS NOT NULL AND end_min IS NOT NULL AND start_min <= end_min''',
+              (shift, shift))
+    c.execute(f'SELECT (SELECT COUNT(*) FROM {schema}.reserve) - (SELECT COUNT(*) FROM {schema}.reserve_new)')
+    skipped = c.fetchone()[0]
+    if skipped:
+        print(f"Skipped {skipped} reservations with invalid time")
+    c.execute(f'DROP TABLE {schema}.reserve')
+    c.execute(f'ALTER TABLE {schema}.reserve_new RENAME TO reserve')
+    c.execute(f'CREATE INDEX {schema}.idx_reserve_equipment_start ON reserve (equipment_id, start_min)')
+    c.execute(f'CREATE INDEX {schema}.idx_reserve_user ON reserve (user_id)')
+
+    # rtree_i32 хранит координаты точно (обычный rtree — во float32, теряя минуты)
+    c.execute(f'''CREATE VIRTUAL TABLE {schema}.reserve_rtree
+                 USING rtree_i32(id, equipment_lo, equipment_hi, start_min, end_min)''')
+    c.execute(f'''INSERT INTO {schema}.reserve_rtree
+                 SELECT id, equipment_id, equipment_id, start_min, end_min FROM {schema}.reserve''')
+    c.execute(f'''CREATE TRIGGER {schema}.reserve_rtree_insert AFTER INSERT ON reserve BEGIN
+                     INSERT INTO reserve_rtree VALUES (new.id, new.equipment_id, new.equipment_id,
+                                                       new.start_min, new.end_min);
+                 END''')
+    c.execute(f'''CREATE TRIGGER {schema}.reserve_rtree_update AFTER UPDATE ON reserve BEGIN
+                     DELETE FROM reserve_rtree WHERE id = old.id;
+                     INSERT INTO reserve_rtree VALUES (new.id, new.equipment_id, new.equipment_id,
+                                                       new.start_min, new.end_min);
+                 END''')
+    c.execute(f'''CREATE TRIGGER {schema}.reserve_rtree_delete AFTER DELETE ON reserve BEGIN
+                     DELETE FROM reserve_rtree WHERE id = old.id;
+                 END''')
+
+def _migration_template_shift_table(c: sqlite3.Cursor, schema_for):
+    """Колонка templates.shift_table с допустимыми смещениями веток, заполняемая для всех шаблонов."""
+    c.execute(f'ALTER TABLE {schema_for("templates")}.templates ADD COLUMN shift_table TEXT')
+    c.execute('''SELECT id, stages FROM templates''')
+    for template_id, stages_json in c.fetchall():
+        try:
+            stages = json.loads(stages_json)
+        except json.JSONDecodeError:
+            continue
+        c.execute('''UPDATE templates SET shift_table = ? WHERE id = ?''', (shift_table_json(stages), template_id))
+
+def _migration_template_duration(c: sqlite3.Cursor, schema_for):
+    """Колонка templates.duration — минимальная длительность шаблона.
+
+    Для полностью перебранной таблицы смещений это её первая запись; для усечённой длительность
+    останется пустой и будет вычислена при первом поиске по шаблону, см. _template_schedule.
+    """
+    c.execute(f'ALTER TABLE {schema_for("templates")}.templates ADD COLUMN duration INTEGER')
+    c.execute('''UPDATE templates SET duration = json_extract(shift_table, '$.shifts[0][0]')
+                 WHERE json_extract(shift_table, '$.truncated') = 0''')
+
+def _migration_reserve_steps(c: sqlite3.Cursor, schema_for):
+    """Таблица шагов шаблонов и ссылка брони на шаг (branch_idx, step_idx)."""
+    c.execute(f'''CREATE TABLE {schema_for("template_steps")}.template_steps
+                 (template_id INTEGER NOT NULL,
+                  branch_idx INTEGER NOT NULL,
+                  step_idx INTEGER NOT NULL,
+                  name TEXT NOT NULL,
+                  equipment TEXT NOT NULL,
+                  active_time INTEGER NOT NULL,
+                  passive_time INTEGER NOT NULL,
+                  processing_time INTEGER NOT NULL,
+                  PRIMARY KEY (template_id, branch_idx, step_idx)) WITHOUT ROWID''')
+    c.execute(f'ALTER TABLE {schema_for("reserve")}.reserve ADD COLUMN branch_idx INTEGER')
+    c.execute(f'ALTER TABLE {schema_for("reserve")}.reserve ADD COLUMN step_idx INTEGER')
+    c.execute(f'DROP INDEX {schema_for("reserve")}.idx_reserve_user')
+    c.execute(f'CREATE INDEX {schema_for("reserve")}.idx_reserve_user_start ON reserve (user_id, start_min)')
+
+    c.execute('''SELECT id, stages FROM templates''')
+    for template_id, stages_json in c.fetchall():
+        _insert_template_steps(c, template_id, stages_json)
+
+    # Старые брони привязываются к шагу так же, как раньше угадывал get_user_reservations:
+    # первый шаг на том же приборе с той же длительностью
+    c.execute('''SELECT r.id, e.name, r.end_min - r.start_min, tp.stages
+                 FROM reserve r
+                 JOIN equipments e ON e.id = r.equipment_id
+                 JOIN tasks t ON t.id = r.task_id
+                 JOIN templates tp ON tp.id = t.templates_id''')
+    updates = []
+    for reserve_id, equipment_name, duration, stages_json in c.fetchall():
+        try:
+            step = task_template.load(stages_json).find_step(equipment_name, duration)
+        except (json.JSONDecodeError, KeyError, IndexError, TypeError, ValueError):
+            continue
+        if step is not None:
+            updates.append((step.branch_idx, step.step_idx, reserve_id))
+    c.executemany('''UPDATE reserve SET branch_idx = ?, step_idx = ? WHERE id = ?''', updates)
+
+def _migration_template_stages_hash(c: sqlite3.Cursor, schema_for):
+    """Колонка templates.stages_hash с индексом для поиска шаблона по содержимому."""
+    schema = schema_for("templates")
+    c.execute(f'ALTER TABLE {schema}.templates ADD COLUMN stages_hash TEXT')
+    c.execute('''SELECT id, stages FROM templates''')
+    updates = []
+    for template_id, stages_json in c.fetchall():
+        try:
+            updates.append((stages_hash(json.loads(stages_json)), template_id))
+        except json.JSONDecodeError:
+            continue
+    c.executemany('''UPDATE templates SET stages_hash = ? WHERE id = ?''', updates)
+    c.execute(f'CREATE INDEX {schema}.idx_templates_stages_hash ON templates (stages_hash)')
+
+def _migration_notifications(c: sqlite3.Cursor, schema_for):
+    """Очередь напоминаний notifications, которую триггеры на reserve держат в согласии с бронями.
+
+    Таблица лежит в одном файле с reserve: триггер не может писать в другую базу.
+    """
+    schema = schema_for("notifications")
+    c.execute(f'''CREATE TABLE {schema}.notifications
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  reserve_id INTEGER NOT NULL UNIQUE,
+                  user_id INTEGER NOT NULL,
+                  due_min INTEGER NOT NULL,
+                  status TEXT NOT NULL DEFAULT 'pending',
+                  attempts INTEGER NOT NULL DEFAULT 0,
+                  next_attempt_at INTEGER NOT NULL DEFAULT 0,
+                  claimed_until INTEGER,
+                  last_error TEXT)''')
+    c.execute(f'CREATE INDEX {schema}.idx_notifications_status_due ON notifications (status, due_min)')
+    # Напоминания только о шагах задач: ручные брони без шага не напоминаются, как и раньше
+    c.execute(f'''CREATE TRIGGER {schema}.notifications_insert AFTER INSERT ON reserve
+                 WHEN new.branch_idx IS NOT NULL BEGIN
+                     INSERT INTO notifications (reserve_id, user_id, due_min)
+                     VALUES (new.id, new.user_id, new.start_min - {REMINDER_LEAD_MINUTES});
+                 END''')
+    c.execute(f'''CREATE TRIGGER {schema}.notifications_update AFTER UPDATE OF start_min ON reserve BEGIN
+                     UPDATE notifications SET due_min = new.start_min - {REMINDER_LEAD_MINUTES}
+                     WHERE reserve_id = new.id AND status = 'pending';
+                 END''')
+    c.execute(f'''CREATE TRIGGER {schema}.notifications_delete AFTER DELETE ON reserve BEGIN
+                     DELETE FROM notifications WHERE reserve_id = old.id;
+                 END''')
+    # Напоминания для уже записанных броней, которые ещё впереди
+    c.execute(f'''INSERT INTO {schema}.notifications (reserve_id, user_id, due_min)
+                  SELECT id, user_id, start_min - ? FROM reserve
+                  WHERE branch_idx IS NOT NULL AND start_min - ? >= ?''',
+              (REMINDER_LEAD_MINUTES, REMINDER_LEAD_MINUTES, int(time.time()) // 60))
+
+def _migration_wizard_state(c: sqlite3.Cursor, schema_for):
+    """Незавершённые мастера создания задач (wizard_state.SqliteWizardStore)."""
+    schema = schema_for("wizard_state")
+    c.execute(f'''CREATE TABLE {schema}.wizard_state
+                 (user_id TEXT PRIMARY KEY,
+                  state TEXT NOT NULL,
+                  expires_at INTEGER NOT NULL)''')
+    c.execute(f'CREATE INDEX {schema}.idx_wizard_state_expires ON wizard_state (expires_at)')
+
+# (версия, функция миграции); новые миграции добавляются только в конец
+MIGRATIONS = [
+    (1, _migration_indexes),
+    (2, _migration_lab_creator),
+    (3, _migration_reserve_minutes),
+    (4, _migration_template_shift_table),
+    (5, _migration_template_duration),
+    (6, _migration_reserve_steps),
+    (7, _migration_template_stages_hash),
+    (8, _migration_notifications),
+    (9, _migration_wizard_state),
+]
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS main.schema_version
+                 (version INTEGER PRIMARY KEY,
+                  applied_at TEXT NOT NULL)''')
+    c.execute('''SELECT COALESCE(MAX(version), 0) FROM main.schema_version''')
+    return c.fetchone()[0]
+
+def run_migrations(conn: sqlite3.Connection, schema_for=schema_of) -> int:
+    """Применяет недостающие миграции, каждую в отдельной транзакции. Возвращает итоговую версию схемы."""
+    version = get_schema_version(conn)
+    c = conn.cursor()
+    for migration_version, migration in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        c.execute('BEGIN')
+        try:
+            migration(c, schema_for)
+            c.execute('''INSERT INTO main.schema_version (version, applied_at) VALUES (?, ?)''',
+                      (migration_version, datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M")))
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        print(f"Schema migrated to version {migration_version}")
+        version = migration_version
+    return version
+
+def init_db():
+    if not os.path.exists(DB_DIR):
+        os.makedirs(DB_DIR)
+
+    conn = get_connection()
     c = conn.cursor()
     try:
-        c.execute('''SELECT COUNT(*) FROM users WHERE telegram_id = ?''', (telegram_id,))
-        count = c.fetchone()[0]
-        return count > 0
-    except:
-        return 'error'
+        _create_tables(c)
+        conn.commit()
+        run_migrations(conn)
     finally:
+        release_connection(conn)
+
+def migrate_to_single_file():
+    """Офлайн-перенос данных из раздельных файлов в одну базу database/task_lab.db.
+
+    Запускать при остановленном боте после init_db(), чтобы исходные файлы были на последней
+    версии схемы; после переноса бот запускается с TASK_LAB_STORAGE=single.
+    """
+    target = f'{DB_DIR}/{SINGLE_DB_NAME}.db'
+    if os.path.exists(target):
+        raise FileExistsError(target)
+    conn = sqlite3.connect(target)
+    try:
+        c = conn.cursor()
+        _create_tables(c, schema_for=lambda table: 'main')
+        conn.commit()
+        run_migrations(conn, schema_for=lambda table: 'main')
+        for name in (MAIN_DB_NAME,) + ATTACHED_DB_NAMES:
+            c.execute('ATTACH DATABASE ? AS ' + f'src_{name}', (f'{DB_DIR}/{name}.db',))
+        for table, name in TABLE_FILES.items():
+            c.execute(f'''SELECT COUNT(*) FROM src_{name}.sqlite_master WHERE type = 'table' AND name = ?''',
+                      (table,))
+            if c.fetchone()[0] == 0:
+                continue
+            c.execute(f'PRAGMA src_{name}.table_info({table})')
+            source_columns = {row[1] for row in c.fetchall()}
+            c.execute(f'PRAGMA main.table_info({table})')
+            columns = ', '.join(row[1] for row in c.fetchall() if row[1] in source_columns)
+            # Строки, созданные триггерами при копировании reserve (notifications), заменяются исходными
+            c.execute(f'DELETE FROM main.{table}')
+            c.execute(f'INSERT INTO main.{table} ({columns}) SELECT {columns} FROM src_{name}.{table}')
+        conn.commit()
+        c.execute('PRAGMA journal_mode=WAL')
+    except:
+        conn.rollback()
         conn.close()
+        os.remove(target)
+        raise
+    conn.close()
+
+def _cache_get(cache: OrderedDict, key):
+    with _user_cache_lock:
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del cache[key]
+            return None
+        cache.move_to_end(key)
+        return entry[1:]
+
+def _cache_put(cache: OrderedDict, key, *value):
+    with _user_cache_lock:
+        cache[key] = (time.monotonic() + USER_CACHE_TTL_SECONDS,) + value
+        cache.move_to_end(key)
+        while len(cache) > USER_CACHE_SIZE:
+            cache.popitem(last=False)
+
+def invalidate_user_cache(telegram_id=None):
+    """Сбрасывает кэш пользователя telegram_id или, без аргумента, всех пользователей и лабораторий."""
+    with _user_cache_lock:
+        if telegram_id is None:
+            _user_cache.clear()
+            _lab_admins_cache.clear()
+        else:
+            _user_cache.pop(str(telegram_id), None)
+
+def _user_profile(telegram_id):
+    """(зарегистрирован, is_admin, (lab_id, ...)) пользователя одним запросом или None при ошибке."""
+    key = str(telegram_id)
+    profile = _cache_get(_user_cache, key)
+    if profile is not None:
+        return profile
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        c.execute('''SELECT u.telegram_id, u.is_admin, l.lab_id FROM (SELECT ? AS telegram_id) q
+                     LEFT JOIN users u ON u.telegram_id = q.telegram_id
+                     LEFT JOIN connection_user_to_lab l ON l.user_id = q.telegram_id
+                     ORDER BY l.id''', (key,))
+        rows = c.fetchall()
+    except:
+        return None
+    finally:
+        release_connection(conn)
+    profile = (rows[0][0] is not None, rows[0][1] == 1,
+               tuple(lab_id for _, _, lab_id in rows if lab_id is not None))
+    _cache_put(_user_cache, key, *profile)
+    return profile
+
+def is_user_registered(telegram_id: str):
+    profile = _user_profile(telegram_id)
+    if profile is None:
+        return 'error'
+    return profile[0]
 
 def add_user(telegram_id: str):
-    conn = sqlite3.connect('database/users.db')
+    conn = get_connection()
     c = conn.cursor()
     try:
-        c.execute('''INSERT INTO users (telegram_id) VALUES (?)''', (telegram_id,))
+        c.execute('''INSERT OR IGNORE INTO users (telegram_id) VALUES (?)''', (telegram_id,))
         conn.commit()
+        invalidate_user_cache(telegram_id)
         return True
     except:
         return 'error'
     finally:
-        conn.close()
+        release_connection(conn)
 
 def is_user_admin_of_any_lab(telegram_id: str):
-    conn = sqlite3.connect('database/labs.db')
+    conn = get_connection()
     c = conn.cursor()
     try:
         c.execute('''SELECT COUNT(*) FROM labs WHERE creator_id = ?''', (telegram_id,))
@@ -117,174 +634,177 @@ def is_user_admin_of_any_lab(telegram_id: str):
     except:
         return 'error'
     finally:
-        conn.close()
+        release_connection(conn)
 
 def create_template(name: str, description: str, stages: str):
-    conn = sqlite3.connect('database/tasks.db')
+    conn = get_connection()
     c = conn.cursor()
     try:
-        c.execute('''INSERT INTO templates (name, description, stages) VALUES (?, ?, ?)''',
-                  (name, description, stages))
+        try:
+            content_hash = stages_hash(json.loads(stages))
+        except json.JSONDecodeError:
+            content_hash = None
+        # shift_table и duration заполнит первый поиск по шаблону, см. _template_schedule
+        c.execute('''INSERT INTO templates (name, description, stages, stages_hash) VALUES (?, ?, ?, ?)''',
+                  (name, description, stages, content_hash))
+        _insert_template_steps(c, c.lastrowid, stages)
         conn.commit()
         return True
     except:
         return 'error'
     finally:
-        conn.close()
+        release_connection(conn)
 
 def delete_template(id: int):
-    conn = sqlite3.connect('database/tasks.db')
+    conn = get_connection()
     c = conn.cursor()
     try:
         c.execute('DELETE FROM templates WHERE id = ?', (id,))
+        c.execute('DELETE FROM template_steps WHERE template_id = ?', (id,))
         conn.commit()
         return True
     except:
         return 'error'
     finally:
-        conn.close()
+        release_connection(conn)
 
 def assign_task_to_user(templates_id: int, user_id: str):
-    conn_tasks = sqlite3.connect('database/tasks.db')
-    c_tasks = conn_tasks.cursor()
-    conn_connection = sqlite3.connect('database/connection.db')
-    c_connection = conn_connection.cursor()
+    conn = get_connection()
+    c = conn.cursor()
     try:
-        c_tasks.execute('''INSERT INTO tasks (templates_id) VALUES (?)''', (templates_id,))
-        conn_tasks.commit()
-        task_id = c_tasks.lastrowid
-        c_connection.execute('''INSERT INTO connection_user_to_task (user_id, task_id) VALUES (?, ?)''',
-                             (user_id, task_id))
-        conn_connection.commit()
+        c.execute('''INSERT INTO tasks (templates_id) VALUES (?)''', (templates_id,))
+        task_id = c.lastrowid
+        c.execute('''INSERT INTO connection_user_to_task (user_id, task_id) VALUES (?, ?)''',
+                  (user_id, task_id))
+        conn.commit()
         return True
     except:
         return 'error'
     finally:
-        conn_tasks.close()
-        conn_connection.close()
+        release_connection(conn)
 
 def unassign_task_to_user(user_id: int, task_id: int):
-    conn_connection = sqlite3.connect('database/connection.db')
-    c_connection = conn_connection.cursor()
-    conn_tasks = sqlite3.connect('database/tasks.db')
-    c_tasks = conn_tasks.cursor()
+    conn = get_connection()
+    c = conn.cursor()
     try:
-        c_connection.execute('''DELETE FROM connection_user_to_task WHERE user_id = ? AND task_id = ?''',
-                             (user_id, task_id))
-        conn_connection.commit()
-        c_connection.execute('''SELECT COUNT(*) FROM connection_user_to_task WHERE task_id = ?''', (task_id,))
-        count = c_connection.fetchone()[0]
-        if count == 0:
-            c_tasks.execute('DELETE FROM tasks WHERE id = ?', (task_id,))
-            conn_tasks.commit()
+        c.execute('''DELETE FROM connection_user_to_task WHERE user_id = ? AND task_id = ?''',
+                  (user_id, task_id))
+        c.execute('''DELETE FROM tasks WHERE id = ? AND NOT EXISTS
+                     (SELECT 1 FROM connection_user_to_task WHERE task_id = ?)''', (task_id, task_id))
+        conn.commit()
         return True
     except:
         return 'error'
     finally:
-        conn_connection.close()
-        conn_tasks.close()
+        release_connection(conn)
 
 def create_connection_user_to_lab(user_id: str, lab_id: int):
-    conn = sqlite3.connect('database/connection.db')
+    conn = get_connection()
     c = conn.cursor()
     try:
-        c.execute('''SELECT COUNT(*) FROM connection_user_to_lab WHERE user_id = ? AND lab_id = ?''',
-                  (user_id, lab_id))
-        if c.fetchone()[0] > 0:
-            return True
-        c.execute('''INSERT INTO connection_user_to_lab (user_id, lab_id) VALUES (?, ?)''',
+        c.execute('''INSERT OR IGNORE INTO connection_user_to_lab (user_id, lab_id) VALUES (?, ?)''',
                   (user_id, lab_id))
         conn.commit()
+        invalidate_user_cache(user_id)
         return True
     except:
         return 'error'
     finally:
-        conn.close()
+        release_connection(conn)
 
 def create_lab(name: str, creator_id: str):
-    conn = sqlite3.connect('database/labs.db')
+    conn = get_connection()
     c = conn.cursor()
     try:
-        c.execute('''INSERT INTO labs (name, admins) VALUES (?, ?)''', (name, json.dumps([creator_id])))
-        conn.commit()
+        c.execute('''INSERT INTO labs (name, admins, creator_id) VALUES (?, ?, ?)''',
+                  (name, json.dumps([creator_id]), creator_id))
         lab_id = c.lastrowid
-        connection_result = create_connection_user_to_lab(creator_id, lab_id)
-        if connection_result == 'error' or connection_result is False:
-            return 'error'
+        c.execute('''INSERT INTO connection_user_to_lab (user_id, lab_id) VALUES (?, ?)''',
+                  (creator_id, lab_id))
+        conn.commit()
+        invalidate_user_cache(creator_id)
         return lab_id
     except:
         return 'error'
     finally:
-        conn.close()
+        release_connection(conn)
 
 def delete_lab(id: int):
-    conn_labs = sqlite3.connect('database/labs.db')
-    c_labs = conn_labs.cursor()
-    conn_connection = sqlite3.connect('database/connection.db')
-    c_connection = conn_connection.cursor()
+    conn = get_connection()
+    c = conn.cursor()
     try:
-        c_labs.execute('SELECT id FROM equipments WHERE lab_id = ?', (id,))
-        equipment_ids = [row[0] for row in c_labs.fetchall()]
-        for equipment_id in equipment_ids:
-            c_labs.execute('DELETE FROM reserve WHERE equipment_id = ?', (equipment_id,))
-        c_labs.execute('DELETE FROM equipments WHERE lab_id = ?', (id,))
-        c_labs.execute('DELETE FROM labs WHERE id = ?', (id,))
-        c_connection.execute('DELETE FROM connection_user_to_lab WHERE lab_id = ?', (id,))
-        conn_labs.commit()
-        conn_connection.commit()
+        c.execute('''DELETE FROM reserve WHERE equipment_id IN
+                     (SELECT id FROM equipments WHERE lab_id = ?)''', (id,))
+        c.execute('DELETE FROM equipments WHERE lab_id = ?', (id,))
+        c.execute('DELETE FROM labs WHERE id = ?', (id,))
+        c.execute('DELETE FROM connection_user_to_lab WHERE lab_id = ?', (id,))
+        conn.commit()
+        _occupancy.drop_lab(id)
+        # Связи с лабораторией были у многих пользователей
+        invalidate_user_cache()
         return True
     except:
         return 'error'
     finally:
-        conn_labs.close()
-        conn_connection.close()
+        release_connection(conn)
 
 def add_equipment(name: str, is_active: bool, lab_id: int):
-    conn = sqlite3.connect('database/labs.db')
+    conn = get_connection()
     c = conn.cursor()
     try:
         is_active_int = 1 if is_active else 0
         c.execute('''INSERT INTO equipments (name, is_active, lab_id) VALUES (?, ?, ?)''',
                   (name, is_active_int, lab_id))
         conn.commit()
+        if is_active_int:
+            _occupancy.add_equipment(lab_id, c.lastrowid, name)
         return True
     except:
         return 'error'
     finally:
-        conn.close()
+        release_connection(conn)
 
 def delete_equipment(id: int):
-    conn = sqlite3.connect('database/labs.db')
+    conn = get_connection()
     c = conn.cursor()
     try:
+        c.execute('''SELECT lab_id FROM equipments WHERE id = ?''', (id,))
+        result = c.fetchone()
         c.execute('DELETE FROM equipments WHERE id = ?', (id,))
         conn.commit()
+        if result is not None:
+            _occupancy.drop_equipment(result[0], id)
         return True
     except:
         return 'error'
     finally:
-        conn.close()
+        release_connection(conn)
 
 def change_equipment_status(equipment_id: int):
-    conn = sqlite3.connect('database/labs.db')
+    conn = get_connection()
     c = conn.cursor()
     try:
-        c.execute('''SELECT is_active FROM equipments WHERE id = ?''', (equipment_id,))
+        c.execute('''SELECT is_active, name, lab_id FROM equipments WHERE id = ?''', (equipment_id,))
         result = c.fetchone()
         if result is None:
             return False
-        current_status = result[0]
+        current_status, name, lab_id = result
         new_status = 0 if current_status == 1 else 1
         c.execute('''UPDATE equipments SET is_active = ? WHERE id = ?''', (new_status, equipment_id))
         conn.commit()
+        if new_status:
+            _occupancy.add_equipment(lab_id, equipment_id, name,
+                                     lambda start_min, end_min: _equipment_busy(c, equipment_id, start_min, end_min))
+        else:
+            _occupancy.drop_equipment(lab_id, equipment_id)
         return True
     except:
         return "error"
     finally:
-        conn.close()
+        release_connection(conn)
 
 def get_equipment_list(lab_id: int) -> list:
-    conn = sqlite3.connect('database/labs.db')
+    conn = get_connection()
     c = conn.cursor()
     try:
         c.execute('''SELECT id FROM equipments WHERE lab_id = ?''', (lab_id,))
@@ -292,10 +812,10 @@ def get_equipment_list(lab_id: int) -> list:
     except:
         return []
     finally:
-        conn.close()
+        release_connection(conn)
 
 def get_equipment_by_id(equipment_id: int) -> dict:
-    conn = sqlite3.connect('database/labs.db')
+    conn = get_connection()
     c = conn.cursor()
     try:
         c.execute('''SELECT id, name, is_active, lab_id FROM equipments WHERE id = ?''', (equipment_id,))
@@ -306,49 +826,101 @@ def get_equipment_by_id(equipment_id: int) -> dict:
     except:
         return None
     finally:
-        conn.close()
-
-def add_reserve(user_id: int, equipment_id: int, start_time: str, end_time: str, task_id: int):
-    conn = sqlite3.connect('database/labs.db')
+        release_connection(conn)
+
+def has_overlapping_reservation(c: sqlite3.Cursor, equipment_id: int, start_min: int, end_min: int) -> bool:
+    """Проверяет по R*Tree, есть ли бронь оборудования, пересекающая [start_min, end_min)."""
+    c.execute('''SELECT 1 FROM reserve_rtree
+                 WHERE equipment_lo <= ? AND equipment_hi >= ? AND start_min < ? AND end_min > ?
+                 LIMIT 1''', (equipment_id, equipment_id, end_min, start_min))
+    return c.fetchone() is not None
+
+def _insert_reservations(c: sqlite3.Cursor, user_id, task_id, placements: list):
+    """Перепроверяет и вставляет брони [(equip_id, начало, конец, branch_idx, step_idx), ...] в открытой транзакции.
+
+    Возвращает [(reserve_id, начало), ...] или None, если прибор выключен или время уже занято.
+    """
+    added = []
+    for equip_id, start_min, end_min, branch_idx, step_idx in placements:
+        c.execute('''SELECT is_active FROM equipments WHERE id = ?''', (equip_id,))
+        result = c.fetchone()
+        if result is None or result[0] == 0 or has_overlapping_reservation(c, equip_id, start_min, end_min):
+            return None
+        c.execute('''INSERT INTO reserve (user_id, equipment_id, start_min, end_min, task_id, branch_idx, step_idx)
+                     VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                  (user_id, equip_id, start_min, end_min, task_id, branch_idx, step_idx))
+        added.append((c.lastrowid, start_min))
+    return added
+
+def _book(conn: sqlite3.Connection, user_id, task_id, placements: list):
+    """Бронирует placements атомарно: проверка и вставка идут в одной транзакции BEGIN IMMEDIATE.
+
+    Пока она открыта, другие писатели ждут, поэтому занятое параллельно время не может быть
+    забронировано дважды, а поиск расписания идёт вне транзакции и никого не блокирует.
+    Возвращает [(reserve_id, начало), ...] или None при конфликте.
+    """
+    c = conn.cursor()
+    for attempt in range(BOOKING_ATTEMPTS):
+        try:
+            c.execute('BEGIN IMMEDIATE')
+            added = _insert_reservations(c, user_id, task_id, placements)
+            if added is None:
+                conn.rollback()
+                return None
+            conn.commit()
+            return added
+        except sqlite3.OperationalError as e:
+            conn.rollback()
+            # 'database is locked': другой писатель держал базу дольше таймаута соединения
+            if 'locked' not in str(e) or attempt == BOOKING_ATTEMPTS - 1:
+                raise
+            time.sleep(BOOKING_RETRY_SECONDS * 2 ** attempt)
+
+def add_reserve(user_id: int, equipment_id: int, start_time, end_time, task_id: int):
+    """Бронирует оборудование на [start_time, end_time); время — datetime или строка TIME_FORMAT."""
+    conn = get_connection()
     c = conn.cursor()
     try:
-        c.execute('''SELECT is_active FROM equipments WHERE id = ?''', (equipment_id,))
+        start_min = to_epoch_minutes(start_time)
+        end_min = to_epoch_minutes(end_time)
+        c.execute('''SELECT lab_id FROM equipments WHERE id = ?''', (equipment_id,))
         result = c.fetchone()
-        if result is None or result[0] == 0:
+        if result is None:
             return False
-        c.execute('''SELECT COUNT(*) FROM reserve WHERE equipment_id = ? AND 
-                     ((start_time <= ? AND end_time >= ?) OR (start_time <= ? AND end_time >= ?) OR 
-                     (start_time >= ? AND end_time <= ?))''',
-                  (equipment_id, start_time, start_time, end_time, end_time, start_time, end_time))
-        if c.fetchone()[0] > 0:
+        added = _book(conn, user_id, task_id, [(equipment_id, start_min, end_min, None, None)])
+        if added is None:
             return False
-        c.execute('''INSERT INTO reserve (user_id, equipment_id, start_time, end_time, task_id) 
-                     VALUES (?, ?, ?, ?, ?)''',
-                  (user_id, equipment_id, start_time, end_time, task_id))
-        conn.commit()
+        _occupancy.mark(result[0], equipment_id, start_min, end_min)
+        _notify_reservations(added=added)
         return True
     except:
         return "error"
     finally:
-        conn.close()
+        release_connection(conn)
 
 def delete_reserve(reserve_id: int) -> bool:
-    conn = sqlite3.connect('database/labs.db')
+    conn = get_connection()
     c = conn.cursor()
     try:
-        c.execute('''SELECT COUNT(*) FROM reserve WHERE id = ?''', (reserve_id,))
-        if c.fetchone()[0] == 0:
+        c.execute('''SELECT r.id, r.equipment_id, r.start_min, r.end_min, e.lab_id
+                     FROM reserve r
+                     JOIN equipments e ON e.id = r.equipment_id
+                     WHERE r.id = ?''', (reserve_id,))
+        rows = c.fetchall()
+        if not rows:
             return False
         c.execute('DELETE FROM reserve WHERE id = ?', (reserve_id,))
         conn.commit()
+        _release_occupancy(c, rows)
+        _notify_reservations(removed=[reserve_id])
         return True
     except:
         return "error"
     finally:
-        conn.close()
+        release_connection(conn)
 
 def user_task_exists(user_id: int, task_id: int):
-    conn = sqlite3.connect('database/connection.db')
+    conn = get_connection()
     c = conn.cursor()
     try:
         c.execute('''SELECT COUNT(*) FROM connection_user_to_task WHERE user_id = ? AND task_id = ?''',
@@ -358,26 +930,18 @@ def user_task_exists(user_id: int, task_id: int):
     except:
         return "error"
     finally:
-        conn.close()
+        release_connection(conn)
 
 def user_is_admin(user_id: str):
-    conn = sqlite3.connect('database/users.db')
-    c = conn.cursor()
-    try:
-        c.execute('''SELECT is_admin FROM users WHERE telegram_id = ?''', (user_id,))
-        result = c.fetchone()
-        if result is None:
-            return False
-        return result[0] == 1
-    except:
+    profile = _user_profile(user_id)
+    if profile is None:
         return "error"
-    finally:
-        conn.close()
+    return profile[1]
 
 def get_labname_by_id(lab_id: int) -> str:
     if lab_id is None or lab_id == "":
         return "Не выбрано"
-    conn = sqlite3.connect('database/labs.db')
+    conn = get_connection()
     c = conn.cursor()
     try:
         c.execute('''SELECT name FROM labs WHERE id = ?''', (lab_id,))
@@ -388,22 +952,16 @@ def get_labname_by_id(lab_id: int) -> str:
     except:
         return None
     finally:
-        conn.close()
+        release_connection(conn)
 
 def get_available_labs(user_id: str) -> list:
-    conn_connection = sqlite3.connect('database/connection.db')
-    c_connection = conn_connection.cursor()
-    try:
-        c_connection.execute('''SELECT lab_id FROM connection_user_to_lab WHERE user_id = ?''', (user_id,))
-        lab_ids = [row[0] for row in c_connection.fetchall()]
-        return lab_ids
-    except:
+    profile = _user_profile(user_id)
+    if profile is None:
         return []
-    finally:
-        conn_connection.close()
+    return list(profile[2])
 
 def user_get_selected_lab_id(user_id: str) -> int:
-    conn = sqlite3.connect('database/users.db')
+    conn = get_connection()
     c = conn.cursor()
     try:
         c.execute('''SELECT selected_lab FROM users WHERE telegram_id = ?''', (user_id,))
@@ -414,10 +972,10 @@ def user_get_selected_lab_id(user_id: str) -> int:
     except:
         return None
     finally:
-        conn.close()
+        release_connection(conn)
 
 def user_set_admin(user_id: str, is_admin: bool):
-    conn = sqlite3.connect('database/users.db')
+    conn = get_connection()
     c = conn.cursor()
     try:
         c.execute('''SELECT COUNT(*) FROM users WHERE telegram_id = ?''', (user_id,))
@@ -426,14 +984,20 @@ def user_set_admin(user_id: str, is_admin: bool):
         is_admin_int = 1 if is_admin else 0
         c.execute('''UPDATE users SET is_admin = ? WHERE telegram_id = ?''', (is_admin_int, user_id))
         conn.commit()
+        invalidate_user_cache(user_id)
         return True
     except:
         return False
     finally:
-        conn.close()
+        release_connection(conn)
 
 def is_user_admin_of_lab(user_id: str, lab_id: int) -> bool:
-    conn = sqlite3.connect('database/labs.db')
+    # id в labs.admins и у вызывающих бывают и числом, и строкой — сравниваем строки
+    user_id = str(user_id)
+    cached = _cache_get(_lab_admins_cache, lab_id)
+    if cached is not None:
+        return user_id in cached[0]
+    conn = get_connection()
     c = conn.cursor()
     try:
         c.execute('''SELECT admins FROM labs WHERE id = ?''', (lab_id,))
@@ -441,32 +1005,35 @@ def is_user_admin_of_lab(user_id: str, lab_id: int) -> bool:
         if result is None:
             return False
         admins_json = result[0]
-        admin_ids = json.loads(admins_json)
+        admin_ids = frozenset(str(admin_id) for admin_id in json.loads(admins_json))
+        _cache_put(_lab_admins_cache, lab_id, admin_ids)
         return user_id in admin_ids
     except json.JSONDecodeError:
         return False
     except:
         return False
     finally:
-        conn.close()
+        release_connection(conn)
 
 def add_template(name: str, description: str, stages: list) -> int:
-    conn = sqlite3.connect('database/tasks.db')
+    conn = get_connection()
     c = conn.cursor()
     try:
         stages_json = json.dumps(stages)
-        c.execute('''INSERT INTO templates (name, description, stages) VALUES (?, ?, ?)''',
-                  (name, description, stages_json))
-        conn.commit()
+        # shift_table и duration заполнит первый поиск по шаблону, см. _template_schedule
+        c.execute('''INSERT INTO templates (name, description, stages, stages_hash) VALUES (?, ?, ?, ?)''',
+                  (name, description, stages_json, stages_hash(stages)))
         template_id = c.lastrowid
+        _insert_template_steps(c, template_id, stages_json)
+        conn.commit()
         return template_id
     except:
         return 'error'
     finally:
-        conn.close()
+        release_connection(conn)
 
 def user_select_lab(user_id: str, lab_id: int) -> bool:
-    conn = sqlite3.connect('database/users.db')
+    conn = get_connection()
     c = conn.cursor()
     try:
         c.execute('''SELECT COUNT(*) FROM users WHERE telegram_id = ?''', (user_id,))
@@ -482,49 +1049,233 @@ def user_select_lab(user_id: str, lab_id: int) -> bool:
     except:
         return False
     finally:
-        conn.close()
+        release_connection(conn)
 
 def get_tasks_by_user_id(user_id: str) -> list:
-    conn_connection = sqlite3.connect('database/connection.db')
-    c_connection = conn_connection.cursor()
-    task_conn_connection = sqlite3.connect('database/tasks.db')
-    task_c_connection = task_conn_connection.cursor()
+    conn = get_connection()
+    c = conn.cursor()
     try:
         tasks = []
-        c_connection.execute('''SELECT task_id FROM connection_user_to_task WHERE user_id = ?''', (user_id,))
-        task_ids = [row[0] for row in c_connection.fetchall()]
-        for task_id in task_ids:
-            task_c_connection.execute('''SELECT templates_id FROM tasks WHERE id = ?''', (task_id,))
-            template_id = task_c_connection.fetchone()[0]
-            task_c_connection.execute('''SELECT name, description, stages FROM templates WHERE id = ?''',
-                                      (template_id,))
-            name, description, stages_json = task_c_connection.fetchone()
+        c.execute('''SELECT ct.task_id, tp.id, tp.name, tp.description, tp.stages, tp.shift_table, tp.duration
+                     FROM connection_user_to_task ct
+                     JOIN tasks t ON t.id = ct.task_id
+                     JOIN templates tp ON tp.id = t.templates_id
+                     WHERE ct.user_id = ?
+                     ORDER BY ct.id''', (user_id,))
+        for task_id, template_id, name, description, stages_json, table_json, duration in c.fetchall():
             stages = json.loads(stages_json)
             task = Task(name=name, description=description, stages=stages)
+            task._compiled = task_template.load(stages_json)
             task.task_id = task_id
+            task.template_id = template_id
+            task.shift_table = json.loads(table_json) if table_json else None
+            task.duration = duration
             tasks.append(task)
         return tasks
     except:
         return []
     finally:
-        task_conn_connection.close()
-        conn_connection.close()
+        release_connection(conn)
 
 def get_equipment_reservations(equipment_id):
-    """Возвращает список броней для оборудования."""
-    conn = sqlite3.connect('database/labs.db')
+    """Возвращает список броней для оборудования в виде пар datetime (местное время)."""
+    conn = get_connection()
     c = conn.cursor()
     try:
-        c.execute('''SELECT start_time, end_time FROM reserve WHERE equipment_id = ?''', (equipment_id,))
-        return [(row[0], row[1]) for row in c.fetchall()]
+        c.execute('''SELECT start_min, end_min FROM reserve WHERE equipment_id = ? ORDER BY start_min''',
+                  (equipment_id,))
+        return [(from_epoch_minutes(row[0]), from_epoch_minutes(row[1])) for row in c.fetchall()]
     except:
         return []
     finally:
-        conn.close()
+        release_connection(conn)
+
+class ReservationSnapshot:
+    """Активное оборудование лаборатории и его брони за окно [window_start, window_end) в минутах UTC.
+
+    Загружается одним запросом; брони каждого экземпляра хранятся отсортированными массивами,
+    поэтому проверки планировщиков идут в памяти без обращений к базе.
+    """
+
+    stale = False  # снимок читается из базы целиком и не следит за изменениями
+
+    def __init__(self, lab_id, window_start: int, window_end: int):
+        self.lab_id = lab_id
+        self.window_start = window_start
+        self.window_end = window_end
+        self.equipment_instances = {}  # {название: [equip_id, ...]}
+        self._starts = {}              # {equip_id: [начало, ...]} по возрастанию
+        self._ends = {}                # {equip_id: [конец, ...]}
+        self._max_ends = {}            # {equip_id: [максимум концов среди первых i+1 броней]}
+
+    def load(self, c: sqlite3.Cursor):
+        c.execute('''SELECT e.id, e.name, r.start_min, r.end_min
+                     FROM equipments e
+                     LEFT JOIN reserve r ON r.equipment_id = e.id AND r.end_min > ? AND r.start_min < ?
+                     WHERE e.lab_id = ? AND e.is_active = 1
+                     ORDER BY e.id, r.start_min''', (self.window_start, self.window_end, self.lab_id))
+        for equip_id, equip_name, start, end in c.fetchall():
+            if equip_id not in self._starts:
+                self.equipment_instances.setdefault(equip_name, []).append(equip_id)
+                self._starts[equip_id] = []
+                self._ends[equip_id] = []
+                self._max_ends[equip_id] = []
+            if start is None:
+                continue
+            max_ends = self._max_ends[equip_id]
+            self._starts[equip_id].append(start)
+            self._ends[equip_id].append(end)
+            max_ends.append(max(end, max_ends[-1]) if max_ends else end)
+        return self
+
+    def busy(self, equip_id) -> list:
+        """Брони экземпляра парами (начало, конец) по возрастанию начала."""
+        return list(zip(self._starts.get(equip_id, ()), self._ends.get(equip_id, ())))
+
+    def is_free(self, equip_id, start: int, end: int) -> bool:
+        """Свободен ли экземпляр на [start, end): нет брони с началом < end и концом > start."""
+        starts = self._starts.get(equip_id)
+        if not starts:
+            return True
+        idx = bisect_left(starts, end)
+        return idx == 0 or self._max_ends[equip_id][idx - 1] <= start
+
+def load_reservation_snapshot(lab_id, window_start: int, window_end: int):
+    """Загружает занятость лаборатории за окно в минутах UTC."""
+    conn = get_connection()
+    try:
+        return lab_occupancy(conn.cursor(), lab_id, window_start, window_end)
+    finally:
+        release_connection(conn)
+
+def lab_occupancy(c: sqlite3.Cursor, lab_id, window_start: int, window_end: int):
+    """Занятость лаборатории за окно: из кэша занятости или, если он выключен, снимком из базы."""
+    if not OCCUPANCY_CACHE_ENABLED:
+        return ReservationSnapshot(lab_id, window_start, window_end).load(c)
+
+    def load_equipment():
+        c.execute('''SELECT id, name FROM equipments WHERE lab_id = ? AND is_active = 1 ORDER BY id''', (lab_id,))
+        return c.fetchall()
+
+    def load_reservations(start_min, end_min):
+        c.execute('''SELECT r.equipment_id, r.start_min, r.end_min
+                     FROM reserve r
+                     JOIN equipments e ON e.id = r.equipment_id
+                     WHERE e.lab_id = ? AND e.is_active = 1 AND r.end_min > ? AND r.start_min < ?''',
+                  (lab_id, start_min, end_min))
+        return c.fetchall()
+
+    return _occupancy.view(lab_id, window_start, window_end, load_equipment, load_reservations)
+
+def _equipment_busy(c: sqlite3.Cursor, equipment_id: int, start_min: int, end_min: int) -> list:
+    """Брони экземпляра, пересекающие [start_min, end_min), по R*Tree."""
+    c.execute('''SELECT start_min, end_min FROM reserve_rtree
+                 WHERE equipment_lo <= ? AND equipment_hi >= ? AND start_min < ? AND end_min > ?''',
+              (equipment_id, equipment_id, end_min, start_min))
+    return c.fetchall()
+
+def add_reservation_listener(listener):
+    """Подписывает listener(added, removed) на изменения броней в этом процессе.
+
+    added — [(reserve_id, start_min), ...] новых броней, removed — [reserve_id, ...] удалённых.
+    Вызывается после коммита; удаления вместе с оборудованием и лабораторией не сообщаются.
+    """
+    _reservation_listeners.append(listener)
+
+def _notify_reservations(added=(), removed=()):
+    for listener in _reservation_listeners:
+        try:
+            listener(list(added), list(removed))
+        except Exception as e:
+            print(f"Error in reservation listener: {e}")
+
+def _release_occupancy(c: sqlite3.Cursor, rows: list):
+    """Снимает удалённые брони [(reserve_id, equip_id, начало, конец, lab_id), ...] из кэша занятости."""
+    for _, equip_id, start_min, end_min, lab_id in rows:
+        _occupancy.release(lab_id, equip_id, start_min, end_min, _equipment_busy(c, equip_id, start_min, end_min))
+
+def _plan_schedule(task, branches, snapshot, window_start: int):
+    """Ищет расписание задачи, начинающееся в window_start, по снимку броней; None, если не помещается."""
+    return scheduler.find_best_schedule(
+        branches, snapshot.equipment_instances,
+        lambda equip_id, step_start, step_end: snapshot.is_free(equip_id, window_start + step_start,
+                                                                window_start + step_end),
+        shift_table=_template_schedule(task)[0])
+
+def store_plan(lab_id, task_id, placements: list) -> str:
+    """Кладёт план бронирования [(equip_id, начало, конец, branch_idx, step_idx), ...] в кэш и возвращает его токен."""
+    token = secrets.token_hex(4)
+    now = time.monotonic()
+    with _plan_cache_lock:
+        # Задачи идут по времени последнего плана: вытесняются первые, у которых истекли все планы
+        while _plan_cache:
+            plans = next(iter(_plan_cache.values()))
+            if plans and next(reversed(plans.values()))[0] >= now:
+                break
+            _plan_cache.popitem(last=False)
+        plans = _plan_cache.setdefault(task_id, OrderedDict())
+        _plan_cache.move_to_end(task_id)
+        plans[token] = (now + PLAN_TTL_SECONDS, lab_id, placements)
+        while len(plans) > PLANS_PER_TASK:
+            plans.popitem(last=False)
+    return token
+
+def claim_plan(lab_id, task_id, token: str):
+    """Забирает план для бронирования и помечает токен использованным.
+
+    Возвращает placements, PLAN_BOOKED, если по токену уже бронировали, или None, если плана нет или он истёк.
+    """
+    with _plan_cache_lock:
+        plans = _plan_cache.get(task_id)
+        entry = plans.get(token) if plans is not None else None
+        if entry is None or entry[1] != lab_id:
+            return None
+        if entry[0] < time.monotonic():
+            del plans[token]
+            return None
+        if entry[2] is None:
+            return PLAN_BOOKED
+        plans[token] = (entry[0], lab_id, None)
+        return entry[2]
+
+def _drop_plan(task_id, token: str):
+    with _plan_cache_lock:
+        plans = _plan_cache.get(task_id)
+        if plans is not None:
+            plans.pop(token, None)
+
+def reserve_planned(user_id, task, lab_id, token: str):
+    """Бронирует готовый план из поиска окон: перепроверяет каждый шаг и вставляет все брони одной транзакцией.
+
+    Возвращает True/False, PLAN_BOOKED при повторном нажатии той же кнопки или None, если плана нет
+    в кэше или его время уже заняли и нужен полный поиск.
+    """
+    placements = claim_plan(lab_id, task.task_id, token)
+    if placements is None or placements == PLAN_BOOKED:
+        return placements
+    conn = get_connection()
+    try:
+        added = _book(conn, user_id, task.task_id, placements)
+        if added is None:
+            # Время заняли после поиска; кэш занятости мог не видеть брони другого процесса
+            _drop_plan(task.task_id, token)
+            _occupancy.drop_lab(lab_id)
+            return None
+        for equip_id, start_min, end_min, _, _ in placements:
+            _occupancy.mark(lab_id, equip_id, start_min, end_min)
+        _notify_reservations(added=added)
+        return True
+    except Exception as e:
+        print(f"Error in reserve_planned: {e}")
+        conn.rollback()
+        _drop_plan(task.task_id, token)
+        return False
+    finally:
+        release_connection(conn)
 
 def get_equipment_id_by_name(equipment_name, lab_id):
     """Возвращает ID оборудования по имени и lab_id."""
-    conn = sqlite3.connect('database/labs.db')
+    conn = get_connection()
     c = conn.cursor()
     try:
         c.execute('''SELECT id FROM equipments WHERE name = ? AND lab_id = ?''', (equipment_name, lab_id))
@@ -533,29 +1284,106 @@ def get_equipment_id_by_name(equipment_name, lab_id):
     except:
         return None
     finally:
-        conn.close()
+        release_connection(conn)
 
 def get_branch_duration(branch):
     """Вычисляет продолжительность одной ветки в минутах."""
-    branch_duration = 0
-    for step in branch:
-        timing = step["timing"]  # ['5a', '15p', '7a']
-        active_time = int(timing[0].rstrip('a'))
-        passive_time = int(timing[1].rstrip('p'))
-        processing_time = int(timing[2].rstrip('a'))
-        branch_duration += active_time + passive_time + processing_time
-    return branch_duration
+    return task_template.compile_stages([branch]).branches[0].duration
+
+def _template_schedule(task) -> tuple:
+    """(таблица смещений, минимальная длительность) шаблона задачи.
+
+    Берутся из колонок templates. Новый шаблон сохраняется без них: они вычисляются при первом
+    поиске по шаблону, кэшируются в разобранном шаблоне и записываются в templates для остальных процессов.
+    """
+    if task.shift_table is not None and task.duration is not None:
+        return task.shift_table, task.duration
+    compiled = task.compiled
+    if task.shift_table is None:
+        task.shift_table, task.duration = compiled.shift_table, compiled.duration
+    else:
+        task.duration = scheduler.shortest_duration(compiled.scheduler_branches, task.shift_table)
+    if task.template_id is not None:
+        conn = get_connection()
+        c = conn.cursor()
+        try:
+            c.execute('''UPDATE templates SET shift_table = ?, duration = ? WHERE id = ? AND duration IS NULL''',
+                      (json.dumps(task.shift_table), task.duration, task.template_id))
+            conn.commit()
+        except Exception as e:
+            print(f"Error saving template schedule: {e}")
+        finally:
+            release_connection(conn)
+    return task.shift_table, task.duration
 
 def get_task_duration(task):
-    """Вычисляет продолжительность задачи с учётом параллельных веток."""
-    branch_durations = [get_branch_duration(branch) for branch in task.stages]
-    return max(branch_durations) if branch_durations else 0
+    """Вычисляет минимальную продолжительность задачи с учётом параллельных веток и активных фаз.
+
+    Берётся из templates.duration, а для нового шаблона вычисляется один раз, см. _template_schedule.
+    """
+    try:
+        return _template_schedule(task)[1]
+    except (KeyError, IndexError, TypeError, ValueError):
+        return 0
+
+
+def _slot_search_state(task):
+    """Разбирает задачу для поиска окон один раз на все дни: длительность, шаги по приборам и ветки."""
+    compiled = task.compiled
+    # Насколько за конец рабочего дня могут заходить шаги окна и перебор смещений веток
+    tail = max(compiled.max_step_end, 2 * compiled.max_shift)
+    return get_task_duration(task), compiled.equipment_usage, compiled.scheduler_branches, tail
+
+def _day_slots(task, lab_id, state, day_start: datetime, day_end: datetime, not_before: int = None, limit: int = None):
+    """Ищет окна одного рабочего дня и строит для них планы; тройки (начало, конец, токен плана).
+
+    not_before — минута UTC, раньше которой окна не предлагаются; limit — сколько окон достаточно.
+    """
+    total_duration, equipment_usage, branches, tail = state
+
+    # Снимок броней лаборатории — только тех, что могут задеть окна этого дня
+    day_start_min = to_epoch_minutes(day_start)
+    horizon = int((day_end - day_start).total_seconds() // 60)
+    snapshot = load_reservation_snapshot(lab_id, day_start_min, day_start_min + horizon + tail)
+    equipment_instances = snapshot.equipment_instances
+
+    print(f"Equipment instances: {equipment_instances}")  # Отладка
 
+    busy = {}
+    for equip_ids in equipment_instances.values():
+        for equip_id in equip_ids:
+            busy[equip_id] = [(start - day_start_min, end - day_start_min) for start, end in snapshot.busy(equip_id)]
+
+    available_slots = []
+    slot_starts = scheduler.numpy_slot_starts if SLOT_ENGINE == 'numpy' else scheduler.sweep_slot_starts
+    for start in slot_starts(equipment_usage, equipment_instances, busy, total_duration, horizon, day_start.minute):
+        window_start = day_start_min + start
+        if not_before is not None and window_start < not_before:
+            continue
+        result = _plan_schedule(task, branches, snapshot, window_start)
+        if result is None:
+            continue
+        duration, schedule = result
+        if start + duration > horizon:
+            continue  # С реальным оборудованием план длиннее минимального и не успевает до конца дня
+        token = store_plan(lab_id, task.task_id,
+                           [(equip_id, window_start + step_start, window_start + step_end, branch_idx, step_idx)
+                            for branch_idx, step_idx, step_start, step_end, _, _, _, _, equip_id in schedule])
+        slot_start = day_start + timedelta(minutes=start)
+        slot_end = slot_start + timedelta(minutes=duration)
+        available_slots.append((slot_start, slot_end, token))
+        if limit is not None and len(available_slots) >= limit:
+            break
+
+    return available_slots
 
 def find_available_slots(task, lab_id, selected_date=None):
-    """Ищет доступные временные окна для задачи на указанную дату."""
+    """Ищет доступные временные окна для задачи на указанную дату.
+
+    Для каждого окна сразу строится план бронирования; возвращаются тройки (начало, конец, токен плана).
+    """
     if selected_date is None:
-        selected_date = datetime.now(tz=timezone(timedelta(hours=10))).replace(second=0, microsecond=0)
+        selected_date = datetime.now(tz=LOCAL_TZ).replace(second=0, microsecond=0)
     else:
         selected_date = selected_date.replace(hour=8, minute=0, second=0, microsecond=0)
 
@@ -564,264 +1392,111 @@ def find_available_slots(task, lab_id, selected_date=None):
 
     print(f"find_available_slots: Date {selected_date}, Day start {day_start}, Day end {day_end}")  # Отладка
     
-    total_duration = reserve_task_equipment(None, task, lab_id, datetime(2023, 1, 1, 0, 0), None, dry_run=True)
+    state = _slot_search_state(task)
+    total_duration, equipment_usage = state[0], state[1]
     print(f"Total duration: {total_duration}")  # Отладка
     if not total_duration or total_duration <= 0:
         print("No valid duration found")  # Отладка
         return []
 
-    equipment_usage = {}
-    for branch_idx, branch in enumerate(task.stages):
-        branch_offset = 0
-        if branch_idx > 0:
-            first_step = task.stages[0][0]
-            branch_offset = int(first_step["timing"][0].rstrip('a'))
-        for step in branch:
-            equipment_name = step["equipment"]
-            step_duration = sum(int(t.rstrip('ap')) for t in step["timing"])
-            if equipment_name not in equipment_usage:
-                equipment_usage[equipment_name] = []
-            equipment_usage[equipment_name].append((branch_offset, step_duration))
-            branch_offset += step_duration
-
     print(f"Equipment usage: {equipment_usage}")  # Отладка
 
-    conn = sqlite3.connect('database/labs.db')
-    c = conn.cursor()
-    equipment_instances = {}
-    c.execute('''SELECT id, name FROM equipments WHERE lab_id = ? AND is_active = 1''', (lab_id,))
-    for equip_id, equip_name in c.fetchall():
-        if equip_name not in equipment_instances:
-            equipment_instances[equip_name] = []
-        equipment_instances[equip_name].append(equip_id)
-    conn.close()
+    return _day_slots(task, lab_id, state, day_start, day_end)
 
-    print(f"Equipment instances: {equipment_instances}")  # Отладка
+def find_next_slots(task, lab_id, horizon_days: int = 14, limit: int = 5):
+    """Ищет ближайшие свободные окна для задачи, начиная с текущего момента, на horizon_days дней вперёд.
 
-    available_slots = []
-    current_time = day_start
-    
-    while current_time + timedelta(minutes=total_duration) <= day_end:
-        slot_end = current_time + timedelta(minutes=total_duration)
-        is_slot_available = True
-        
-        for equipment_name, usages in equipment_usage.items():
-            if equipment_name not in equipment_instances:
-                is_slot_available = False
-                print(f"Equipment {equipment_name} not found in lab")  # Отладка
-                break
-            available_equip_ids = equipment_instances[equipment_name].copy()
-            used_equip_ids = set()
-
-            for start_offset, duration in usages:
-                step_start = current_time + timedelta(minutes=start_offset)
-                step_end = step_start + timedelta(minutes=duration)
-                assigned = False
-
-                for equip_id in available_equip_ids:
-                    if equip_id not in used_equip_ids:
-                        reservations = get_equipment_reservations(equip_id)
-                        is_free = True
-                        for res_start, res_end in reservations:
-                            res_start_dt = datetime.strptime(res_start, "%Y-%m-%d %H:%M")
-                            res_end_dt = datetime.strptime(res_end, "%Y-%m-%d %H:%M")
-                            if step_start < res_end_dt and step_end > res_start_dt:
-                                is_free = False
-                                break
-                        if is_free:
-                            used_equip_ids.add(equip_id)
-                            assigned = True
-                            break
-                if not assigned:
-                    is_slot_available = False
-                    print(f"No available equipment for {equipment_name} at {step_start} - {step_end}")  # Отладка
-                    break
-            if not is_slot_available:
-                break
+    Задача разбирается один раз, дни просматриваются по порядку до первых limit окон.
+    Возвращает тройки (начало, конец, токен плана), как find_available_slots.
+    """
+    state = _slot_search_state(task)
+    if not state[0] or state[0] <= 0:
+        return []
 
-        if is_slot_available:
-            available_slots.append((current_time, slot_end))
-            print(f"Slot found: {current_time} - {slot_end}")  # Отладка
-            if len(available_slots) == 1:
-                minutes = current_time.minute
-                if minutes < 30:
-                    delta_to_30 = 30 - minutes
-                    current_time += timedelta(minutes=delta_to_30)
-                else:
-                    delta_to_next_hour = 60 - minutes
-                    current_time += timedelta(minutes=delta_to_next_hour)
-            elif len(available_slots) > 1:
-                current_time += timedelta(minutes=15)
-        else:
-            current_time += timedelta(minutes=1)
-    
+    now = datetime.now(tz=LOCAL_TZ).replace(tzinfo=None, second=0, microsecond=0)
+    not_before = to_epoch_minutes(now)
+    available_slots = []
+    for day in range(horizon_days):
+        date = now + timedelta(days=day)
+        day_start = date.replace(hour=8, minute=0)
+        day_end = date.replace(hour=17, minute=0)
+        if day_end <= now:
+            continue
+        available_slots.extend(_day_slots(task, lab_id, state, day_start, day_end,
+                                          not_before, limit - len(available_slots)))
+        if len(available_slots) >= limit:
+            break
     return available_slots
 
 
   
 
+def _user_task_id(c: sqlite3.Cursor, user_id, task):
+    """task_id для брони: task.task_id, если задача принадлежит пользователю.
+
+    Задача без task_id ищется среди задач пользователя по хэшу содержимого шаблона.
+    """
+    if task.task_id is not None:
+        c.execute('''SELECT task_id FROM connection_user_to_task WHERE user_id = ? AND task_id = ?''',
+                  (user_id, task.task_id))
+    else:
+        c.execute('''SELECT ct.task_id
+                     FROM connection_user_to_task ct
+                     JOIN tasks t ON t.id = ct.task_id
+                     JOIN templates tp ON tp.id = t.templates_id
+                     WHERE ct.user_id = ? AND tp.stages_hash = ?
+                     ORDER BY ct.id LIMIT 1''', (user_id, stages_hash(task.stages)))
+    row = c.fetchone()
+    return row[0] if row else None
+
 def reserve_task_equipment(user_id, task, lab_id, start_time, end_time, dry_run=False):
     """Бронирует оборудование, находя минимальное время выполнения с учетом параллельных веток и фаз."""
-    conn = sqlite3.connect('database/labs.db')
+    conn = get_connection()
     c = conn.cursor()
     try:
         # Получаем task_id
         if not dry_run:
-            conn_connection = sqlite3.connect('database/connection.db')
-            c_connection = conn_connection.cursor()
-            conn_tasks = sqlite3.connect('database/tasks.db')
-            c_tasks = conn_tasks.cursor()
-            c_connection.execute('''SELECT task_id FROM connection_user_to_task WHERE user_id = ?''', (user_id,))
-            task_ids = [row[0] for row in c_connection.fetchall()]
-            task_id = None
-            stages_json = json.dumps(task.stages)
-            for tid in task_ids:
-                c_tasks.execute('''SELECT templates_id FROM tasks WHERE id = ?''', (tid,))
-                templates_id = c_tasks.fetchone()[0]
-                c_tasks.execute('''SELECT stages FROM templates WHERE id = ?''', (templates_id,))
-                stored_stages = c_tasks.fetchone()[0]
-                if stored_stages == stages_json:
-                    task_id = tid
-                    break
+            task_id = _user_task_id(c, user_id, task)
             if task_id is None:
                 raise ValueError("Could not find matching task_id.")
-            conn_connection.close()
-            conn_tasks.close()
         else:
             task_id = None
 
-        # Доступное оборудование
-        c.execute('''SELECT id, name FROM equipments WHERE lab_id = ? AND is_active = 1''', (lab_id,))
-        equipment_instances = {}
-        for equip_id, equip_name in c.fetchall():
-            if equip_name not in equipment_instances:
-                equipment_instances[equip_name] = []
-            equipment_instances[equip_name].append(equip_id)
-
-        # Проверка доступности оборудования
-        def is_equipment_available(equip_id, step_start, step_end):
-            reservations = get_equipment_reservations(equip_id)
-            for res_start, res_end in reservations:
-                res_start_dt = datetime.strptime(res_start, "%Y-%m-%d %H:%M")
-                res_end_dt = datetime.strptime(res_end, "%Y-%m-%d %H:%M")
-                if step_start < res_end_dt and step_end > res_start_dt:
-                    return False
-            return True
-
-        # Структура шага: [(branch_idx, step_idx, start_time, end_time, active_start1, active_end1, active_start2, active_end2, equip_id)]
-        best_schedule = None
-        min_duration = float('inf')
-
-        # Функция для вычисления длительности ветки
-        def get_branch_duration(branch):
-            return sum(int(t.rstrip('ap')) for step in branch for t in step["timing"])
-
-        # Перебор смещений второй ветки относительно первой
-        branch1_duration = get_branch_duration(task.stages[0])
-        branch2_duration = get_branch_duration(task.stages[1]) if len(task.stages) > 1 else 0
-        max_shift = branch1_duration + branch2_duration  # Максимальный диапазон для поиска
-
-        for shift in range(0, max_shift + 1, 1):  # Шаг 1 минута
-            schedule = []
-            equipment_used = {}  # {equip_id: [(start, end), ...]}
-            active_times = []    # [(start, end), ...] для проверки пересечений
-
-            # Размещаем первую ветку с начала
-            offset = 0
-            for step_idx, step in enumerate(task.stages[0]):
-                active_time = int(step["timing"][0].rstrip('a'))
-                passive_time = int(step["timing"][1].rstrip('p'))
-                processing_time = int(step["timing"][2].rstrip('a'))
-                step_start = start_time + timedelta(minutes=offset)
-                active_end1 = step_start + timedelta(minutes=active_time)
-                passive_end = active_end1 + timedelta(minutes=passive_time)
-                step_end = passive_end + timedelta(minutes=processing_time)
-
-                equip_id = None
-                for eid in equipment_instances.get(step["equipment"], []):
-                    if is_equipment_available(eid, step_start, step_end):
-                        equip_id = eid
-                        break
-                if equip_id is None:
-                    break  # Пропускаем этот вариант, если оборудование занято
-
-                schedule.append((0, step_idx, step_start, step_end, step_start, active_end1, passive_end, step_end, equip_id))
-                active_times.append((step_start, active_end1))
-                active_times.append((passive_end, step_end))
-                equipment_used[equip_id] = equipment_used.get(equip_id, []) + [(step_start, step_end)]
-                offset += active_time + passive_time + processing_time
-
-            if len(schedule) != len(task.stages[0]):
-                continue  # Первая ветка не размещена полностью
-
-            # Размещаем вторую ветку со смещением
-            offset = shift
-            branch2_placed = True
-            for step_idx, step in enumerate(task.stages[1]):
-                active_time = int(step["timing"][0].rstrip('a'))
-                passive_time = int(step["timing"][1].rstrip('p'))
-                processing_time = int(step["timing"][2].rstrip('a'))
-                step_start = start_time + timedelta(minutes=offset)
-                active_end1 = step_start + timedelta(minutes=active_time)
-                passive_end = active_end1 + timedelta(minutes=passive_time)
-                step_end = passive_end + timedelta(minutes=processing_time)
-
-                equip_id = None
-                for eid in equipment_instances.get(step["equipment"], []):
-                    if eid in equipment_used:
-                        for res_start, res_end in equipment_used[eid]:
-                            if step_start < res_end and step_end > res_start:
-                                break
-                        else:
-                            if is_equipment_available(eid, step_start, step_end):
-                                equip_id = eid
-                                break
-                    elif is_equipment_available(eid, step_start, step_end):
-                        equip_id = eid
-                        break
-                if equip_id is None:
-                    branch2_placed = False
-                    break
-
-                schedule.append((1, step_idx, step_start, step_end, step_start, active_end1, passive_end, step_end, equip_id))
-                active_times.append((step_start, active_end1))
-                active_times.append((passive_end, step_end))
-                equipment_used[equip_id] = equipment_used.get(equip_id, []) + [(step_start, step_end)]
-                offset += active_time + passive_time + processing_time
-
-            if not branch2_placed or len(schedule) != len(task.stages[0]) + len(task.stages[1]):
-                continue
-
-            # Проверка пересечения активных фаз
-            active_times.sort()
-            overlap = False
-            for i in range(1, len(active_times)):
-                if active_times[i][0] < active_times[i-1][1]:
-                    overlap = True
-                    break
-            if overlap:
-                continue
-
-            # Вычисляем длительность
-            end_time = max(s[3] for s in schedule)
-            duration = (end_time - start_time).total_seconds() / 60
-            if duration < min_duration:
-                min_duration = duration
-                best_schedule = schedule
-
-        if best_schedule is None:
-            raise ValueError("No valid schedule found.")
-
-        # Выполняем бронирование
-        if not dry_run:
-            for _, _, step_start, step_end, _, _, _, _, equip_id in best_schedule:
-                c.execute('''INSERT INTO reserve (user_id, equipment_id, start_time, end_time, task_id)
-                             VALUES (?, ?, ?, ?, ?)''',
-                          (user_id, equip_id, step_start.strftime("%Y-%m-%d %H:%M"),
-                           step_end.strftime("%Y-%m-%d %H:%M"), task_id))
-            conn.commit()
+        branches = task.compiled.scheduler_branches
+        max_shift = task.compiled.max_shift  # Максимальный диапазон для поиска
+
+        window_start = to_epoch_minutes(start_time)
+        for attempt in range(BOOKING_ATTEMPTS):
+            # Доступное оборудование и его брони на всё окно перебора — одним запросом
+            snapshot = lab_occupancy(c, lab_id, window_start, window_start + 2 * max_shift)
+
+            result = _plan_schedule(task, branches, snapshot, window_start)
+            if result is not None and snapshot.stale:
+                # Пока шёл поиск, занятость лаборатории изменилась — повторяем по свежему снимку
+                snapshot = lab_occupancy(c, lab_id, window_start, window_start + 2 * max_shift)
+                result = _plan_schedule(task, branches, snapshot, window_start)
+            if result is None:
+                raise ValueError("No valid schedule found.")
+            # Структура шага: (branch_idx, step_idx, start, end, active_start1, active_end1, active_start2, active_end2, equip_id)
+            min_duration, best_schedule = result
+            if dry_run:
+                return min_duration
+
+            # Выполняем бронирование; если время заняли во время поиска — ищем заново
+            placements = [(equip_id, window_start + step_start, window_start + step_end, branch_idx, step_idx)
+                          for branch_idx, step_idx, step_start, step_end, _, _, _, _, equip_id in best_schedule]
+            added = _book(conn, user_id, task_id, placements)
+            if added is not None:
+                break
+            # Кэш занятости мог не видеть брони другого процесса
+            _occupancy.drop_lab(lab_id)
+        else:
+            raise ValueError("Equipment was reserved concurrently.")
 
-        return min_duration if dry_run else True
+        for equip_id, start_min, end_min, _, _ in placements:
+            _occupancy.mark(lab_id, equip_id, start_min, end_min)
+        _notify_reservations(added=added)
+        return True
 
     except Exception as e:
         print(f"Error in reserve_task_equipment: {e}")
@@ -829,92 +1504,214 @@ def reserve_task_equipment(user_id, task, lab_id, start_time, end_time, dry_run=
             conn.rollback()
         return False
     finally:
-        conn.close()
+        release_connection(conn)
+
 
+# Брони, привязанные к шагу шаблона задачи, которая есть в списке пользователя
+_RESERVED_STEPS_FROM = '''FROM reserve r
+                          JOIN connection_user_to_task ct ON ct.user_id = r.user_id AND ct.task_id = r.task_id
+                          JOIN equipments e ON e.id = r.equipment_id
+                          JOIN tasks t ON t.id = r.task_id
+                          JOIN templates tp ON tp.id = t.templates_id
+                          JOIN template_steps ts ON ts.template_id = t.templates_id
+                                                AND ts.branch_idx = r.branch_idx AND ts.step_idx = r.step_idx'''
 
 def get_user_reservations(user_id):
-    conn = sqlite3.connect('database/labs.db')
+    """Забронированные шаги пользователя по времени начала."""
+    conn = get_connection()
     c = conn.cursor()
     try:
-        c.execute('''SELECT r.id, r.start_time, r.end_time, r.equipment_id, r.task_id 
-                     FROM reserve r 
-                     WHERE r.user_id = ? 
-                     ORDER BY r.start_time''', (user_id,))
-        reservations = c.fetchall()
-
-        tasks = get_tasks_by_user_id(user_id)
-        # Создаем словарь задач для быстрого поиска по task_id
-        task_dict = {str(task.task_id): task for task in tasks}
-        reserved_steps = []
-
-        for res_id, start_time, end_time, equipment_id, task_id in reservations:
-            try:
-                start_dt = datetime.strptime(start_time, "%Y-%m-%d %H:%M")
-                end_dt = datetime.strptime(end_time, "%Y-%m-%d %H:%M")
-            except ValueError as e:
-                print(f"Invalid datetime format: {e}")
-                continue
+        c.execute(f'''SELECT r.start_min, r.end_min, r.task_id, tp.name, ts.name, ts.equipment
+                      {_RESERVED_STEPS_FROM}
+                      WHERE r.user_id = ?
+                      ORDER BY r.start_min''', (user_id,))
+        return [{
+            "task_name": task_name,
+            "step_name": step_name,
+            "equipment": equipment,
+            "start_time": from_epoch_minutes(start_min),
+            "end_time": from_epoch_minutes(end_min),
+            "task_id": task_id
+        } for start_min, end_min, task_id, task_name, step_name, equipment in c.fetchall()]
+    except Exception as e:
+        print(f"Error in get_user_reservations: {e}")
+        return []
+    finally:
+        release_connection(conn)
+
+def _shard_filter(shard) -> tuple:
+    """Условие на notifications.user_id для shard = (номер, всего) или None — все напоминания."""
+    if shard is None:
+        return '', []
+    index, count = shard
+    return ' AND user_id % ? = ?', [count, index]
+
+def claim_notifications(limit: int, lease_seconds: int, shard=None) -> list:
+    """Забирает до limit наступивших напоминаний и помечает их взятыми на lease_seconds.
+
+    Берутся ожидающие с наступившим сроком, повторные с наступившим временем попытки и взятые,
+    чья аренда истекла (отправитель упал). shard = (номер, всего) — только напоминания
+    пользователей с user_id % всего == номер. Возвращает [(notification_id, reserve_id, attempts), ...].
+    """
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        now = int(time.time())
+        shard_sql, shard_args = _shard_filter(shard)
+        c.execute('BEGIN IMMEDIATE')
+        c.execute(f'''UPDATE notifications
+                      SET status = 'claimed', claimed_until = ?, attempts = attempts + 1
+                      WHERE id IN (SELECT id FROM notifications WHERE status = 'pending' AND due_min <= ?{shard_sql}
+                                   UNION ALL
+                                   SELECT id FROM notifications WHERE status = 'retry' AND next_attempt_at <= ?{shard_sql}
+                                   UNION ALL
+                                   SELECT id FROM notifications WHERE status = 'claimed' AND claimed_until <= ?{shard_sql}
+                                   LIMIT ?)
+                      RETURNING id, reserve_id, attempts''',
+                  [now + lease_seconds, now // 60, *shard_args, now, *shard_args, now, *shard_args, limit])
+        rows = c.fetchall()
+        conn.commit()
+        return rows
+    except Exception as e:
+        print(f"Error in claim_notifications: {e}")
+        conn.rollback()
+        return []
+    finally:
+        release_connection(conn)
 
-            equipment = get_equipment_by_id(equipment_id)
-            if not equipment:
-                continue
+def renew_notifications(notification_ids: list, lease_seconds: int) -> int:
+    """Продлевает аренду ещё не закрытых напоминаний на lease_seconds от текущего момента; число продлённых."""
+    if not notification_ids:
+        return 0
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        placeholders = ', '.join('?' * len(notification_ids))
+        c.execute(f'''UPDATE notifications SET claimed_until = ?
+                      WHERE status = 'claimed' AND id IN ({placeholders})''',
+                  [int(time.time()) + lease_seconds] + list(notification_ids))
+        conn.commit()
+        return c.rowcount
+    except Exception as e:
+        print(f"Error in renew_notifications: {e}")
+        return 0
+    finally:
+        release_connection(conn)
 
-            # Приводим task_id из резервации к строке для совместимости
-            task = task_dict.get(str(task_id))
-            if not task:
-                continue
+def finish_notification(notification_id: int, status: str, error: str = None, retry_at: int = 0) -> bool:
+    """Закрывает взятое напоминание: 'sent', 'retry' (с retry_at в секундах эпохи), 'failed', 'expired' или 'skipped'."""
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        c.execute('''UPDATE notifications
+                     SET status = ?, last_error = ?, next_attempt_at = ?, claimed_until = NULL
+                     WHERE status = 'claimed' AND id = ?''',
+                  (status, error, retry_at, notification_id))
+        conn.commit()
+        return c.rowcount == 1
+    except Exception as e:
+        print(f"Error in finish_notification: {e}")
+        return False
+    finally:
+        release_connection(conn)
 
-            # Поиск соответствующего шага в задаче
-            for branch in task.stages:
-                for step in branch:
-                    if step["equipment"] != equipment["name"]:
-                        continue
-
-                    # Расчет длительности шага
-                    try:
-                        step_duration = sum(int(t.rstrip('ap').rstrip('m')) for t in step["timing"])
-                    except ValueError as e:
-                        print(f"Invalid timing format: {e}")
-                        continue
-
-                    reservation_duration = (end_dt - start_dt).total_seconds() / 60
-                    if abs(reservation_duration - step_duration) < 1:
-                        reserved_steps.append({
-                            "task_name": task.name,
-                            "step_name": step["name"],
-                            "equipment": step["equipment"],
-                            "start_time": start_dt,
-                            "end_time": end_dt,
-                            "task_id": task.task_id
-                        })
-                        break  # Прерываем после первого совпадения в ветке
-                else:
-                    continue  # Переходим к следующей ветке, если не нашли в текущей
-                break  # Прерываем поиск по веткам после нахождения совпадения
-
-        reserved_steps.sort(key=lambda x: x["start_time"])
-        return reserved_steps
+def next_notification_at(shard=None):
+    """Ближайший момент в секундах эпохи, когда появится работа для отправителей шарда shard, или None."""
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        shard_sql, shard_args = _shard_filter(shard)
+        c.execute(f'''SELECT MIN(at) FROM
+                      (SELECT MIN(due_min) * 60 AS at FROM notifications WHERE status = 'pending'{shard_sql}
+                       UNION ALL
+                       SELECT MIN(next_attempt_at) FROM notifications WHERE status = 'retry'{shard_sql}
+                       UNION ALL
+                       SELECT MIN(claimed_until) FROM notifications WHERE status = 'claimed'{shard_sql})''',
+                  shard_args * 3)
+        return c.fetchone()[0]
     except Exception as e:
-        print(f"Error in get_user_reservations: {e}")
-        return []
+        print(f"Error in next_notification_at: {e}")
+        return None
     finally:
-        conn.close()
+        release_connection(conn)
 
+def get_wizard_state(user_id: str):
+    """Сериализованное состояние мастера пользователя или None, если его нет или оно истекло."""
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        c.execute('''SELECT state FROM wizard_state WHERE user_id = ? AND expires_at > ?''',
+                  (user_id, int(time.time())))
+        result = c.fetchone()
+        return result[0] if result else None
+    except Exception as e:
+        print(f"Error in get_wizard_state: {e}")
+        return None
+    finally:
+        release_connection(conn)
 
-def get_all_users():
-    conn = sqlite3.connect('database/users.db')
+def put_wizard_state(user_id: str, state: str, expires_at: int) -> bool:
+    conn = get_connection()
     c = conn.cursor()
     try:
-        c.execute('''SELECT telegram_id FROM users''')
-        return [row[0] for row in c.fetchall()]
-    except:
+        c.execute('''INSERT INTO wizard_state (user_id, state, expires_at) VALUES (?, ?, ?)
+                     ON CONFLICT (user_id) DO UPDATE SET state = excluded.state, expires_at = excluded.expires_at''',
+                  (user_id, state, expires_at))
+        conn.commit()
+        return True
+    except Exception as e:
+        print(f"Error in put_wizard_state: {e}")
+        return False
+    finally:
+        release_connection(conn)
+
+def delete_wizard_state(user_id: str = None, expired_before: int = None) -> int:
+    """Удаляет состояние пользователя user_id и/или все состояния, истёкшие до expired_before."""
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        c.execute('''DELETE FROM wizard_state WHERE user_id = ? OR expires_at <= ?''',
+                  (user_id, expired_before if expired_before is not None else -1))
+        conn.commit()
+        return c.rowcount
+    except Exception as e:
+        print(f"Error in delete_wizard_state: {e}")
+        return 0
+    finally:
+        release_connection(conn)
+
+def get_reminders(reserve_ids: list) -> list:
+    """Забронированные шаги по id броней вместе с user_id; удалённые брони пропускаются."""
+    if not reserve_ids:
+        return []
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        placeholders = ', '.join('?' * len(reserve_ids))
+        c.execute(f'''SELECT r.id, r.user_id, r.start_min, r.end_min, r.task_id, tp.name, ts.name, ts.equipment
+                      {_RESERVED_STEPS_FROM}
+                      WHERE r.id IN ({placeholders})
+                      ORDER BY r.start_min''', list(reserve_ids))
+        return [{
+            "reserve_id": reserve_id,
+            "user_id": user_id,
+            "task_name": task_name,
+            "step_name": step_name,
+            "equipment": equipment,
+            "start_time": from_epoch_minutes(start_min),
+            "end_time": from_epoch_minutes(end_min),
+            "task_id": task_id
+        } for reserve_id, user_id, start_min, end_min, task_id, task_name, step_name, equipment in c.fetchall()]
+    except Exception as e:
+        print(f"Error in get_reminders: {e}")
         return []
     finally:
-        conn.close()
+        release_connection(conn)
+
 
 def get_equipment_summary_by_lab(lab_id):
     """Возвращает словарь с количеством оборудования по названию для указанной лаборатории."""
-    conn = sqlite3.connect('database/labs.db')
+    conn = get_connection()
     c = conn.cursor()
     try:
         c.execute('''SELECT name, COUNT(*) as count 
@@ -926,40 +1723,42 @@ def get_equipment_summary_by_lab(lab_id):
     except:
         return {}
     finally:
-        conn.close()
+        release_connection(conn)
 
 
 def delete_reservations_by_task(user_id, task_id):
     """Удаляет все брони для указанной задачи пользователя."""
-    conn = sqlite3.connect('database/labs.db')
+    conn = get_connection()
     c = conn.cursor()
     try:
-
-        conn_connection = sqlite3.connect('database/connection.db')
-        c_connection = conn_connection.cursor()
-        c_connection.execute('''SELECT COUNT(*) FROM connection_user_to_task WHERE user_id = ? AND task_id = ?''',
-                             (user_id, task_id))
-        if c_connection.fetchone()[0] == 0:
+        c.execute('''SELECT COUNT(*) FROM connection_user_to_task WHERE user_id = ? AND task_id = ?''',
+                  (user_id, task_id))
+        if c.fetchone()[0] == 0:
             return False
-        
 
+        c.execute('''SELECT r.id, r.equipment_id, r.start_min, r.end_min, e.lab_id
+                     FROM reserve r
+                     JOIN equipments e ON e.id = r.equipment_id
+                     WHERE r.user_id = ? AND r.task_id = ?''', (user_id, task_id))
+        rows = c.fetchall()
         c.execute('''DELETE FROM reserve WHERE user_id = ? AND task_id = ?''', (user_id, task_id))
         conn.commit()
+        _release_occupancy(c, rows)
+        _notify_reservations(removed=[row[0] for row in rows])
         return True
     except Exception as e:
         print(f"Error in delete_reservations_by_task: {e}")
         conn.rollback()
         return False
     finally:
-        conn.close()
-        if 'conn_connection' in locals():
-            conn_connection.close()
+        release_connection(conn)
 
 def remove_equipments(lab_id: int, equipment_list: list) -> list:
     """Удаляет указанное количество оборудования из лаборатории. Возвращает список ошибок."""
-    conn = sqlite3.connect('database/labs.db')
+    conn = get_connection()
     c = conn.cursor()
     errors = []
+    removed_ids = []
     
     try:
         for line in equipment_list:
@@ -991,44 +1790,40 @@ def remove_equipments(lab_id: int, equipment_list: list) -> list:
                 equip_id = equip_ids[i]
                 c.execute('DELETE FROM reserve WHERE equipment_id = ?', (equip_id,))
                 c.execute('DELETE FROM equipments WHERE id = ?', (equip_id,))
+                removed_ids.append(equip_id)
         
         conn.commit()
+        for equip_id in removed_ids:
+            _occupancy.drop_equipment(lab_id, equip_id)
     except Exception as e:
         print(f"Error in remove_equipments: {e}")
         conn.rollback()
         errors.append("Произошла ошибка при удалении оборудования")
     finally:
-        conn.close()
+        release_connection(conn)
     
     return errors
 
 
 def share_template(template_id: int, from_user_id: str, to_user_id: str) -> bool:
     """Передает шаблон задачи от одного пользователя другому."""
-    conn_tasks = sqlite3.connect('database/tasks.db')
-    c_tasks = conn_tasks.cursor()
-    conn_connection = sqlite3.connect('database/connection.db')
-    c_connection = conn_connection.cursor()
+    conn = get_connection()
+    c = conn.cursor()
     try:
-        # Проверяем, существует ли шаблон
-        c_tasks.execute('''SELECT COUNT(*) FROM templates WHERE id = ?''', (template_id,))
-        if c_tasks.fetchone()[0] == 0:
+        # Создаем новую задачу на основе шаблона, если он существует
+        c.execute('''INSERT INTO tasks (templates_id) SELECT id FROM templates WHERE id = ?''', (template_id,))
+        if c.rowcount == 0:
             return False
-        
-        # Создаем новую задачу на основе шаблона
-        c_tasks.execute('''INSERT INTO tasks (templates_id) VALUES (?)''', (template_id,))
-        new_task_id = c_tasks.lastrowid
-        
-        # Привязываем задачу к получателю
-        c_connection.execute('''INSERT INTO connection_user_to_task (user_id, task_id) VALUES (?, ?)''',
-                             (to_user_id, new_task_id))
-        
-        conn_tasks.commit()
-        conn_connection.commit()
+        new_task_id = c.lastrowid
+
+        # Привязываем задачу к получателю в той же транзакции
+        c.execute('''INSERT INTO connection_user_to_task (user_id, task_id) VALUES (?, ?)''',
+                  (to_user_id, new_task_id))
+
+        conn.commit()
         return True
     except Exception as e:
         print(f"Error in share_template: {e}")
         return False
     finally:
-        conn_tasks.close()
-        conn_connection.close()
\ No newline at end of file
+        release_connection(conn)
\ No newline at end of file
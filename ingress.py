@@ -0,0 +1,129 @@
+"""Многопроцессный режим: один процесс получает обновления, N воркеров их обрабатывают.
+
+Запуск вместо master.py: python ingress.py [число воркеров]
+Обновления пользователя всегда уходят одному воркеру и обрабатываются им по очереди,
+разные пользователи обрабатываются параллельно на всех ядрах. Напоминания пользователю
+рассылает тот же воркер, что обрабатывает его обновления.
+"""
+import multiprocessing
+import os
+import sys
+import time
+
+from dotenv import load_dotenv
+from telebot import apihelper, types
+
+import db
+import send_queue
+
+WORKERS = int(os.environ.get('TASK_LAB_WORKERS', os.cpu_count() or 1))
+# Сколько обновлений может ждать воркера, прежде чем приём остановится
+QUEUE_SIZE = 1000
+POLL_LIMIT = 100
+POLL_TIMEOUT = 20
+RETRY_SECONDS = 3
+# Адрес Bot API вместо api.telegram.org (локальный сервер Bot API или тестовый)
+API_URL = os.environ.get('TASK_LAB_BOT_API_URL')
+
+# Кэш занятости процесса не видит броней других воркеров, а состояние мастера должно пережить
+# смену числа воркеров; явно заданные значения не переопределяются
+WORKER_ENV = {
+    'TASK_LAB_OCCUPANCY_CACHE': '0',
+    'TASK_LAB_WIZARD_STORE': 'sqlite',
+}
+
+
+def update_user_id(update: dict):
+    """id автора обновления (from или user вложенного объекта) или None."""
+    for key, value in update.items():
+        if key != 'update_id' and isinstance(value, dict):
+            author = value.get('from') or value.get('user')
+            if author:
+                return author['id']
+    return None
+
+
+def shard_of(user_id, workers: int) -> int:
+    return user_id % workers if user_id is not None else 0
+
+
+def worker_main(updates, index: int, workers: int):
+    """Обрабатывает обновления из очереди по одному, пока не придёт None."""
+    if API_URL:
+        apihelper.API_URL = API_URL
+    import master
+    master.bot.threaded = False  # обработчики — в этом потоке, по порядку
+    # Общий лимит бота делится между воркерами; лимит чата точен, чат всегда в одном воркере
+    master.outbound = send_queue.SendQueue(global_rate=send_queue.GLOBAL_RATE / workers,
+                                           global_burst=max(send_queue.GLOBAL_BURST // workers, 1))
+    master.setup(index, workers)
+    while True:
+        update = updates.get()
+        if update is None:
+            break
+        try:
+            master.bot.process_new_updates([types.Update.de_json(update)])
+        except Exception as e:
+            print(f"Error processing update {update.get('update_id')}: {e}")
+
+
+def start_workers(workers: int) -> tuple:
+    """Запускает воркеры; возвращает (очереди, процессы)."""
+    for key, value in WORKER_ENV.items():
+        os.environ.setdefault(key, value)
+    # spawn: воркер открывает свои соединения с базой, а не наследует их при fork
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue(maxsize=QUEUE_SIZE) for _ in range(workers)]
+    processes = [context.Process(target=worker_main, args=(queue, index, workers), daemon=True)
+                 for index, queue in enumerate(queues)]
+    for process in processes:
+        process.start()
+    return queues, processes
+
+
+def stop_workers(queues, processes):
+    for queue in queues:
+        queue.put(None)
+    for process in processes:
+        process.join()
+
+
+def poll(token: str, queues: list, stop=None):
+    """Получает обновления long polling и раскладывает их по очередям воркеров, пока stop не установлен."""
+    offset = None
+    while stop is None or not stop.is_set():
+        try:
+            updates = apihelper.get_updates(token, offset=offset, limit=POLL_LIMIT, timeout=POLL_TIMEOUT,
+                                            long_polling_timeout=POLL_TIMEOUT)
+        except Exception as e:
+            print(f"Error polling updates: {e}")
+            time.sleep(RETRY_SECONDS)
+            continue
+        for update in updates:
+            offset = update['update_id'] + 1
+            queues[shard_of(update_user_id(update), len(queues))].put(update)
+
+
+def run(workers: int = WORKERS, stop=None):
+    load_dotenv()
+    token = os.environ.get('TELEGRAM_BOT_TOKEN')
+    if not token:
+        print("Error: TELEGRAM_BOT_TOKEN not found in .env file")
+        sys.exit(1)
+    if API_URL:
+        apihelper.API_URL = API_URL
+    # Миграции — один раз до запуска воркеров
+    db.init_db()
+    db.close_connections()
+    queues, processes = start_workers(workers)
+    print(f'Ingress started with {workers} workers')
+    try:
+        poll(token, queues, stop)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_workers(queues, processes)
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else WORKERS)
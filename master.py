@@ -4,7 +4,11 @@ from datetime import datetime, tzinfo, timezone, timedelta
 import sqlite3
 from telebot.types import BotCommand
 
+import callback_router
 import db
+import notifier
+import send_queue
+import wizard_state
 import os
 from dotenv import load_dotenv
 import threading
@@ -18,25 +22,36 @@ if not token:
     print("Error: TELEGRAM_BOT_TOKEN not found in .env file")
     exit(1)
 
-bot = telebot.TeleBot(token, parse_mode="HTML")
+# Исходящие сообщения идут через очередь с лимитами Telegram; отправители запускает setup()
+outbound = send_queue.SendQueue()
 
-# Глобальные словари для временного хранения
-user_tasks = {}  # {user_id: Task}
-user_steps = {}  # {user_id: [{"name": str, "equipment": str, "timing": list}, ...]}
-# Словарь блокировок для каждого пользователя
-user_locks = {}
-lock_for_locks = threading.Lock()  # Блокировка для создания новых блокировок в user_locks
+class QueuedTeleBot(telebot.TeleBot):
+    def send_message(self, chat_id, text, *args, priority=send_queue.INTERACTIVE, wait=False, **kwargs):
+        """Ставит сообщение в outbound и возвращает Future; с wait=True ждёт отправки и возвращает Message."""
+        future = outbound.submit(chat_id, super().send_message, (chat_id, text) + args, kwargs, priority)
+        return future.result() if wait else future
 
-def get_user_lock(user_id):
-    """Получает или создаёт блокировку для конкретного пользователя."""
-    with lock_for_locks:  # Синхронизация доступа к user_locks
-        if user_id not in user_locks:
-            user_locks[user_id] = threading.Lock()
-        return user_locks[user_id]
+bot = QueuedTeleBot(token, parse_mode="HTML")
+
+# Поиск ближайших окон: на сколько дней вперёд и сколько окон показать
+NEXT_SLOTS_DAYS = 14
+NEXT_SLOTS_LIMIT = 8
+
+# Незавершённые задачи пользователей, см. wizard_state.WIZARD_STORE
+wizard = wizard_state.create_store()
 
 def isFirstMessage(message):
     return not db.is_user_registered(str(message.from_user.id))
 
+# Все callback-кнопки проходят через один обработчик route_callback
+router = callback_router.CallbackRouter()
+
+def is_lab_member(query, args):
+    return int(args[0]) in db.get_available_labs(str(query.from_user.id))
+
+def is_admin(query, args):
+    return db.user_is_admin(str(query.from_user.id))
+
 @bot.message_handler(func=lambda message: isFirstMessage(message))
 def firstMessageHandler(message):
     db.add_user(message.from_user.id)
@@ -67,10 +82,9 @@ def showMainMenu(message):
     else:
         bot.send_message(message.from_user.id, "К сожалению, у вас пока нет доступных лабораторий.")
 
-@bot.callback_query_handler(func=lambda query: "lab_menu" in query.data
-                            and int(query.data.split('?')[1]) in db.get_available_labs(str(query.from_user.id)))
-def lab_menu(query):
-    lab_id = query.data.split('?')[1]
+@router.route("lab_menu", check=is_lab_member)
+def lab_menu(query, args):
+    lab_id = args[0]
     markup = telebot.util.quick_markup({
         "Ссылка - приглашение": {"callback_data": f"link_to?{lab_id}"},
         "Создать задачу": {"callback_data": "create_task"},
@@ -82,19 +96,18 @@ def lab_menu(query):
                      reply_markup=markup)
     bot.answer_callback_query(query.id)
 
-@bot.callback_query_handler(func=lambda query: "link_to" in query.data
-                            and int(query.data.split('?')[1]) in db.get_available_labs(str(query.from_user.id)))
-def get_link_to_lab(query):
-    lab_id = query.data.split('?')[1]
+@router.route("link_to", check=is_lab_member)
+def get_link_to_lab(query, args):
+    lab_id = args[0]
     bot.send_message(query.from_user.id, "Ссылка на присоединение к текущей лаборатории:\n"
                                          f"<code>t.me/tasks_lab_bot?start=lab_{lab_id}_{query.from_user.id}</code>\n"
                                          f"<i> (нажмите, чтобы скопировать) </i>")
 
-@bot.callback_query_handler(func=lambda query: query.data == "create_task")
-def create_task(query):
+@router.route("create_task")
+def create_task(query, args):
     user_id = str(query.from_user.id)
-    with get_user_lock(user_id):
-        user_tasks[user_id] = None
+    with wizard.lock(user_id):
+        wizard.put(user_id, wizard_state.WizardState())
     bot.send_message(query.from_user.id, "Пожалуйста, введите название и описание <b>ответом</b> на сообщение в следующем формате:\nНазвание...\nОписание...")
     bot.answer_callback_query(query.id)
 
@@ -127,17 +140,20 @@ def apply_task_name_and_description(message):
         msg()
         return
     
-    with get_user_lock(user_id):
-        user_tasks[user_id] = db.Task(title, description, [])
+    with wizard.lock(user_id):
+        state = wizard.get(user_id) or wizard_state.WizardState()
+        state.name, state.description = title, description
+        wizard.put(user_id, state)
     markup = telebot.util.quick_markup({"Добавить шаги": {"callback_data": "хз"}})
     bot.send_message(message.from_user.id, f"Название и описание сохранены в задачу '{title}'. Теперь введите шаги.", reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda query: query.data == "хз")
-def add_step(query):
+@router.route("хз")
+@router.route("add_another_step")
+def add_step(query, args):
     user_id = str(query.from_user.id)
-    with get_user_lock(user_id):
-        if user_id not in user_steps:
-            user_steps[user_id] = []
+    with wizard.lock(user_id):
+        if wizard.get(user_id) is None:
+            wizard.put(user_id, wizard_state.WizardState())
     bot.send_message(query.from_user.id, 
                      "Введите данные для шага в формате:\n"
                      "Название\n"
@@ -225,8 +241,14 @@ def apply_step_data(message):
 
     timing = [f"{active_time}a", f"{passive_time}p", f"{processing_time}a"]
     step = {"name": name, "equipment": equipment, "timing": timing}
-    with get_user_lock(user_id):
-        user_steps[user_id].append(step)
+    with wizard.lock(user_id):
+        state = wizard.get(user_id)
+        if state is not None:
+            state.steps.append(step)
+            wizard.put(user_id, state)
+    if state is None:
+        bot.send_message(message.from_user.id, "Ошибка: Создание задачи устарело. Начните заново из меню лаборатории.")
+        return
     
     markup = telebot.util.quick_markup({
         "Добавить ещё шаг": {"callback_data": "add_another_step"},
@@ -243,20 +265,16 @@ def add_step_helper(user_id):
                      "Время ожидания: Y\n"
                      "Время обработки: Z")
 
-@bot.callback_query_handler(func=lambda query: query.data == "add_another_step")
-def add_another_step(query):
-    add_step(query)
-
-@bot.callback_query_handler(func=lambda query: query.data == "finish_steps")
-def finish_steps(query):
+@router.route("finish_steps")
+def finish_steps(query, args):
     user_id = str(query.from_user.id)
-    with get_user_lock(user_id):
-        if not user_steps.get(user_id):
-            bot.send_message(user_id, "Вы не добавили ни одного шага.")
-            bot.answer_callback_query(query.id)
-            return
-        steps_list = "\n".join(f"{i+1}. {step['name']} (Прибор: {step['equipment']}, Время: {step['timing']})" 
-                               for i, step in enumerate(user_steps[user_id]))
+    state = wizard.get(user_id)
+    if state is None or not state.steps:
+        bot.send_message(user_id, "Вы не добавили ни одного шага.")
+        bot.answer_callback_query(query.id)
+        return
+    steps_list = "\n".join(f"{i+1}. {step['name']} (Прибор: {step['equipment']}, Время: {step['timing']})" 
+                           for i, step in enumerate(state.steps))
     bot.send_message(user_id, f"Ваши шаги:\n{steps_list}\n\n"
                               "Теперь укажите порядок выполнения в формате:\n"
                               "В одной строчке пишется те шаги, которые выполняются последовательно\n"
@@ -291,25 +309,25 @@ def apply_step_order(message):
         bot.send_message(user_id, "Ошибка: Укажите номера шагов числами через пробел в каждой строке.")
         return
 
-    with get_user_lock(user_id):
-        total_steps = len(user_steps[user_id])
+    with wizard.lock(user_id):
+        state = wizard.get(user_id)
+        if state is None or state.name is None:
+            bot.send_message(user_id, "Ошибка: Создание задачи устарело. Начните заново из меню лаборатории.")
+            return
+
+        total_steps = len(state.steps)
         
         if len(all_indices) != total_steps or max(all_indices, default=-1) >= total_steps or min(all_indices, default=0) < 0:
             bot.send_message(user_id, "Ошибка: Указаны неверные, пропущенные или повторяющиеся номера шагов.")
             return
 
-        task = user_tasks[user_id]
-        task.stages = [[user_steps[user_id][i] for i in branch] for branch in branches]
+        task = db.Task(state.name, state.description, [[state.steps[i] for i in branch] for branch in branches])
         
         template_id = db.add_template(task.name, task.description, task.stages)
         db.assign_task_to_user(templates_id=template_id, user_id=user_id)
 
         # Очистка временных данных
-        del user_steps[user_id]
-        del user_tasks[user_id]
-        # Удаляем блокировку для пользователя после завершения
-        if user_id in user_locks:
-            del user_locks[user_id]
+        wizard.delete(user_id)
 
     confirmation = f"Задача '{task.name}' успешно сохранена со стадиями:\n"
     for i, branch in enumerate(branches, 1):
@@ -319,8 +337,8 @@ def apply_step_order(message):
     bot.send_message(user_id, confirmation)
     showMainMenu(message)
 
-@bot.callback_query_handler(func=lambda query: query.data == "task_list")
-def task_list(query):
+@router.route("task_list")
+def task_list(query, args):
     user_id = str(query.from_user.id)
     tasks = db.get_tasks_by_user_id(user_id=user_id)
     
@@ -337,10 +355,10 @@ def task_list(query):
     
     bot.answer_callback_query(query.id)
 
-@bot.callback_query_handler(func=lambda query: query.data.startswith("share_task_"))
-def share_task(query):
+@router.route("share_task")
+def share_task(query, args):
     user_id = str(query.from_user.id)
-    task_id = int(query.data.split("_")[2])
+    task_id = int(args[0])
     tasks = db.get_tasks_by_user_id(user_id)
     task = next((t for t in tasks if t.task_id == task_id), None)
     
@@ -393,10 +411,10 @@ def process_invite(message):
         bot.send_message(user_id, "Неверный формат ссылки.")
 
 
-@bot.callback_query_handler(func=lambda query: query.data.startswith("task_"))
-def task_details(query):
+@router.route("task")
+def task_details(query, args):
     user_id = str(query.from_user.id)
-    task_index = int(query.data.split("_")[1])
+    task_index = int(args[0])
     
     tasks = db.get_tasks_by_user_id(user_id=user_id)
     
@@ -422,27 +440,25 @@ def task_details(query):
         buttons[f"{day_str}"] = {
             "callback_data": f"select_day_{task_index}_{day_str}"
         }
+    buttons["Ближайшее свободное время"] = {"callback_data": f"next_slots_{task_index}"}
     markup = telebot.util.quick_markup(buttons)
     bot.send_message(query.from_user.id, f"Задача: {task.name}\nВыберите день для бронирования:", reply_markup=markup)
     bot.answer_callback_query(query.id)
     
 
 
-@bot.callback_query_handler(func=lambda query: query.data.startswith("select_day_"))
-def select_day(query):
+@router.route("select_day")
+def select_day(query, args):
     user_id = str(query.from_user.id)
     print(f"Select_day called for user {user_id}, query.data: {query.data}")  # Отладка
     
-    parts = query.data.split("_")
-    print(f"Parts: {parts}")  # Отладка
-    
-    if len(parts) < 4:  # Проверяем, что есть хотя бы 4 части: select, day, task_index, YYYY-MM-DD
+    if len(args) < 2:  # Проверяем, что есть task_index и YYYY-MM-DD
         bot.send_message(user_id, "Ошибка в формате данных бронирования.")
         bot.answer_callback_query(query.id)
         return
     
-    task_index = int(parts[2])
-    day_str = "-".join(parts[3:])  # Собираем дату обратно с дефисами
+    task_index = int(args[0])
+    day_str = "-".join(args[1:])  # Собираем дату обратно с дефисами
     
     print(f"Task index: {task_index}, Day: {day_str}")  # Отладка
     
@@ -474,26 +490,54 @@ def select_day(query):
     
     buttons = {
         f"{slot[0].strftime('%H:%M')} - {slot[1].strftime('%H:%M')}": 
-        {"callback_data": f"reserve_{task_index}_{slot[0].strftime('%Y%m%d%H%M')}_{slot[1].strftime('%Y%m%d%H%M')}"}
+        {"callback_data": f"reserve_{task_index}_{slot[0].strftime('%Y%m%d%H%M')}_{slot[1].strftime('%Y%m%d%H%M')}_{slot[2]}"}
         for slot in available_slots
     }
     markup = telebot.util.quick_markup(buttons)
     bot.send_message(query.from_user.id, f"Задача: {task.name}\nВыберите время для выполнения на {day_str} (8:00–17:00):", reply_markup=markup)
     bot.answer_callback_query(query.id)
 
-@bot.callback_query_handler(func=lambda query: query.data.startswith("reserve_"))
-def reserve_task(query):
+@router.route("next_slots")
+def next_slots(query, args):
     user_id = str(query.from_user.id)
-    parts = query.data.split("_")
+    task_index = int(args[0])
+    
+    tasks = db.get_tasks_by_user_id(user_id=user_id)
+    if task_index < 0 or task_index >= len(tasks):
+        bot.send_message(query.from_user.id, "Задача не найдена.")
+        bot.answer_callback_query(query.id)
+        return
     
-    if len(parts) != 4:
+    task = tasks[task_index]
+    lab_id = db.user_get_selected_lab_id(user_id)
+    
+    available_slots = db.find_next_slots(task, lab_id, NEXT_SLOTS_DAYS, NEXT_SLOTS_LIMIT)
+    if not available_slots:
+        bot.send_message(query.from_user.id, f"Нет свободных окон для задачи в ближайшие {NEXT_SLOTS_DAYS} дней.")
+        bot.answer_callback_query(query.id)
+        return
+    
+    buttons = {
+        f"{slot[0].strftime('%d.%m %H:%M')} - {slot[1].strftime('%H:%M')}": 
+        {"callback_data": f"reserve_{task_index}_{slot[0].strftime('%Y%m%d%H%M')}_{slot[1].strftime('%Y%m%d%H%M')}_{slot[2]}"}
+        for slot in available_slots
+    }
+    markup = telebot.util.quick_markup(buttons)
+    bot.send_message(query.from_user.id, f"Задача: {task.name}\nБлижайшее свободное время:", reply_markup=markup)
+    bot.answer_callback_query(query.id)
+
+@router.route("reserve")
+def reserve_task(query, args):
+    user_id = str(query.from_user.id)
+    
+    if len(args) not in (3, 4):  # 4-й аргумент — токен плана из select_day, старые кнопки без него
         bot.send_message(query.from_user.id, "Ошибка в данных бронирования.")
         bot.answer_callback_query(query.id)
         return
     
-    task_index = int(parts[1])
-    start_time_str = parts[2]
-    end_time_str = parts[3]
+    task_index = int(args[0])
+    start_time_str = args[1]
+    end_time_str = args[2]
     
     try:
         start_time = datetime.strptime(start_time_str, "%Y%m%d%H%M")
@@ -512,7 +556,14 @@ def reserve_task(query):
     task = tasks[task_index]
     lab_id = db.user_get_selected_lab_id(user_id)
     
-    if db.reserve_task_equipment(user_id, task, lab_id, start_time, end_time):
+    reserved = db.reserve_planned(user_id, task, lab_id, args[3]) if len(args) == 4 else None
+    if reserved == db.PLAN_BOOKED:  # Повторное нажатие: бронь по этой кнопке уже сделана
+        bot.send_message(query.from_user.id, f"Задача '{task.name}' уже забронирована на это время.")
+        bot.answer_callback_query(query.id)
+        return
+    if reserved is None:  # План истёк или его время заняли — ищем расписание заново
+        reserved = db.reserve_task_equipment(user_id, task, lab_id, start_time, end_time)
+    if reserved:
         bot.send_message(query.from_user.id, f"Задача '{task.name}' успешно забронирована на {start_time.strftime('%Y-%m-%d %H:%M')} - {end_time.strftime('%H:%M')}.")
     else:
         bot.send_message(query.from_user.id, "Ошибка при бронировании. Попробуйте другое время.")
@@ -532,9 +583,8 @@ def process_invite(message):
             status = db.create_connection_user_to_lab(str(message.from_user.id), int(data[1]))
             bot.send_message(message.from_user.id, "Удачно добавлен")
 
-@bot.callback_query_handler(func=lambda query: query.data == "create_lab"
-                            and db.user_is_admin(str(query.from_user.id)))
-def create_lab(query):
+@router.route("create_lab", check=is_admin)
+def create_lab(query, args):
     bot.send_message(query.from_user.id, "Пожалуйста, введите название лаборатории <b>ответом</b> на сообщение <i>(макс.длина = 100симв.)</i>:")
     bot.answer_callback_query(query.id)
 
@@ -573,11 +623,11 @@ def admin_menu(message):
                                            f"Пожалуйста, выберите действие:",
                      reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda query: "add_equipment" in query.data)
-def add_equipment_to_lab(query):
+@router.route("add_equipment")
+def add_equipment_to_lab(query, args):
     print(db.user_get_selected_lab_id(str(query.from_user.id)))
-    print(db.is_user_admin_of_lab(query.from_user.id, int(query.data.split('?')[1])))
-    lab_id = int(query.data.split('?')[1])
+    print(db.is_user_admin_of_lab(query.from_user.id, int(args[0])))
+    lab_id = int(args[0])
     bot.send_message(query.from_user.id, "Пожалуйста, <b>ответом</b> введите список оборудования в следующем формате: [<i>название кол-во</i>], пример:\n\n"
                                          f"Название 12\nНазвание_2 8\nНазвание_3 1\n...{lab_id}")
     bot.answer_callback_query(query.id)
@@ -620,10 +670,10 @@ def add_equipment_list(message):
     bot.send_message(message.from_user.id, f"Операция выполнена. Количество ошибок при выполнении: <b>{len(errors)}</b>:\n"
                                            f"{'\n'.join(errors) if errors else 'Нет ошибок'}")
     
-@bot.callback_query_handler(func=lambda query: query.data.startswith("equipment_list"))
-def equipment_list(query):
+@router.route("equipment_list")
+def equipment_list(query, args):
     user_id = str(query.from_user.id)
-    lab_id = int(query.data.split('?')[1])
+    lab_id = int(args[0])
     
     if not db.is_user_admin_of_lab(user_id, lab_id):
         bot.send_message(query.from_user.id, "У вас нет прав для просмотра оборудования этой лаборатории.")
@@ -646,10 +696,10 @@ def equipment_list(query):
     
     bot.answer_callback_query(query.id)
 
-@bot.callback_query_handler(func=lambda query: query.data.startswith("my_tasks"))
-def my_tasks(query):
+@router.route("my_tasks")
+def my_tasks(query, args):
     user_id = str(query.from_user.id)
-    lab_id = int(query.data.split('?')[1])
+    lab_id = int(args[0])
     reserved_steps = db.get_user_reservations(user_id)
 
     if not reserved_steps:
@@ -715,10 +765,10 @@ def my_tasks(query):
 
     bot.answer_callback_query(query.id)
 
-@bot.callback_query_handler(func=lambda query: query.data.startswith("cancel_task_"))
-def cancel_task(query):
+@router.route("cancel_task")
+def cancel_task(query, args):
     user_id = str(query.from_user.id)
-    task_id = int(query.data.split("_")[2])
+    task_id = int(args[0])
     
     if db.delete_reservations_by_task(user_id, task_id):
         task = next((t for t in db.get_tasks_by_user_id(user_id) if t.task_id == task_id), None)
@@ -728,22 +778,16 @@ def cancel_task(query):
     
     bot.answer_callback_query(query.id)
 
-def check_reservations():
-    """Проверяет время до начала шагов и отправляет уведомления за 3 минуты."""
-    while True:
-        now = datetime.now(tz=tz).replace(tzinfo=None)
-        for user_id in db.get_all_users():
-            reserved_steps = db.get_user_reservations(user_id)
-            for step in reserved_steps:
-                time_to_start = (step["start_time"] - now).total_seconds() / 60
-                if 3 <= time_to_start <= 4:
-                    bot.send_message(user_id, f"Напоминание: Шаг '{step['step_name']}' ({step['equipment']}) начнётся через 3 минуты в {step['start_time'].strftime('%H:%M')}!")
-        time.sleep(59)
-
-@bot.callback_query_handler(func=lambda query: query.data.startswith("remove_equipment"))
-def remove_equipment(query):
+def send_reminder(step):
+    """Напоминание о шаге за db.REMINDER_LEAD_MINUTES минут до начала."""
+    # Ждём отправки: при ошибке ReminderScheduler повторит напоминание
+    bot.send_message(step["user_id"], f"Напоминание: Шаг '{step['step_name']}' ({step['equipment']}) начнётся через {db.REMINDER_LEAD_MINUTES} минуты в {step['start_time'].strftime('%H:%M')}!",
+                     priority=send_queue.REMINDER, wait=True)
+
+@router.route("remove_equipment")
+def remove_equipment(query, args):
     user_id = str(query.from_user.id)
-    lab_id = int(query.data.split('?')[1])
+    lab_id = int(args[0])
     
     if not db.is_user_admin_of_lab(user_id, lab_id):
         bot.send_message(query.from_user.id, "У вас нет прав для удаления оборудования из этой лаборатории.")
@@ -778,15 +822,31 @@ def remove_equipment_list(message):
     bot.send_message(message.from_user.id, f"Операция выполнена. Количество ошибок: <b>{len(errors)}</b>:\n"
                                           f"{'\n'.join(errors) if errors else 'Нет ошибок'}")
 
+@bot.callback_query_handler(func=lambda query: True)
+def route_callback(query):
+    if not router.dispatch(query):
+        # Неизвестная кнопка или нет прав — просто гасим индикатор загрузки
+        bot.answer_callback_query(query.id)
 
 tz = timezone(timedelta(hours=10))
 
-notification_thread = threading.Thread(target=check_reservations, daemon=True)
-notification_thread.start()
-
-db.init_db()
-db.user_set_admin("1007994831", True)
-db.user_set_admin("877702484", True)
-bot.set_my_commands([BotCommand('main_menu', "Показать доступные вам лаборатории")])
-print('Bot initialized')
-bot.infinity_polling()
\ No newline at end of file
+reminders = notifier.ReminderScheduler(send_reminder)
+
+def setup(shard=0, shards=1, queued=True):
+    """Готовит процесс бота. В ingress.py процесс — воркер shard из shards: он рассылает напоминания
+    тем же пользователям, чьи обновления обрабатывает (user_id % shards == shard).
+    queued — запускать ли отправителей outbound (async_master.py отправляет сообщения без них).
+    """
+    db.init_db()
+    db.user_set_admin("1007994831", True)
+    db.user_set_admin("877702484", True)
+    if queued:
+        outbound.start()
+    reminders.start((shard, shards) if shards > 1 else None)
+    if shard == 0:
+        bot.set_my_commands([BotCommand('main_menu', "Показать доступные вам лаборатории")])
+
+if __name__ == '__main__':
+    setup()
+    print('Bot initialized')
+    bot.infinity_polling()
\ No newline at end of file
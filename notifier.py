@@ -0,0 +1,125 @@
+import threading
+import time
+
+import db
+
+# Сколько потоков отправляют напоминания и сколько напоминаний поток забирает за раз
+SENDER_WORKERS = 2
+BATCH_SIZE = 20
+# На сколько секунд напоминание закрепляется за потоком; после падения его заберёт другой.
+# Пока поток жив, аренда взятых им напоминаний продлевается каждые LEASE_RENEW_SECONDS,
+# так что долгая отправка пачки не отдаёт её недоставленный хвост другому потоку
+LEASE_SECONDS = 60
+LEASE_RENEW_SECONDS = 20
+# Повторные попытки: задержка удваивается, после MAX_ATTEMPTS напоминание помечается 'failed'
+RETRY_BASE_SECONDS = 5
+MAX_ATTEMPTS = 5
+# Дольше этого поток не спит: очередь может пополнить другой процесс
+IDLE_POLL_SECONDS = 60
+
+
+class ReminderScheduler:
+    """Рассылка напоминаний из очереди notifications.
+
+    Строки очереди создают и удаляют триггеры на reserve вместе с бронями, поэтому после
+    перезапуска потоки просто продолжают забирать ожидающие строки, не перебирая брони.
+    Напоминание забирается атомарно с арендой и помечается отправленным после send, а аренда
+    продлевается, пока напоминание в работе, так что два потока или процесса его не дублируют;
+    повтор возможен, только если процесс упал между отправкой и отметкой. Потоки спят до ближайшего срока; новые брони будят их через
+    db.add_reservation_listener. В многопроцессном режиме (ingress.py) каждый воркер рассылает
+    напоминания только своего шарда пользователей — тех, чьи обновления он обрабатывает.
+    """
+
+    def __init__(self, send, workers=SENDER_WORKERS, batch_size=BATCH_SIZE):
+        self._send = send  # send(reminder) — словарь из db.get_reminders
+        self.workers = workers
+        self.batch_size = batch_size
+        self._cond = threading.Condition()
+        self._generation = 0  # растёт при каждой новой брони, чтобы не проспать её между запросом и ожиданием
+        self._stopped = False
+        self._threads = []
+        self._in_flight = set()  # id взятых напоминаний, чью аренду продлевает _renew_leases
+        self._shard = None  # (номер, всего) или None — все пользователи, см. start
+
+    def on_reservations_changed(self, added, removed):
+        if added:
+            with self._cond:
+                self._generation += 1
+                self._cond.notify_all()
+
+    def _deliver(self, batch):
+        reminders = {reminder["reserve_id"]: reminder
+                     for reminder in db.get_reminders([reserve_id for _, reserve_id, _ in batch])}
+        now_min = int(time.time()) // 60
+        for notification_id, reserve_id, attempts in batch:
+            reminder = reminders.get(reserve_id)
+            if reminder is None:
+                # Бронь больше не связана с задачей пользователя
+                db.finish_notification(notification_id, 'skipped')
+                continue
+            if db.to_epoch_minutes(reminder["start_time"]) <= now_min:
+                # Шаг уже начался (бот был остановлен) — напоминать поздно
+                db.finish_notification(notification_id, 'expired')
+                continue
+            try:
+                self._send(reminder)
+            except Exception as e:
+                print(f"Error sending reminder {notification_id}: {e}")
+                if attempts >= MAX_ATTEMPTS:
+                    db.finish_notification(notification_id, 'failed', str(e))
+                else:
+                    retry_at = int(time.time()) + RETRY_BASE_SECONDS * 2 ** (attempts - 1)
+                    db.finish_notification(notification_id, 'retry', str(e), retry_at)
+                continue
+            db.finish_notification(notification_id, 'sent')
+
+    def _wait(self, generation):
+        next_at = db.next_notification_at(self._shard)
+        timeout = IDLE_POLL_SECONDS if next_at is None else min(max(next_at - time.time(), 0), IDLE_POLL_SECONDS)
+        with self._cond:
+            if not self._stopped and timeout > 0 and generation == self._generation:
+                self._cond.wait(timeout)
+
+    def run(self):
+        while not self._stopped:
+            with self._cond:
+                generation = self._generation
+            batch = db.claim_notifications(self.batch_size, LEASE_SECONDS, self._shard)
+            if batch:
+                ids = {notification_id for notification_id, _, _ in batch}
+                with self._cond:
+                    self._in_flight |= ids
+                try:
+                    self._deliver(batch)
+                finally:
+                    with self._cond:
+                        self._in_flight -= ids
+            else:
+                self._wait(generation)
+
+    def _renew_leases(self):
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+                ids = list(self._in_flight)
+            db.renew_notifications(ids, LEASE_SECONDS)
+            with self._cond:
+                if not self._stopped:
+                    self._cond.wait(LEASE_RENEW_SECONDS)
+
+    def start(self, shard=None):
+        """Запускает потоки; shard = (номер, всего) — рассылать только пользователям с user_id % всего == номер."""
+        self._shard = shard
+        db.add_reservation_listener(self.on_reservations_changed)
+        for target in [self._renew_leases] + [self.run] * self.workers:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
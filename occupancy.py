@@ -0,0 +1,217 @@
+import threading
+from collections import OrderedDict
+
+MINUTES_PER_DAY = 24 * 60
+# Сколько лабораторий и суток каждой лаборатории держать в кэше занятости
+CACHE_LABS = 32
+CACHE_DAYS = 14
+
+
+def _mask(start, end):
+    """Маска с единицами в битах [start, end)."""
+    if end <= start:
+        return 0
+    return ((1 << (end - start)) - 1) << start
+
+
+def _runs(bits, base):
+    """Промежутки подряд идущих единиц маски парами (начало, конец), смещёнными на base."""
+    runs = []
+    pos = base
+    while bits:
+        zeros = (bits & -bits).bit_length() - 1
+        bits >>= zeros
+        pos += zeros
+        ones = (bits ^ (bits + 1)).bit_length() - 1
+        runs.append((pos, pos + ones))
+        bits >>= ones
+        pos += ones
+    return runs
+
+
+class OccupancyView:
+    """Занятость лаборатории за окно [window_start, window_end) в минутах UTC.
+
+    Интерфейс тот же, что у db.ReservationSnapshot; stale показывает, что кэш с тех пор изменился.
+    """
+
+    def __init__(self, lab, window_start, window_end, bits):
+        self.lab_id = lab.lab_id
+        self.window_start = window_start
+        self.window_end = window_end
+        self.equipment_instances = {name: list(ids) for name, ids in lab.equipment_instances.items()}
+        self.version = lab.version
+        self._lab = lab
+        self._bits = bits  # {equip_id: маска}, бит 0 — минута window_start
+
+    @property
+    def stale(self):
+        return self._lab.evicted or self._lab.version != self.version
+
+    def busy(self, equip_id) -> list:
+        """Занятые промежутки экземпляра парами (начало, конец) по возрастанию; смежные брони слиты."""
+        return _runs(self._bits.get(equip_id, 0), self.window_start)
+
+    def is_free(self, equip_id, start: int, end: int) -> bool:
+        """Свободен ли экземпляр на [start, end); за пределами окна занятость не известна и считается свободной."""
+        start = max(start, self.window_start)
+        end = min(end, self.window_end)
+        if end <= start:
+            return True
+        return not (self._bits.get(equip_id, 0) >> (start - self.window_start)) & ((1 << (end - start)) - 1)
+
+
+class LabOccupancy:
+    """Активное оборудование лаборатории и маски его занятости по суткам."""
+
+    def __init__(self, lab_id, equipment, version):
+        self.lab_id = lab_id
+        self.version = version
+        self.evicted = False
+        self.equipment_instances = {}  # {название: [equip_id, ...]} по возрастанию id
+        self.names = {}                # {equip_id: название}
+        self.days = OrderedDict()      # {номер суток UTC: {equip_id: маска}}, по давности использования
+        for equip_id, name in equipment:
+            self.names[equip_id] = name
+            self.equipment_instances.setdefault(name, []).append(equip_id)
+
+    def set_bits(self, equip_id, start, end, busy):
+        for day in range(start // MINUTES_PER_DAY, (end - 1) // MINUTES_PER_DAY + 1):
+            masks = self.days.get(day)
+            if masks is None or equip_id not in masks:
+                continue
+            day_start = day * MINUTES_PER_DAY
+            mask = _mask(max(start, day_start) - day_start, min(end, day_start + MINUTES_PER_DAY) - day_start)
+            masks[equip_id] = masks[equip_id] | mask if busy else masks[equip_id] & ~mask
+
+
+class OccupancyCache:
+    """Кэш занятости оборудования по лабораториям и суткам с вытеснением давно не используемых.
+
+    Брони читаются из базы только при первом обращении к суткам, дальше маски обновляются
+    при каждом изменении броней и оборудования. Каждое изменение увеличивает версию лаборатории.
+    """
+
+    def __init__(self, max_labs=CACHE_LABS, max_days=CACHE_DAYS):
+        self.max_labs = max_labs
+        self.max_days = max_days
+        self._labs = OrderedDict()  # {lab_id: LabOccupancy}
+        self._version = 0
+        self._lock = threading.RLock()
+
+    def _next_version(self):
+        self._version += 1
+        return self._version
+
+    def _touch_lab(self, lab_id, load_equipment):
+        lab = self._labs.get(lab_id)
+        if lab is not None:
+            self._labs.move_to_end(lab_id)
+            return lab
+        lab = LabOccupancy(lab_id, load_equipment(), self._next_version())
+        self._labs[lab_id] = lab
+        while len(self._labs) > self.max_labs:
+            _, evicted = self._labs.popitem(last=False)
+            evicted.evicted = True
+        return lab
+
+    def view(self, lab_id, window_start, window_end, load_equipment, load_reservations) -> OccupancyView:
+        """Возвращает занятость лаборатории за окно, подгружая недостающие сутки.
+
+        load_equipment() -> [(equip_id, название), ...] активного оборудования по возрастанию id;
+        load_reservations(start, end) -> [(equip_id, начало, конец), ...] броней активного оборудования.
+        """
+        with self._lock:
+            lab = self._touch_lab(lab_id, load_equipment)
+            first_day = window_start // MINUTES_PER_DAY
+            last_day = max(window_end - 1, window_start) // MINUTES_PER_DAY
+            day = first_day
+            while day <= last_day:
+                if day in lab.days:
+                    lab.days.move_to_end(day)
+                    day += 1
+                    continue
+                # Подряд идущие незагруженные сутки читаются одним запросом
+                run_end = day
+                while run_end + 1 <= last_day and run_end + 1 not in lab.days:
+                    run_end += 1
+                for missing in range(day, run_end + 1):
+                    lab.days[missing] = {equip_id: 0 for equip_id in lab.names}
+                for equip_id, start, end in load_reservations(day * MINUTES_PER_DAY,
+                                                              (run_end + 1) * MINUTES_PER_DAY):
+                    lab.set_bits(equip_id, start, end, True)
+                day = run_end + 1
+
+            base = first_day * MINUTES_PER_DAY
+            bits = {}
+            for equip_id in lab.names:
+                combined = 0
+                for day in range(first_day, last_day + 1):
+                    combined |= lab.days[day][equip_id] << (day * MINUTES_PER_DAY - base)
+                bits[equip_id] = (combined >> (window_start - base)) & _mask(0, window_end - window_start)
+            result = OccupancyView(lab, window_start, window_end, bits)
+
+            while len(lab.days) > self.max_days:
+                lab.days.popitem(last=False)
+            return result
+
+    def mark(self, lab_id, equip_id, start, end):
+        """Отмечает экземпляр занятым на [start, end)."""
+        with self._lock:
+            lab = self._labs.get(lab_id)
+            if lab is not None:
+                lab.set_bits(equip_id, start, end, True)
+                lab.version = self._next_version()
+
+    def release(self, lab_id, equip_id, start, end, remaining=()):
+        """Освобождает [start, end); remaining — другие брони экземпляра, задевающие этот промежуток."""
+        with self._lock:
+            lab = self._labs.get(lab_id)
+            if lab is not None:
+                lab.set_bits(equip_id, start, end, False)
+                for busy_start, busy_end in remaining:
+                    lab.set_bits(equip_id, busy_start, busy_end, True)
+                lab.version = self._next_version()
+
+    def add_equipment(self, lab_id, equip_id, name, load_busy=None):
+        """Добавляет активный экземпляр; load_busy(start, end) -> [(начало, конец), ...] его броней."""
+        with self._lock:
+            lab = self._labs.get(lab_id)
+            if lab is None or equip_id in lab.names:
+                return
+            lab.names[equip_id] = name
+            ids = lab.equipment_instances.setdefault(name, [])
+            ids.append(equip_id)
+            ids.sort()
+            for masks in lab.days.values():
+                masks[equip_id] = 0
+            if load_busy is not None and lab.days:
+                for start, end in load_busy(min(lab.days) * MINUTES_PER_DAY, (max(lab.days) + 1) * MINUTES_PER_DAY):
+                    lab.set_bits(equip_id, start, end, True)
+            lab.version = self._next_version()
+
+    def drop_equipment(self, lab_id, equip_id):
+        """Убирает экземпляр (удалён или выключен)."""
+        with self._lock:
+            lab = self._labs.get(lab_id)
+            if lab is None or equip_id not in lab.names:
+                return
+            name = lab.names.pop(equip_id)
+            lab.equipment_instances[name].remove(equip_id)
+            if not lab.equipment_instances[name]:
+                del lab.equipment_instances[name]
+            for masks in lab.days.values():
+                masks.pop(equip_id, None)
+            lab.version = self._next_version()
+
+    def drop_lab(self, lab_id):
+        with self._lock:
+            lab = self._labs.pop(lab_id, None)
+            if lab is not None:
+                lab.evicted = True
+
+    def clear(self):
+        with self._lock:
+            for lab in self._labs.values():
+                lab.evicted = True
+            self._labs.clear()
@@ -0,0 +1,436 @@
+import heapq
+from bisect import bisect_right
+
+try:
+    import numpy as np
+except ImportError:  # NumPy необязателен: без него окна ищет sweep_slot_starts
+    np = None
+
+
+def _merge_intervals(intervals):
+    """Сливает пересекающиеся и смежные целочисленные отрезки [lo, hi]."""
+    merged = []
+    for lo, hi in sorted(intervals):
+        if merged and lo <= merged[-1][1] + 1:
+            if hi > merged[-1][1]:
+                merged[-1][1] = hi
+        else:
+            merged.append([lo, hi])
+    return merged
+
+
+def _blocked_starts(busy, offset, duration):
+    """Возвращает отрезки стартов t, при которых шаг [t+offset, t+offset+duration) задевает бронь.
+
+    Шаг пересекает бронь [rs, re), если t+offset < re и t+offset+duration > rs,
+    то есть для целых t из [rs-offset-duration+1, re-offset-1].
+    """
+    blocked = []
+    for res_start, res_end in busy:
+        lo = res_start - offset - duration + 1
+        hi = res_end - offset - 1
+        if lo <= hi:
+            blocked.append((lo, hi))
+    return _merge_intervals(blocked)
+
+
+def _is_in(intervals, starts, t):
+    idx = bisect_right(starts, t) - 1
+    return idx >= 0 and intervals[idx][1] >= t
+
+
+def sweep_slot_starts(equipment_usage, equipment_instances, busy, total_duration, horizon, start_minute_of_hour=0):
+    """Ищет старты окон по свободным промежуткам оборудования вместо поминутного перебора.
+
+    equipment_usage: {название: [(смещение, длительность), ...]} — шаги относительно старта окна;
+    equipment_instances: {название: [equip_id, ...]} — экземпляры в порядке приоритета;
+    busy: {equip_id: [(начало, конец), ...]} — брони в минутах относительно начала дня;
+    horizon: длина рабочего дня в минутах.
+
+    Экземпляры назначаются жадно (первый свободный и ещё не занятый в этом окне), как и при
+    поминутной проверке, поэтому результат совпадает с ней. Допустимость старта меняется только
+    на границах броней, поэтому между границами проверка не повторяется. Шаг после найденного окна
+    прежний: первое окно выравнивает следующий старт на :30/:00, дальше — каждые 15 минут.
+    Возвращает список стартов в минутах от начала дня.
+    """
+    if total_duration <= 0:
+        return []
+    for equipment_name in equipment_usage:
+        if not equipment_instances.get(equipment_name):
+            print(f"Equipment {equipment_name} not found in lab")  # Отладка
+            return []
+
+    # Для каждой пары (шаг, экземпляр) — отрезки недопустимых стартов и границы, где допустимость меняется
+    blocked = {}
+    breakpoints = set()
+    for equipment_name, usages in equipment_usage.items():
+        for usage_idx, (offset, duration) in enumerate(usages):
+            for equip_id in equipment_instances[equipment_name]:
+                intervals = _blocked_starts(busy.get(equip_id, ()), offset, duration)
+                blocked[(equipment_name, usage_idx, equip_id)] = (intervals, [lo for lo, _ in intervals])
+                for lo, hi in intervals:
+                    breakpoints.add(lo)
+                    breakpoints.add(hi + 1)
+    breakpoints = sorted(breakpoints)
+
+    def is_feasible(t):
+        for equipment_name, usages in equipment_usage.items():
+            used_equip_ids = set()
+            for usage_idx in range(len(usages)):
+                for equip_id in equipment_instances[equipment_name]:
+                    if equip_id in used_equip_ids:
+                        continue
+                    intervals, starts = blocked[(equipment_name, usage_idx, equip_id)]
+                    if not _is_in(intervals, starts, t):
+                        used_equip_ids.add(equip_id)
+                        break
+                else:
+                    return False
+        return True
+
+    slot_starts = []
+    t = 0
+    while t + total_duration <= horizon:
+        if is_feasible(t):
+            slot_starts.append(t)
+            t = _next_slot_start(t, slot_starts, start_minute_of_hour)
+        else:
+            # До следующей границы результат проверки не изменится
+            idx = bisect_right(breakpoints, t)
+            if idx == len(breakpoints):
+                break
+            t = breakpoints[idx]
+    return slot_starts
+
+
+def _next_slot_start(t, slot_starts, start_minute_of_hour):
+    """Старт, с которого продолжается поиск после найденного окна t: сначала :30/:00, дальше каждые 15 минут."""
+    if len(slot_starts) == 1:
+        minutes = (start_minute_of_hour + t) % 60
+        return t + (30 - minutes if minutes < 30 else 60 - minutes)
+    return t + 15
+
+
+def numpy_slot_starts(equipment_usage, equipment_instances, busy, total_duration, horizon, start_minute_of_hour=0):
+    """То же, что sweep_slot_starts, но все старты дня проверяются сразу операциями над массивами.
+
+    Занятость дня — матрица (экземпляр × минута); для каждого шага по префиксным суммам считается,
+    свободен ли экземпляр на [t+смещение, t+смещение+длительность) при всех t одновременно.
+    Жадное назначение экземпляров повторяет sweep_slot_starts, но идёт сразу по всем стартам.
+    """
+    if np is None or any(duration <= 0 for usages in equipment_usage.values() for _, duration in usages):
+        # Шаг нулевой длины блокируется только внутри брони — это проверяет sweep_slot_starts
+        return sweep_slot_starts(equipment_usage, equipment_instances, busy, total_duration, horizon,
+                                 start_minute_of_hour)
+    if total_duration <= 0 or total_duration > horizon:
+        return []
+    if any(not equipment_instances.get(equipment_name) for equipment_name in equipment_usage):
+        return []
+
+    candidates = horizon - total_duration + 1
+    length = candidates + max((offset + duration for usages in equipment_usage.values()
+                               for offset, duration in usages), default=0)
+    feasible = np.ones(candidates, dtype=bool)
+    starts = np.arange(candidates)
+    for equipment_name, usages in equipment_usage.items():
+        equip_ids = equipment_instances[equipment_name]
+        occupied = np.zeros((len(equip_ids), length), dtype=np.int32)
+        for row, equip_id in enumerate(equip_ids):
+            for res_start, res_end in busy.get(equip_id, ()):
+                occupied[row, max(res_start, 0):max(min(res_end, length), 0)] = 1
+        prefix = np.zeros((len(equip_ids), length + 1), dtype=np.int32)
+        np.cumsum(occupied, axis=1, out=prefix[:, 1:])
+
+        used = np.zeros((len(equip_ids), candidates), dtype=bool)
+        for offset, duration in usages:
+            free = prefix[:, offset + duration:offset + duration + candidates] == prefix[:, offset:offset + candidates]
+            free &= ~used
+            found = free.any(axis=0)
+            first = free.argmax(axis=0)
+            used[first[found], starts[found]] = True
+            feasible &= found
+
+    slot_starts = []
+    feasible_starts = np.flatnonzero(feasible)
+    t = 0
+    while t < candidates:
+        idx = np.searchsorted(feasible_starts, t)
+        if idx == len(feasible_starts):
+            break
+        t = int(feasible_starts[idx])
+        slot_starts.append(t)
+        t = _next_slot_start(t, slot_starts, start_minute_of_hour)
+    return slot_starts
+
+
+# Ограничение перебора: при превышении возвращается лучшее найденное расписание
+MAX_SEARCH_NODES = 20000
+# Сколько лучших допустимых наборов смещений хранится в таблице шаблона
+SHIFT_TABLE_SIZE = 256
+
+
+def _branch_layout(branch):
+    """Раскладывает шаги ветки по минутам от её начала.
+
+    branch: [(название_прибора, активное, ожидание, обработка), ...].
+    Возвращает (длительность, шаги, активные_фазы), где шаг — (прибор, начало, конец,
+    конец_первой_активной_фазы, конец_ожидания), а активные фазы ненулевой длины — пары (начало, конец).
+    """
+    steps = []
+    actives = []
+    offset = 0
+    for equipment_name, active_time, passive_time, processing_time in branch:
+        active_end = offset + active_time
+        passive_end = active_end + passive_time
+        step_end = passive_end + processing_time
+        steps.append((equipment_name, offset, step_end, active_end, passive_end))
+        if active_time > 0:
+            actives.append((offset, active_end))
+        if processing_time > 0:
+            actives.append((passive_end, step_end))
+        offset = step_end
+    return offset, steps, actives
+
+
+def _forbidden_shifts(actives, placed_actives):
+    """Смещения ветки, при которых её активные фазы пересекаются с уже размещёнными.
+
+    Фаза (ra, rb) со смещением s пересекает (pa, pb), если s+ra < pb и s+rb > pa,
+    то есть для целых s из [pa-rb+1, pb-ra-1].
+    """
+    forbidden = []
+    for rel_start, rel_end in actives:
+        for placed_start, placed_end in placed_actives:
+            lo = placed_start - rel_end + 1
+            hi = placed_end - rel_start - 1
+            if lo <= hi:
+                forbidden.append((lo, hi))
+    return _merge_intervals(forbidden)
+
+
+def _first_allowed(forbidden, shift):
+    """Наименьшее смещение не меньше shift, не попадающее в запрещённые отрезки."""
+    for lo, hi in forbidden:
+        if hi < shift:
+            continue
+        if lo > shift:
+            break
+        shift = hi + 1
+    return shift
+
+
+def _pair_forbidden(layouts):
+    """Запрещённые смещения каждой ветки относительно другой ветки, стоящей в момент 0.
+
+    Для ветки со смещением s запрещённые отрезки достаточно сдвинуть на s.
+    """
+    return {(idx, other): _forbidden_shifts(layouts[idx][2], layouts[other][2])
+            for idx in range(len(layouts)) for other in range(len(layouts)) if idx != other}
+
+
+def build_shift_table(branches, limit=SHIFT_TABLE_SIZE, max_nodes=MAX_SEARCH_NODES):
+    """Строит таблицу допустимых смещений веток шаблона, не зависящую от броней лаборатории.
+
+    Смещение допустимо, если активные фазы веток не пересекаются. Первая ветка стоит в момент 0.
+    Возвращает {"complete": bool, "truncated": bool, "shifts": [[длительность, [смещение ветки, ...]], ...]} —
+    не более limit наборов по возрастанию (длительность, смещения). complete=False означает,
+    что за пределами таблицы могут остаться другие допустимые наборы. truncated=True — перебор
+    остановлен по max_nodes: тогда и лучшие наборы могли не попасть в таблицу, а первая запись
+    не обязательно оптимальна.
+    """
+    if not branches:
+        return {"complete": True, "truncated": False, "shifts": []}
+    layouts = [_branch_layout(branch) for branch in branches]
+    max_offset = sum(duration for duration, _, _ in layouts)
+    pair_forbidden = _pair_forbidden(layouts)
+
+    worst = []            # куча (-длительность, -смещения...) — на вершине худший из лучших
+    state = {"complete": True, "truncated": False, "nodes": 0}
+    shifts = [0] * len(layouts)
+
+    def forbidden_for(idx):
+        return _merge_intervals((lo + shifts[other], hi + shifts[other]) for other in range(idx)
+                                for lo, hi in pair_forbidden[(idx, other)])
+
+    def search(idx, current_end):
+        state["nodes"] += 1
+        if state["nodes"] > max_nodes:
+            state["complete"] = False
+            state["truncated"] = True
+            return
+        if idx == len(layouts):
+            heapq.heappush(worst, (-current_end, tuple(-shift for shift in shifts)))
+            if len(worst) > limit:
+                heapq.heappop(worst)
+                state["complete"] = False
+            return
+
+        duration = layouts[idx][0]
+        forbidden = forbidden_for(idx)
+        last_shift = 0 if idx == 0 else max_offset
+        shift = _first_allowed(forbidden, 0)
+        while shift <= last_shift:
+            if len(worst) == limit and max(current_end, shift + duration) > -worst[0][0]:
+                state["complete"] = False
+                break  # Большие смещения только удлиняют расписание
+            shifts[idx] = shift
+            search(idx + 1, max(current_end, shift + duration))
+            shift = _first_allowed(forbidden, shift + 1)
+        shifts[idx] = 0
+
+    search(0, 0)
+    table = sorted((-negative_end, [-shift for shift in negative_shifts]) for negative_end, negative_shifts in worst)
+    return {"complete": state["complete"], "truncated": state["truncated"],
+            "shifts": [[duration, offsets] for duration, offsets in table]}
+
+
+def find_best_schedule(branches, equipment_instances, is_free, max_nodes=MAX_SEARCH_NODES, shift_table=None):
+    """Ищет расписание с минимальной общей длительностью для любого числа параллельных веток.
+
+    branches: [[(название_прибора, активное, ожидание, обработка), ...], ...] — время в минутах;
+    equipment_instances: {название: [equip_id, ...]};
+    is_free(equip_id, начало, конец): свободен ли экземпляр на [начало, конец) (минуты от старта).
+
+    Первая ветка начинается в момент 0, остальные — с неотрицательным смещением. Активные фазы
+    всех веток не должны пересекаться, а один экземпляр не может быть занят двумя шагами сразу.
+    Перебор ветвей и границ: ветки размещаются от длинных к коротким, недопустимые по активным
+    фазам смещения отсекаются сразу, а узел отбрасывается, если даже самое раннее допустимое
+    начало каждой оставшейся ветки не улучшает найденную длительность. Число узлов перебора
+    ограничено max_nodes.
+    shift_table — таблица build_shift_table() этого шаблона: если задана, наборы смещений из неё
+    проверяются только на занятость оборудования, и первый подходящий сразу оптимален, если
+    перебор таблицы не был остановлен по числу узлов (truncated). Для такой таблицы первый
+    подходящий набор становится начальной границей перебора, и возвращается лучшее из двух.
+    Без подходящего набора перебор запускается, если таблица неполна.
+    Возвращает (длительность, [(ветка, шаг, начало, конец, начало_активной1, конец_активной1,
+    начало_активной2, конец_активной2, equip_id), ...]) или None.
+    """
+    if not branches:
+        return None
+    layouts = [_branch_layout(branch) for branch in branches]
+    max_offset = sum(duration for duration, _, _ in layouts)
+    order = [0] + sorted(range(1, len(layouts)), key=lambda idx: -layouts[idx][0])
+    # Общая нижняя граница: самая длинная ветка и все активные фазы, идущие строго по очереди
+    lower_bound = max(max(duration for duration, _, _ in layouts),
+                      sum(end - start for _, _, actives in layouts for start, end in actives))
+
+    best = {"duration": None, "schedule": None}
+    nodes = [0]
+    used = {}             # {equip_id: [(начало, конец), ...]} внутри текущего расписания
+    shifts = {}           # {ветка: смещение} для размещённых веток
+    schedule = []
+
+    def forbidden_for(idx):
+        return _merge_intervals((lo + shift, hi + shift) for other, shift in shifts.items()
+                                for lo, hi in pair_forbidden[(idx, other)])
+
+    def place_branch(branch_idx, shift):
+        steps = layouts[branch_idx][1]
+        placements = []
+        for step_idx, (equipment_name, start, end, active_end, passive_end) in enumerate(steps):
+            step_start = shift + start
+            step_end = shift + end
+            for equip_id in equipment_instances.get(equipment_name, ()):
+                if any(step_start < used_end and step_end > used_start
+                       for used_start, used_end in used.get(equip_id, ())):
+                    continue
+                if is_free(equip_id, step_start, step_end):
+                    break
+            else:
+                return None
+            placements.append((branch_idx, step_idx, step_start, step_end, step_start, shift + active_end,
+                               shift + passive_end, step_end, equip_id))
+        return placements
+
+    if shift_table is not None:
+        steps_count = sum(len(steps) for _, steps, _ in layouts)
+        truncated = shift_table["truncated"]
+        for duration, offsets in shift_table["shifts"]:
+            candidate = []
+            for branch_idx in order:
+                placements = place_branch(branch_idx, offsets[branch_idx])
+                if placements is None:
+                    break
+                for placement in placements:
+                    used.setdefault(placement[8], []).append((placement[2], placement[3]))
+                candidate.extend(placements)
+            used.clear()
+            if len(candidate) == steps_count:
+                candidate.sort(key=lambda placement: (placement[0], placement[1]))
+                if not truncated:
+                    return duration, candidate
+                best["duration"], best["schedule"] = duration, candidate
+                break
+        if best["schedule"] is None and shift_table["complete"]:
+            return None
+
+    pair_forbidden = _pair_forbidden(layouts)
+
+    def search(depth, current_end):
+        nodes[0] += 1
+        if nodes[0] > max_nodes or best["duration"] is not None and best["duration"] <= lower_bound:
+            return
+        if depth == len(order):
+            best["duration"] = current_end
+            best["schedule"] = sorted(schedule, key=lambda placement: (placement[0], placement[1]))
+            return
+
+        # Граница узла: каждая оставшаяся ветка закончится не раньше, чем при самом раннем
+        # допустимом по активным фазам начале
+        forbidden_by_branch = {}
+        bound = current_end
+        for idx in order[depth:]:
+            forbidden_by_branch[idx] = forbidden_for(idx)
+            bound = max(bound, _first_allowed(forbidden_by_branch[idx], 0) + layouts[idx][0])
+        if best["duration"] is not None and bound >= best["duration"]:
+            return
+
+        branch_idx = order[depth]
+        duration = layouts[branch_idx][0]
+        forbidden = forbidden_by_branch[branch_idx]
+        last_shift = 0 if branch_idx == 0 else max_offset
+        shift = _first_allowed(forbidden, 0)
+        while shift <= last_shift:
+            if best["duration"] is not None and max(current_end, shift + duration) >= best["duration"]:
+                break  # Большие смещения только удлиняют расписание
+            nodes[0] += 1
+            if nodes[0] > max_nodes:
+                return
+            placements = place_branch(branch_idx, shift)
+            if placements is not None:
+                for placement in placements:
+                    used.setdefault(placement[8], []).append((placement[2], placement[3]))
+                    schedule.append(placement)
+                shifts[branch_idx] = shift
+
+                search(depth + 1, max(current_end, shift + duration))
+
+                del shifts[branch_idx]
+                for placement in placements:
+                    used[placement[8]].pop()
+                    schedule.pop()
+            shift = _first_allowed(forbidden, shift + 1)
+
+    search(0, 0)
+    if best["schedule"] is None:
+        return None
+    return best["duration"], best["schedule"]
+
+
+def shortest_duration(branches, shift_table, max_nodes=MAX_SEARCH_NODES):
+    """Минимальная длительность веток без учёта занятости оборудования.
+
+    Для таблицы, перебор которой дошёл до конца, это её первая запись; для таблицы, остановленной
+    по max_nodes (truncated), — результат find_best_schedule, где каждому шагу отведён свой экземпляр.
+    """
+    if not shift_table["truncated"]:
+        shifts = shift_table["shifts"]
+        return shifts[0][0] if shifts else 0
+    equipment_instances = {}
+    for branch in branches:
+        for equipment_name, _, _, _ in branch:
+            equip_ids = equipment_instances.setdefault(equipment_name, [])
+            equip_ids.append((equipment_name, len(equip_ids)))
+    result = find_best_schedule(branches, equipment_instances, lambda equip_id, start, end: True, max_nodes,
+                                shift_table)
+    return result[0] if result is not None else 0
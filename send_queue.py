@@ -0,0 +1,208 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+
+from telebot.apihelper import ApiTelegramException
+
+# Приоритеты сообщений: меньше — раньше
+INTERACTIVE = 0
+REMINDER = 1
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота и около одного в секунду в чат
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+SENDER_WORKERS = 4
+# Сколько раз повторять сообщение после ответа 429
+MAX_ATTEMPTS = 5
+# Сверх этого числа чатов корзины простаивающих чатов удаляются
+CHAT_BUCKETS = 10000
+
+
+class TokenBucket:
+    """Корзина токенов (GCRA): rate токенов в секунду, не больше burst подряд."""
+
+    def __init__(self, rate: float, burst: int):
+        self.interval = 1 / rate
+        self.tolerance = (burst - 1) * self.interval
+        self.tat = 0.0  # теоретическое время следующего токена; корзина полна, когда tat <= now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд появится токен (0 — есть сейчас)."""
+        return max(max(self.tat, now) - self.tolerance - now, 0.0)
+
+    def take(self, now: float) -> float:
+        """Берёт токен и возвращает 0 или, если токена нет, не берёт и возвращает время ожидания."""
+        wait = self.delay(now)
+        if wait == 0:
+            self.tat = max(self.tat, now) + self.interval
+        return wait
+
+    def pause(self, until: float):
+        """Не выдавать токенов до until (после ответа 429)."""
+        self.tat = max(self.tat, until + self.tolerance)
+
+
+class _Message:
+    __slots__ = ('priority', 'seq', 'func', 'args', 'kwargs', 'future', 'attempts')
+
+    def __init__(self, priority, seq, func, args, kwargs, future):
+        self.priority = priority
+        self.seq = seq
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.attempts = 0
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _Chat:
+    __slots__ = ('chat_id', 'messages', 'bucket', 'busy', 'queued')
+
+    def __init__(self, chat_id, bucket):
+        self.chat_id = chat_id
+        self.messages = []   # куча _Message: приоритет, затем порядок постановки
+        self.bucket = bucket
+        self.busy = False    # сообщение чата сейчас отправляется
+        self.queued = False  # чат стоит в _ready или _delayed
+
+
+class SendQueue:
+    """Очередь исходящих сообщений с лимитами на чат и на бота и пулом отправителей.
+
+    Сообщения одного чата уходят по одному в порядке приоритета и постановки; разные чаты
+    отправляются параллельно. На ответ 429 чат и общая корзина бота приостанавливаются
+    на retry_after из ответа, и сообщение отправляется снова.
+    """
+
+    def __init__(self, workers=SENDER_WORKERS, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST,
+                 chat_rate=CHAT_RATE, chat_burst=CHAT_BURST):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chats = {}      # {chat_id: _Chat}
+        self._ready = []      # куча (приоритет, seq, chat_id) чатов, готовых к отправке
+        self._delayed = []    # куча (момент, chat_id) чатов, ждущих свою корзину
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._threads = []
+
+    def submit(self, chat_id, func, args=(), kwargs=None, priority=INTERACTIVE) -> Future:
+        """Ставит вызов func(*args, **kwargs) в очередь чата; Future получит его результат или исключение."""
+        future = Future()
+        chat_id = str(chat_id)  # 42 и "42" — один чат: одна очередь и сравнимые ключи в кучах
+        with self._cond:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                if len(self._chats) >= CHAT_BUCKETS:
+                    self._prune(time.monotonic())
+                chat = self._chats[chat_id] = _Chat(chat_id, TokenBucket(self.chat_rate, self.chat_burst))
+            heapq.heappush(chat.messages, _Message(priority, next(self._seq), func, args, kwargs or {}, future))
+            self._schedule(chat)
+        return future
+
+    def _prune(self, now):
+        for chat_id in [chat_id for chat_id, chat in self._chats.items()
+                        if not chat.messages and not chat.busy and not chat.queued and chat.bucket.tat <= now]:
+            del self._chats[chat_id]
+
+    def _schedule(self, chat, at=None):
+        if chat.busy or chat.queued or not chat.messages:
+            return
+        chat.queued = True
+        if at is None:
+            head = chat.messages[0]
+            heapq.heappush(self._ready, (head.priority, head.seq, chat.chat_id))
+        else:
+            heapq.heappush(self._delayed, (at, chat.chat_id))
+        self._cond.notify()
+
+    def _next(self):
+        """Ждёт, пока можно отправить следующее сообщение; возвращает (чат, сообщение) или None после stop."""
+        with self._cond:
+            while not self._stopped:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, chat_id = heapq.heappop(self._delayed)
+                    chat = self._chats[chat_id]
+                    head = chat.messages[0]
+                    heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+                if not self._ready:
+                    timeout = self._delayed[0][0] - now if self._delayed else None
+                    self._cond.wait(timeout)
+                    continue
+                chat = self._chats[self._ready[0][2]]
+                wait = chat.bucket.delay(now)
+                if wait > 0:
+                    heapq.heappop(self._ready)
+                    heapq.heappush(self._delayed, (now + wait, chat.chat_id))
+                    continue
+                wait = self._global.take(now)
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                heapq.heappop(self._ready)
+                chat.bucket.take(now)
+                chat.queued = False
+                chat.busy = True
+                return chat, heapq.heappop(chat.messages)
+            return None
+
+    def _done(self, chat, message, retry_after=None):
+        with self._cond:
+            chat.busy = False
+            if retry_after is None:
+                self._schedule(chat)
+                return
+            # Сообщение возвращается в голову очереди чата: приоритет и seq у него прежние
+            heapq.heappush(chat.messages, message)
+            until = time.monotonic() + retry_after
+            chat.bucket.pause(until)
+            # 429 может означать и превышение общего лимита бота: остальные чаты тоже ждут
+            self._global.pause(until)
+            self._schedule(chat, until)
+
+    def run(self):
+        while True:
+            task = self._next()
+            if task is None:
+                return
+            chat, message = task
+            message.attempts += 1
+            try:
+                result = message.func(*message.args, **message.kwargs)
+            except ApiTelegramException as e:
+                if e.error_code == 429 and message.attempts < MAX_ATTEMPTS:
+                    retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+                    print(f"Rate limited in chat {chat.chat_id}, retry in {retry_after} s")
+                    self._done(chat, message, retry_after)
+                    continue
+                print(f"Error sending to chat {chat.chat_id}: {e}")
+                message.future.set_exception(e)
+            except Exception as e:
+                print(f"Error sending to chat {chat.chat_id}: {e}")
+                message.future.set_exception(e)
+            else:
+                message.future.set_result(result)
+            self._done(chat, message)
+
+    def start(self):
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.run, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
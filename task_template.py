@@ -0,0 +1,132 @@
+import functools
+import json
+import sys
+
+import scheduler
+
+# Сколько разобранных шаблонов держать в памяти
+TEMPLATE_CACHE_SIZE = 1024
+
+
+def _minutes(timing: str) -> int:
+    """'15p' -> 15: длительность фазы без суффикса (a — активная, p — ожидание)."""
+    return int(timing.rstrip('apm'))
+
+
+class Step:
+    """Шаг ветки с фазами в минутах и границами относительно начала ветки."""
+
+    __slots__ = ('branch_idx', 'step_idx', 'name', 'equipment', 'equipment_id', 'active', 'passive', 'processing',
+                 'duration', 'start', 'end')
+
+    def __init__(self, branch_idx, step_idx, name, equipment, equipment_id, active, passive, processing, start):
+        self.branch_idx = branch_idx
+        self.step_idx = step_idx
+        self.name = name
+        self.equipment = equipment
+        self.equipment_id = equipment_id  # индекс в CompiledTemplate.equipment_names
+        self.active = active
+        self.passive = passive
+        self.processing = processing
+        self.duration = active + passive + processing
+        self.start = start
+        self.end = start + self.duration
+
+
+class Branch:
+    """Последовательные шаги; offsets — префиксные суммы длительностей, offsets[-1] — длительность ветки."""
+
+    __slots__ = ('steps', 'offsets', 'duration')
+
+    def __init__(self, steps):
+        self.steps = tuple(steps)
+        self.offsets = tuple([step.start for step in self.steps] + [self.steps[-1].end if self.steps else 0])
+        self.duration = self.offsets[-1]
+
+
+class CompiledTemplate:
+    """Разобранные stages шаблона: строки таймингов переведены в числа один раз при загрузке.
+
+    scheduler_branches — ветки в виде, который принимает scheduler; equipment_usage — шаги по
+    приборам для поиска окон, где ветки после первой стартуют после активной фазы её первого шага.
+    """
+
+    __slots__ = ('branches', 'equipment_names', 'scheduler_branches', 'equipment_usage', 'max_step_end',
+                 'max_shift', '_shift_table', '_duration', '_steps_by_usage')
+
+    def __init__(self, branches):
+        self.branches = tuple(branches)
+        names = []
+        for branch in self.branches:
+            for step in branch.steps:
+                if step.equipment not in names:
+                    names.append(step.equipment)
+        self.equipment_names = tuple(names)
+        self.scheduler_branches = [[(step.equipment, step.active, step.passive, step.processing)
+                                    for step in branch.steps] for branch in self.branches]
+
+        equipment_usage = {}
+        first_active = self.branches[0].steps[0].active if self.branches and self.branches[0].steps else 0
+        for branch_idx, branch in enumerate(self.branches):
+            branch_offset = first_active if branch_idx > 0 else 0
+            for step in branch.steps:
+                equipment_usage.setdefault(step.equipment, []).append((branch_offset + step.start, step.duration))
+        self.equipment_usage = equipment_usage
+        self.max_step_end = max((offset + duration for usages in equipment_usage.values()
+                                 for offset, duration in usages), default=0)
+        self.max_shift = sum(branch.duration for branch in self.branches)
+        self._shift_table = None
+        self._duration = None
+        self._steps_by_usage = None
+
+    @property
+    def shift_table(self) -> dict:
+        """Таблица допустимых смещений веток (scheduler.build_shift_table), строится при первом обращении."""
+        if self._shift_table is None:
+            self._shift_table = scheduler.build_shift_table(self.scheduler_branches)
+        return self._shift_table
+
+    @property
+    def duration(self) -> int:
+        """Минимальная длительность задачи с учётом параллельных веток и непересекающихся активных фаз.
+
+        Вычисляется при первом обращении (scheduler.shortest_duration), для усечённой таблицы — перебором.
+        """
+        if self._duration is None:
+            self._duration = scheduler.shortest_duration(self.scheduler_branches, self.shift_table)
+        return self._duration
+
+    def find_step(self, equipment: str, duration: int):
+        """Первый по порядку веток шаг на приборе equipment с длительностью duration или None."""
+        if self._steps_by_usage is None:
+            steps_by_usage = {}
+            for branch in self.branches:
+                for step in branch.steps:
+                    steps_by_usage.setdefault((step.equipment, step.duration), step)
+            self._steps_by_usage = steps_by_usage
+        return self._steps_by_usage.get((equipment, duration))
+
+
+def compile_stages(stages: list) -> CompiledTemplate:
+    """Разбирает stages [[{"name", "equipment", "timing": ['5a', '15p', '7a']}, ...], ...]."""
+    equipment_ids = {}
+    branches = []
+    for branch_idx, branch in enumerate(stages):
+        steps = []
+        offset = 0
+        for step_idx, step in enumerate(branch):
+            equipment = sys.intern(step["equipment"])
+            active, passive, processing = (_minutes(timing) for timing in step["timing"])
+            equipment_id = equipment_ids.setdefault(equipment, len(equipment_ids))
+            compiled = Step(branch_idx, step_idx, step["name"], equipment, equipment_id,
+                            active, passive, processing, offset)
+            steps.append(compiled)
+            offset = compiled.end
+        branches.append(Branch(steps))
+    return CompiledTemplate(branches)
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def load(stages_json: str) -> CompiledTemplate:
+    """Разбирает templates.stages; один и тот же текст разбирается один раз, пока он в кэше."""
+    return compile_stages(json.loads(stages_json))
@@ -0,0 +1,47 @@
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from callback_router import CallbackRouter
+
+
+def make_router(calls):
+    router = CallbackRouter()
+    for action in ("reserve", "reserve_task", "lab_menu", "main_menu"):
+        router.route(action)(lambda query, args, action=action: calls.append((action, args)))
+    router.route("admin", check=lambda query, args: query.from_user.id == 1)(
+        lambda query, args: calls.append(("admin", args)))
+    return router
+
+
+def query(data, user_id=1):
+    return SimpleNamespace(data=data, from_user=SimpleNamespace(id=user_id))
+
+
+def test_longest_registered_prefix_wins():
+    calls = []
+    router = make_router(calls)
+    assert router.dispatch(query("reserve_task_0_202501020800"))
+    assert router.dispatch(query("reserve_0_202501020800_202501021000_ab12"))
+    assert calls == [("reserve_task", ["0", "202501020800"]),
+                     ("reserve", ["0", "202501020800", "202501021000", "ab12"])]
+
+
+def test_question_mark_and_exact_actions():
+    calls = []
+    router = make_router(calls)
+    assert router.dispatch(query("lab_menu?5"))
+    assert router.dispatch(query("main_menu"))
+    assert calls == [("lab_menu", ["5"]), ("main_menu", [])]
+
+
+def test_unknown_action_and_failed_check_are_not_dispatched():
+    calls = []
+    router = make_router(calls)
+    assert not router.dispatch(query("unknown_1"))
+    assert not router.dispatch(query("lab?5"))
+    assert not router.dispatch(query("admin_7", user_id=2))
+    assert router.dispatch(query("admin_7"))
+    assert calls == [("admin", ["7"])]
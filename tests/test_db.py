@@ -0,0 +1,263 @@
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import notifier
+import occupancy
+import task_template
+import wizard_state
+
+
+@pytest.fixture(autouse=True)
+def fresh_db(tmp_path, monkeypatch):
+    """Пустая база в tmp_path и чистые кэши модуля на каждый тест."""
+    monkeypatch.chdir(tmp_path)
+    db.close_connections()
+    task_template.load.cache_clear()
+    db._plan_cache.clear()
+    monkeypatch.setattr(db, '_occupancy', occupancy.OccupancyCache())
+    monkeypatch.setattr(db, '_reservation_listeners', [])
+    db.invalidate_user_cache()
+    db.init_db()
+    yield
+    db.close_connections()
+
+
+def step(equipment, active, passive=0, processing=0):
+    return {"name": equipment, "equipment": equipment, "timing": [f"{active}a", f"{passive}p", f"{processing}a"]}
+
+
+def make_task(user_id, stages, equipment):
+    """Лаборатория с оборудованием и назначенная пользователю задача по шаблону."""
+    db.add_user(user_id)
+    lab_id = db.create_lab("Lab", user_id)
+    for name in equipment:
+        db.add_equipment(name, True, lab_id)
+    db.user_select_lab(user_id, lab_id)
+    db.assign_task_to_user(db.add_template("Task", "", stages), user_id)
+    return db.get_tasks_by_user_id(user_id)[0], lab_id
+
+
+def local_now():
+    return datetime.now(tz=db.LOCAL_TZ).replace(tzinfo=None)
+
+
+def next_day():
+    return local_now() + timedelta(days=1)
+
+
+def reserved_rows(task_id):
+    conn = db.get_connection()
+    try:
+        return sorted(conn.execute('''SELECT equipment_id, start_min, end_min, branch_idx, step_idx
+                                      FROM reserve WHERE task_id = ?''',
+                                   (task_id,)).fetchall())
+    finally:
+        db.release_connection(conn)
+
+
+def test_slots_stay_inside_day_window():
+    # Поиск окон проверяет приборы на смещениях первой ветки, а план сдвигает вторую ветку за бронь
+    # прибора C — такой план длиннее минимальной длительности и может не успеть до конца дня
+    task, lab_id = make_task("1", [[step("A", 10), step("D", 10)], [step("B", 10), step("C", 10)]],
+                             ["A", "B", "C", "D"])
+    assert db.get_task_duration(task) == 40
+    day = next_day().replace(hour=8, minute=0, second=0, microsecond=0)
+    equip_c = db.get_equipment_id_by_name("C", lab_id)
+    db.add_reserve("2", equip_c, day.replace(hour=16, minute=45), day.replace(hour=17, minute=5), 999)
+
+    slots = db.find_available_slots(task, lab_id, day)
+    assert slots
+    for slot_start, slot_end, _ in slots:
+        assert slot_start >= day
+        assert slot_end <= day.replace(hour=17)
+
+
+def test_next_slots_stay_inside_day_windows():
+    task, lab_id = make_task("1", [[step("A", 10), step("D", 10)], [step("B", 10), step("C", 10)]],
+                             ["A", "B", "C", "D"])
+    now = local_now()
+    day = next_day().replace(hour=8, minute=0, second=0, microsecond=0)
+    equip_c = db.get_equipment_id_by_name("C", lab_id)
+    db.add_reserve("2", equip_c, day.replace(hour=16, minute=45), day.replace(hour=17, minute=5), 999)
+
+    slots = db.find_next_slots(task, lab_id, horizon_days=2, limit=200)
+    assert any(slot_start.date() == day.date() for slot_start, _, _ in slots)
+    for slot_start, slot_end, _ in slots:
+        assert slot_start >= now.replace(second=0, microsecond=0)
+        assert slot_start >= slot_start.replace(hour=8, minute=0)
+        assert slot_end <= slot_start.replace(hour=17, minute=0)
+
+
+def test_replayed_plan_token_books_planned_rows_once():
+    task, lab_id = make_task("1", [[step("Micro", 30, 20, 10)], [step("Micro", 15), step("Cent", 25)]],
+                             ["Micro", "Micro", "Cent"])
+    slots = db.find_available_slots(task, lab_id, next_day())
+    token = slots[0][2]
+    plan = sorted(db._plan_cache[task.task_id][token][2])
+
+    assert db.reserve_planned("1", task, lab_id, token) is True
+    assert reserved_rows(task.task_id) == plan
+
+    assert db.reserve_planned("1", task, lab_id, token) == db.PLAN_BOOKED
+    assert reserved_rows(task.task_id) == plan
+
+
+def test_plan_with_taken_time_falls_back_to_full_search():
+    task, lab_id = make_task("1", [[step("Micro", 30)]], ["Micro"])
+    token = db.find_available_slots(task, lab_id, next_day())[0][2]
+    equip_id, start_min, end_min, _, _ = db._plan_cache[task.task_id][token][2][0]
+    db.add_reserve("2", equip_id, db.from_epoch_minutes(start_min), db.from_epoch_minutes(end_min), 999)
+
+    assert db.reserve_planned("1", task, lab_id, token) is None
+    assert db.claim_plan(lab_id, task.task_id, token) is None
+    assert reserved_rows(task.task_id) == []
+
+
+def test_identical_templates_book_under_their_own_task():
+    stages = [[step("Micro", 30)]]
+    first, lab_id = make_task("1", stages, ["Micro"])
+    db.assign_task_to_user(db.add_template("Copy", "", stages), "1")
+    second = db.get_tasks_by_user_id("1")[1]
+    start = next_day().replace(hour=9, minute=0, second=0, microsecond=0)
+
+    assert db.reserve_task_equipment("1", second, lab_id, start, start + timedelta(minutes=30)) is True
+    assert reserved_rows(first.task_id) == []
+    assert len(reserved_rows(second.task_id)) == 1
+
+
+def test_lab_admin_check_accepts_int_and_str_ids():
+    db.add_user("42")
+    lab_id = db.create_lab("Lab", "42")
+    for _ in range(2):  # из базы и из кэша
+        assert db.is_user_admin_of_lab("42", lab_id)
+        assert db.is_user_admin_of_lab(42, lab_id)
+        assert not db.is_user_admin_of_lab(7, lab_id)
+    assert db.get_available_labs(42) == db.get_available_labs("42")
+
+    db.add_user("7")
+    db.create_connection_user_to_lab("7", lab_id)
+    assert lab_id in db.get_available_labs("7")
+
+
+def book_due_step(user_id="1"):
+    """Бронь шага задачи, напоминание о которой уже наступило; шаг начнётся не раньше чем через 10 минут."""
+    task, lab_id = make_task(user_id, [[step("Micro", 30)]], ["Micro"])
+    start = local_now().replace(second=0, microsecond=0) + timedelta(minutes=10)
+    assert db.reserve_task_equipment(user_id, task, lab_id, start, start + timedelta(minutes=30)) is True
+    conn = db.get_connection()
+    try:
+        conn.execute('''UPDATE notifications SET due_min = 0''')
+        conn.commit()
+        return conn.execute('''SELECT id, reserve_id FROM notifications ORDER BY id DESC''').fetchone()
+    finally:
+        db.release_connection(conn)
+
+
+def notification_state(notification_id):
+    conn = db.get_connection()
+    try:
+        return conn.execute('''SELECT status, attempts, next_attempt_at FROM notifications WHERE id = ?''',
+                            (notification_id,)).fetchone()
+    finally:
+        db.release_connection(conn)
+
+
+def test_expired_notification_lease_is_claimed_again(monkeypatch):
+    notification_id, reserve_id = book_due_step()
+    assert db.claim_notifications(10, 60) == [(notification_id, reserve_id, 1)]
+    assert db.claim_notifications(10, 60) == []
+
+    now = time.time()
+    monkeypatch.setattr(db.time, 'time', lambda: now + 61)
+    assert db.claim_notifications(10, 60) == [(notification_id, reserve_id, 2)]
+
+
+def test_notifications_are_claimed_by_the_users_shard():
+    first, _ = book_due_step("1")
+    second, _ = book_due_step("2")
+    assert db.next_notification_at((1, 2)) == 0
+    assert [row[0] for row in db.claim_notifications(10, 60, (0, 2))] == [second]
+    assert db.claim_notifications(10, 60, (0, 2)) == []
+    assert [row[0] for row in db.claim_notifications(10, 60, (1, 2))] == [first]
+
+
+def test_failed_reminder_is_retried_with_backoff_then_failed(monkeypatch):
+    notification_id, reserve_id = book_due_step()
+
+    def send(reminder):
+        raise RuntimeError("Telegram is down")
+
+    scheduler = notifier.ReminderScheduler(send)
+    now = time.time()
+    monkeypatch.setattr(db.time, 'time', lambda: now)
+    for attempt in range(1, notifier.MAX_ATTEMPTS + 1):
+        assert db.claim_notifications(10, notifier.LEASE_SECONDS) == [(notification_id, reserve_id, attempt)]
+        scheduler._deliver([(notification_id, reserve_id, attempt)])
+        status, attempts, next_attempt_at = notification_state(notification_id)
+        assert attempts == attempt
+        if attempt < notifier.MAX_ATTEMPTS:
+            assert status == 'retry'
+            assert next_attempt_at == int(now) + notifier.RETRY_BASE_SECONDS * 2 ** (attempt - 1)
+            assert db.claim_notifications(10, notifier.LEASE_SECONDS) == []
+            now = next_attempt_at
+    assert status == 'failed'
+
+
+def test_reminder_lease_is_renewed_while_sending(monkeypatch):
+    monkeypatch.setattr(notifier, 'LEASE_SECONDS', 2)
+    monkeypatch.setattr(notifier, 'LEASE_RENEW_SECONDS', 0.5)
+    notification_id, reserve_id = book_due_step()
+    started, release = threading.Event(), threading.Event()
+    sent = []
+
+    def slow_send(reminder):
+        started.set()
+        release.wait(10)
+        sent.append(reminder["reserve_id"])
+
+    scheduler = notifier.ReminderScheduler(slow_send, workers=1)
+    scheduler.start()
+    try:
+        assert started.wait(10)
+        # Отправка длится вдвое дольше аренды, но напоминание не достаётся другому отправителю
+        deadline = time.time() + 2 * notifier.LEASE_SECONDS
+        while time.time() < deadline:
+            assert db.claim_notifications(10, notifier.LEASE_SECONDS) == []
+            time.sleep(0.2)
+        release.set()
+        deadline = time.time() + 10
+        while notification_state(notification_id)[0] != 'sent' and time.time() < deadline:
+            time.sleep(0.05)
+    finally:
+        release.set()
+        scheduler.stop()
+    assert sent == [reserve_id]
+    assert notification_state(notification_id)[:2] == ('sent', 1)
+
+
+@pytest.mark.parametrize('kind', ['memory', 'sqlite'])
+def test_wizard_store_round_trip(kind):
+    store = wizard_state.create_store(kind)
+    state = wizard_state.WizardState("Task", None, [step("Micro", 5, 15, 7)])
+    store.put(7, state)
+
+    loaded = store.get("7")
+    assert (loaded.name, loaded.description, loaded.steps) == ("Task", None, state.steps)
+    store.delete("7")
+    assert store.get(7) is None
+
+
+def test_memory_wizard_store_is_bounded():
+    store = wizard_state.MemoryWizardStore(max_users=2)
+    for user_id in range(3):
+        store.put(user_id, wizard_state.WizardState(f"Task {user_id}"))
+    assert store.get(0) is None
+    assert [store.get(user_id).name for user_id in (1, 2)] == ["Task 1", "Task 2"]
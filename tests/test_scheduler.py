@@ -0,0 +1,67 @@
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scheduler
+
+
+def random_branches(seed, branches_count, steps_count):
+    rng = random.Random(seed)
+    return [[(rng.choice('ABCD'), rng.randint(1, 20), rng.randint(0, 60), rng.randint(0, 20))
+             for _ in range(steps_count)] for _ in range(branches_count)]
+
+
+def own_instances(branches):
+    """По экземпляру на каждый шаг: расписание ограничено только активными фазами."""
+    instances = {}
+    for branch in branches:
+        for equipment_name, _, _, _ in branch:
+            equip_ids = instances.setdefault(equipment_name, [])
+            equip_ids.append(f"{equipment_name}{len(equip_ids)}")
+    return instances
+
+
+def always_free(equip_id, start, end):
+    return True
+
+
+def test_truncated_table_is_not_trusted_over_branch_and_bound():
+    for branches_count, seed in ((6, 2), (10, 3)):
+        branches = random_branches(seed, branches_count, 5)
+        instances = own_instances(branches)
+        table = scheduler.build_shift_table(branches)
+        assert table["truncated"]
+
+        duration, schedule = scheduler.find_best_schedule(branches, instances, always_free, shift_table=table)
+        searched = scheduler.find_best_schedule(branches, instances, always_free)
+        assert duration <= table["shifts"][0][0]
+        assert duration <= searched[0]
+        assert duration == max(placement[3] for placement in schedule)
+
+
+def test_complete_table_matches_branch_and_bound():
+    branches = random_branches(0, 3, 3)
+    instances = own_instances(branches)
+    table = scheduler.build_shift_table(branches)
+    assert not table["truncated"]
+
+    from_table = scheduler.find_best_schedule(branches, instances, always_free, shift_table=table)
+    searched = scheduler.find_best_schedule(branches, instances, always_free)
+    assert from_table[0] == searched[0] == table["shifts"][0][0]
+
+
+def test_shortest_duration_of_truncated_table_ignores_other_equipment():
+    branches = [[(f"E{idx}", 2, 60, 2), (f"F{idx}", 1, 30, 1)] for idx in range(10)]
+    table = scheduler.build_shift_table(branches)
+    assert table["truncated"]
+    assert scheduler.shortest_duration(branches, table) == 123
+
+
+def test_shortest_duration_matches_exhaustive_table():
+    branches = [[("A", 5, 10, 5)], [("B", 5, 10, 5)]]
+    full = scheduler.build_shift_table(branches)
+    truncated = scheduler.build_shift_table(branches, max_nodes=2)
+    assert not full["truncated"] and truncated["truncated"]
+    assert scheduler.shortest_duration(branches, truncated) == scheduler.shortest_duration(branches, full) == 25
@@ -0,0 +1,84 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip('telebot')
+
+import send_queue
+from telebot.apihelper import ApiTelegramException
+
+
+def fast_queue(workers=4):
+    """Очередь с лимитами, которые не задерживают тест."""
+    return send_queue.SendQueue(workers=workers, global_rate=1000, global_burst=1000,
+                                chat_rate=1000, chat_burst=1000)
+
+
+def rate_limited(retry_after):
+    return ApiTelegramException('sendMessage', None, {'error_code': 429, 'description': 'Too Many Requests',
+                                                      'parameters': {'retry_after': retry_after}})
+
+
+def test_chat_messages_are_sent_in_order_for_int_and_str_ids():
+    queue = fast_queue()
+    sent, active = [], []
+
+    def send(text):
+        active.append(text)
+        assert len(active) == 1  # сообщения одного чата не отправляются параллельно
+        time.sleep(0.01)
+        sent.append(text)
+        active.remove(text)
+
+    futures = [queue.submit(42 if i % 2 else "42", send, (i,)) for i in range(10)]
+    queue.start()
+    try:
+        for future in futures:
+            future.result(10)
+    finally:
+        queue.stop()
+    assert sent == list(range(10))
+
+
+def test_interactive_messages_go_before_reminders():
+    queue = fast_queue(workers=1)
+    sent = []
+    futures = [queue.submit(1, sent.append, ("reminder",), priority=send_queue.REMINDER),
+               queue.submit(2, sent.append, ("other chat reminder",), priority=send_queue.REMINDER),
+               queue.submit("1", sent.append, ("answer",))]
+    queue.start()
+    try:
+        for future in futures:
+            future.result(10)
+    finally:
+        queue.stop()
+    assert sent == ["answer", "reminder", "other chat reminder"]
+
+
+def test_rate_limited_message_is_retried_and_pauses_other_chats():
+    queue = fast_queue(workers=1)
+    attempts = []
+    sent = {}
+
+    def limited():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise rate_limited(0.3)
+        return "ok"
+
+    first = queue.submit(1, limited)
+    second = queue.submit(2, lambda: sent.setdefault(2, time.monotonic()))
+    queue.start()
+    try:
+        assert first.result(10) == "ok"
+        second.result(10)
+    finally:
+        queue.stop()
+    assert len(attempts) == 2
+    assert attempts[1] - attempts[0] >= 0.3
+    assert sent[2] - attempts[0] >= 0.3  # 429 приостанавливает и общую корзину бота
@@ -0,0 +1,119 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import db
+
+# Где хранить незавершённые мастера создания задач:
+#   'memory' — в памяти процесса с вытеснением давно не используемых;
+#   'sqlite' — в таблице wizard_state, переживает перезапуск и видна всем процессам бота.
+WIZARD_STORE = os.environ.get('TASK_LAB_WIZARD_STORE', 'memory')
+# Брошенный мастер удаляется через столько секунд после последнего шага
+WIZARD_TTL_SECONDS = 24 * 60 * 60
+WIZARD_MAX_USERS = 10000
+# Блокировки пользователей берутся из фиксированного набора, а не создаются на каждого
+LOCK_STRIPES = 64
+# SQLite-хранилище удаляет истёкшие строки раз в столько записей
+PURGE_EVERY = 500
+
+
+class WizardState:
+    """Незавершённая задача: название и описание (None, пока не введены) и добавленные шаги."""
+
+    __slots__ = ('name', 'description', 'steps')
+
+    def __init__(self, name: str = None, description: str = None, steps: list = None):
+        self.name = name
+        self.description = description
+        self.steps = steps if steps is not None else []  # [{"name", "equipment", "timing": ['5a', '15p', '7a']}, ...]
+
+    def dumps(self) -> str:
+        """Компактная запись: [название, описание, [[шаг, прибор, '5a', '15p', '7a'], ...]]."""
+        return json.dumps([self.name, self.description,
+                           [[step["name"], step["equipment"]] + list(step["timing"]) for step in self.steps]],
+                          ensure_ascii=False, separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, data: str) -> 'WizardState':
+        name, description, steps = json.loads(data)
+        return cls(name, description, [{"name": step[0], "equipment": step[1], "timing": step[2:]} for step in steps])
+
+
+class _StripedLocks:
+    def __init__(self, stripes=LOCK_STRIPES):
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    def lock(self, user_id) -> threading.Lock:
+        """Блокировка пользователя для чтения-изменения-записи его состояния в этом процессе."""
+        return self._locks[hash(str(user_id)) % len(self._locks)]
+
+
+class MemoryWizardStore(_StripedLocks):
+    """Состояния в памяти процесса: не больше max_users, каждое живёт ttl секунд с последней записи."""
+
+    def __init__(self, max_users=WIZARD_MAX_USERS, ttl=WIZARD_TTL_SECONDS):
+        super().__init__()
+        self.max_users = max_users
+        self.ttl = ttl
+        self._states = OrderedDict()  # {user_id: (истекает, сериализованное состояние)}
+        self._states_lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._states_lock:
+            entry = self._states.get(str(user_id))
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._states[str(user_id)]
+                return None
+            data = entry[1]
+        return WizardState.loads(data)
+
+    def put(self, user_id, state: WizardState):
+        data = state.dumps()
+        with self._states_lock:
+            self._states[str(user_id)] = (time.monotonic() + self.ttl, data)
+            self._states.move_to_end(str(user_id))
+            while len(self._states) > self.max_users:
+                self._states.popitem(last=False)
+
+    def delete(self, user_id):
+        with self._states_lock:
+            self._states.pop(str(user_id), None)
+
+
+class SqliteWizardStore(_StripedLocks):
+    """Состояния в таблице wizard_state.
+
+    Блокировки действуют внутри процесса: обновления одного пользователя должны приходить
+    в один процесс, иначе последняя запись перетрёт параллельную.
+    """
+
+    def __init__(self, ttl=WIZARD_TTL_SECONDS):
+        super().__init__()
+        self.ttl = ttl
+        self._writes = 0
+
+    def get(self, user_id):
+        data = db.get_wizard_state(str(user_id))
+        return WizardState.loads(data) if data is not None else None
+
+    def put(self, user_id, state: WizardState):
+        now = int(time.time())
+        db.put_wizard_state(str(user_id), state.dumps(), now + self.ttl)
+        self._writes += 1
+        if self._writes % PURGE_EVERY == 0:
+            db.delete_wizard_state(expired_before=now)
+
+    def delete(self, user_id):
+        db.delete_wizard_state(str(user_id))
+
+
+def create_store(kind: str = WIZARD_STORE):
+    if kind == 'sqlite':
+        return SqliteWizardStore()
+    if kind == 'memory':
+        return MemoryWizardStore()
+    raise ValueError(f"Unknown wizard store: {kind}")